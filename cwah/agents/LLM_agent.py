@@ -1,4 +1,5 @@
 from LLM import *
+from utils.profiling import profiled
 
 
 class LLM_agent:
@@ -139,6 +140,7 @@ class LLM_agent:
 		return f"{action} <{x['class_name']}> ({x['id']}) <{y['class_name']}> ({y['id']})"
 
 
+	@profiled('llm')
 	def LLM_plan(self):
 		if len(self.grabbed_objects) == 2:
 			return f"[goput] {self.goal_location}", {}
@@ -19,6 +19,7 @@ import sys
 
 sys.path.append('..')
 from utils import utils_environment as utils_env
+from utils.profiling import profiled
 
 
 def find_heuristic(agent_id, char_index, unsatisfied, env_graph, simulator, object_target):
@@ -366,6 +367,7 @@ def clean_graph(state, goal_spec, last_opened):
     return new_graph
 
 
+@profiled('mcts')
 def get_plan(sample_id, root_action, root_node, env, mcts, nb_steps, goal_spec, res, last_subgoal, last_action,
              opponent_subgoal=None, verbose=True):
     init_state = env.state
@@ -483,6 +485,7 @@ class MCTS_agent:
         graph['edges'] = new_edges
         return graph
 
+    @profiled('belief')
     def sample_belief(self, obs_graph):
         new_graph = self.belief.update_graph_from_gt_graph(obs_graph)
         self.belief.append_to_send()
@@ -24,6 +24,7 @@ from agents.MCTS_agent import *
 import sys
 sys.path.append('..')
 from utils import utils_environment as utils_env
+from utils.profiling import profiled
 
 class MCTS_vision_agent():
     """
@@ -79,6 +80,7 @@ class MCTS_vision_agent():
         graph['edges'] = new_edges
         return graph
 
+    @profiled('belief')
     def sample_belief(self, obs_graph):
         new_graph = self.belief.update_graph_from_gt_graph(obs_graph)
         self.previous_belief_graph = self.filtering_graph(new_graph)
@@ -9,6 +9,7 @@ import sys
 import simulation.evolving_graph.utils as vh_utils
 import json
 import copy
+from utils.profiling import profiled
 
 
 class Belief():
@@ -202,6 +203,7 @@ class Belief():
                 report.append((room_id, obj_in_it))
         return report
     
+    @profiled('messages')
     def receive_belief_new(self, message):
         # message is a list of (node_id, [obj in it])
         for relation in message:
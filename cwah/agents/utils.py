@@ -3,6 +3,7 @@ import numpy as np
 import cv2
 import copy
 import re
+from utils.profiling import profiled
 
 def save_pcd_from_point_array(pos, col = None, filename = 'temp.ply'):
     print(filename)
@@ -46,6 +47,55 @@ def save_navigation_visual_map(grid_info, filename):
                 visualize[x, y, grid_info[x, y]] = 1
     cv2.imwrite(filename, visualize[:, :, 1:] * 255)
 
+class CameraModel:
+    r'''
+        Unprojection of depth images to world points.
+        The camera space ray of every pixel is cached per (width, height, projection matrix), so a frame costs one matmul.
+    '''
+    rays_cache = {}
+
+    @staticmethod
+    def matrices(camera_info):
+        projection = np.array(camera_info['projection_matrix']).reshape((4,4)).transpose()
+        view = np.array(camera_info['world_to_camera_matrix']).reshape((4,4)).transpose()
+        return projection, inverse_rot(view)
+
+    @classmethod
+    def rays(cls, ws, hs, projection):
+        r'''
+            camera space points of all pixels at depth 1, shape = (hs * ws, 3), and the image location of the pixels, shape = (hs * ws, 2)
+        '''
+        key = (ws, hs, projection.tobytes())
+        if key not in cls.rays_cache:
+            xv, yv = np.meshgrid(np.arange(ws), np.arange(hs))
+            # Normalize image coordinates
+            x = xv.reshape((-1)) * 2./hs - ws / hs
+            y = 2 - (yv.reshape((-1)) * 2./hs) - 1
+            rays = np.stack([x / projection[0,0], y / projection[1,1], -np.ones(len(x))], axis = 1)
+            image_location = np.stack([xv.reshape(-1), yv.reshape(-1)], axis = 1)
+            cls.rays_cache[key] = (rays, image_location)
+        return cls.rays_cache[key]
+
+    @classmethod
+    def unproject(cls, depths, camera_infos):
+        r'''
+            depths: (F, hs, ws), camera_infos: F camera infos
+            return world points, shape = (F, hs * ws, 3), camera positions, shape = (F, 3), image location of the pixels, shape = (hs * ws, 2)
+        '''
+        (num_frames, hs, ws) = depths.shape
+        pos = np.zeros((num_frames, hs * ws, 3))
+        camera_pos = np.zeros((num_frames, 3))
+        for i in range(num_frames):
+            projection, inv_view = cls.matrices(camera_infos[i])
+            rays, image_location = cls.rays(ws, hs, projection)
+            pos[i] = np.matmul(rays * depths[i].reshape((-1, 1)), inv_view[:3, :3].transpose()) + inv_view[:3, 3]
+            camera_pos[i] = inv_view[:3, 3]
+        return pos, camera_pos, image_location
+
+def image_colors(img):
+    if (len(img.shape) > 2): return np.array(img.reshape(-1, 3)) / 255
+    return np.array(img.reshape(-1))
+
 def image2coords(img, depth, camera_info, far_away_remove = True, remove_threshold = 10, clip = None, mask = None):
     r'''
         for a (img, depth) input, return a list of points, rgb: [x, y, z], [g ,b, r]
@@ -56,79 +106,48 @@ def image2coords(img, depth, camera_info, far_away_remove = True, remove_thresho
     if (len(depth.shape) > 2): depth = depth[:, :, 0]
     if (len(img.shape) > 2): (hs, ws, _) = img.shape
     else: (hs, ws) = img.shape
-#    if (hs > ws):
-#        delt = (hs - ws) / 2
-#        img = img[:, int(delt):int(delt + ws)]
-#        depth = depth[:, int(delt):int(delt + ws)]
-#    if (len(img.shape) > 2): (ws, hs, _) = img.shape
-#    else: (ws, hs) = img.shape
-    # naspect = float(ws/hs)
-    # aspect = camera_info['aspect']
-    
-    w = np.arange(ws)
-    h = np.arange(hs)
-    projection = np.array(camera_info['projection_matrix']).reshape((4,4)).transpose()
-    view = np.array(camera_info['world_to_camera_matrix']).reshape((4,4)).transpose()
-
-    # Build inverse projection
-    inv_view = inverse_rot(view)
-    # img = img.reshape(-1,3)
-    # col = img
-
-    xv, yv = np.meshgrid(w, h)
-    ori_x, ori_y = np.meshgrid(w, h) # check it
+
+    pos, camera_pos, image_location = CameraModel.unproject(depth[None], [camera_info])
+    pos, camera_pos = pos[0], camera_pos[0]
+    col = image_colors(img)
     if type(clip) != type(None):
         clip = [int(clip[0]), int(clip[1]), int(clip[2]), int(clip[3])]
-        xv = xv[clip[1]:clip[3], clip[0]:clip[2]]
-        yv = yv[clip[1]:clip[3], clip[0]:clip[2]]
-        ori_x = ori_x[clip[1]:clip[3], clip[0]:clip[2]]
-        ori_y = ori_y[clip[1]:clip[3], clip[0]:clip[2]]
-        img = img[clip[1]:clip[3], clip[0]:clip[2]]
-        depth = depth[clip[1]:clip[3], clip[0]:clip[2]]
+        index = np.arange(hs * ws).reshape((hs, ws))[clip[1]:clip[3], clip[0]:clip[2]].reshape(-1)
+        pos, col, image_location = pos[index], col[index], image_location[index]
         if type(mask) != type(None):
             mask = mask[clip[1]:clip[3], clip[0]:clip[2]]
 
-    # npoint = ws * hs
-    # Normalize image coordinates to -1, 1
-    # -1 to 1
-    # xp = xv.reshape((-1))
-    # yp = yv.reshape((-1))
-
-    x = xv.reshape((-1)) * 2./hs - ws / hs
-    y = 2 - (yv.reshape((-1)) * 2./hs) - 1
-    z = depth.reshape((-1))
-
-    nump = x.shape[0]
-
-    m00 = projection[0,0]
-    m11 = projection[1,1]
-
-    xn = x*z / m00
-    yn = y*z / m11
-    zn = -z
-    XY1 = np.concatenate([xn[:, None], yn[:, None], zn[:, None], np.ones((nump,1))], 1).transpose()
-    # World coordinates
-    XY = np.matmul(inv_view, XY1).transpose()
-
-    x, y, z = XY[:, 0], XY[:, 1], XY[:, 2]
-    if (len(img.shape) > 2):
-        pos, col = np.array([x, y, z]).transpose(), np.array(img.reshape(-1, 3)) / 255
-    else:
-        pos, col = np.array([x, y, z]).transpose(), np.array(img.reshape(-1))
-    image_location = np.array([ori_x.reshape(-1), ori_y.reshape(-1)]).transpose()
     if (len(col.shape) > 1):
         col = col[:, [2, 1, 0]]
-    camera_pos = np.matmul(inv_view, np.array([0, 0, 0, 1]))
     if (type(mask) != type(None)):
         pos = pos[mask.reshape(-1)]
         col = col[mask.reshape(-1)]
         image_location = image_location[mask.reshape(-1)]
     if (far_away_remove == True):
-        remain_id = [np.sqrt((pos[i][0] - camera_pos[0]) ** 2 + (pos[i][2] - camera_pos[2]) ** 2) <= remove_threshold for i in range(len(pos))]
+        remain_id = np.hypot(pos[:, 0] - camera_pos[0], pos[:, 2] - camera_pos[2]) <= remove_threshold
         pos = pos[remain_id]
         col = col[remain_id]
         image_location = image_location[remain_id]
-    return pos, col, image_location, camera_pos[:3]
+    return pos, col, image_location, camera_pos
+
+def image2coords_batch(imgs, depths, camera_infos, far_away_remove = True, remove_threshold = 10):
+    r'''
+        image2coords for several frames of the same size, possibly from different cameras, in one call
+        return points position, points color, points image location, frame index of the points, camera positions, the points of all frames are concatenated
+    '''
+    depths = np.stack([depth[:, :, 0] if len(depth.shape) > 2 else depth for depth in depths])
+    pos, camera_pos, image_location = CameraModel.unproject(depths, camera_infos)
+    col = np.concatenate([image_colors(img) for img in imgs])
+    if (len(col.shape) > 1):
+        col = col[:, [2, 1, 0]]
+    frame = np.repeat(np.arange(len(depths)), pos.shape[1])
+    image_location = np.tile(image_location, (len(depths), 1))
+    if (far_away_remove == True):
+        remain_id = (np.hypot(pos[:, :, 0] - camera_pos[:, 0:1], pos[:, :, 2] - camera_pos[:, 2:3]) <= remove_threshold).reshape(-1)
+    else:
+        remain_id = np.ones(len(frame), dtype = bool)
+    pos = pos.reshape((-1, 3))
+    return pos[remain_id], col[remain_id], image_location[remain_id], frame[remain_id], camera_pos
 
 def bbox_from_point(point):
     return [point for i in range(8)]
@@ -229,6 +248,63 @@ def relationship_detection(bbox_a, bbox_b, close_to_threshold = 2.5, outlog = Fa
     
     return np.array([is_ON, is_INSIDE, is_CLOSE])
 
+def candidate_pairs(lo, hi, query, targets, close_to_threshold = 2.5, eps = 0.25):
+    r'''
+        Broad phase of batch_relationship_detection, lo / hi: (N, 3) corners of the axis aligned bboxes
+        Return the pairs (a, b), a in query and b in targets, that may have a relationship, all other pairs are [0, 0, 0]:
+        the center of a is close to the center of b, or inside the top view rectangle of b enlarged by eps.
+        The targets are put into a uniform grid on the ground (x, z), each cell lists the targets that a center in it can be related to.
+    '''
+    center = (lo + hi)[:, [0, 2]] / 2
+    reach_lo = np.floor(np.minimum(lo[:, [0, 2]] - eps, center - close_to_threshold) / close_to_threshold).astype(int)
+    reach_hi = np.floor(np.maximum(hi[:, [0, 2]] + eps, center + close_to_threshold) / close_to_threshold).astype(int)
+    grid = {}
+    for b in targets:
+        for x in range(reach_lo[b][0], reach_hi[b][0] + 1):
+            for z in range(reach_lo[b][1], reach_hi[b][1] + 1):
+                grid.setdefault((x, z), []).append(b)
+    cell = np.floor(center / close_to_threshold).astype(int)
+    pair_a, pair_b = [], []
+    for a in query:
+        in_cell = grid.get((cell[a][0], cell[a][1]), [])
+        pair_a += [a] * len(in_cell)
+        pair_b += in_cell
+    pair_a, pair_b = np.array(pair_a, dtype = int), np.array(pair_b, dtype = int)
+    near = np.linalg.norm(center[pair_a] - center[pair_b], axis = 1) < close_to_threshold
+    over = np.all((center[pair_a] >= lo[pair_b][:, [0, 2]] - eps) & (center[pair_a] <= hi[pair_b][:, [0, 2]] + eps), axis = 1)
+    keep = (pair_a != pair_b) & (near | over)
+    return pair_a[keep], pair_b[keep]
+
+def clip_bboxes(points, lo_a, hi_a):
+    r'''
+        The bbox of points cropped to the top view rectangle of each bbox a enlarged by 0.5, as the crop in relationship_detection
+        points: (M, 3), lo_a / hi_a: (K, 3), return the (K, 3) corners of the cropped bboxes, the bbox of all points if nothing is cropped
+    '''
+    inside = (points[None, :, 0] >= lo_a[:, None, 0] - 0.5) & (points[None, :, 0] <= hi_a[:, None, 0] + 0.5) \
+           & (points[None, :, 2] >= lo_a[:, None, 2] - 0.5) & (points[None, :, 2] <= hi_a[:, None, 2] + 0.5) \
+           & (points[None, :, 1] >= -10) & (points[None, :, 1] <= 10)
+    clip_lo = np.where(inside[:, :, None], points[None], np.inf).min(axis = 1)
+    clip_hi = np.where(inside[:, :, None], points[None], -np.inf).max(axis = 1)
+    empty = ~inside.any(axis = 1)
+    clip_lo[empty] = points.min(axis = 0)
+    clip_hi[empty] = points.max(axis = 0)
+    return clip_lo, clip_hi
+
+def batch_relationship_detection(lo_a, hi_a, lo_b, hi_b, clip_lo_b, clip_hi_b, close_to_threshold = 2.5):
+    r'''
+        relationship_detection for K pairs of axis aligned bboxes at once, lo / hi: (K, 3) corners, clip_lo_b / clip_hi_b: the cropped bboxes of b
+        Return: (K, 3) array of bool, ON, INSIDE, CLOSE
+    '''
+    def inside_rectangle(x, z, eps = 0.25):
+        return (x >= clip_lo_b[:, 0] - eps) & (x <= clip_hi_b[:, 0] + eps) & (z >= clip_lo_b[:, 2] - eps) & (z <= clip_hi_b[:, 2] + eps)
+    center_a = (lo_a + hi_a) / 2
+    center_b = (lo_b + hi_b) / 2
+    is_ON = (np.abs(lo_a[:, 1] - clip_hi_b[:, 1]) < 0.6) & inside_rectangle(center_a[:, 0], center_a[:, 2]) & (hi_a[:, 1] + 0.1 > clip_hi_b[:, 1])
+    is_INSIDE = (lo_a[:, 1] + 0.1 > clip_lo_b[:, 1]) & (hi_a[:, 1] < clip_hi_b[:, 1] + 0.1) \
+              & inside_rectangle(lo_a[:, 0], lo_a[:, 2]) & inside_rectangle(hi_a[:, 0], hi_a[:, 2])
+    is_CLOSE = np.linalg.norm(center_a[:, [0, 2]] - center_b[:, [0, 2]], axis = 1) < close_to_threshold
+    return np.stack([is_ON, is_INSIDE, is_CLOSE], axis = 1)
+
 def two_point_to_bbox(a, b):
     return np.array([
         [a[0], a[1], a[2]],
@@ -318,6 +394,7 @@ def MCTS_to_language_convert(info, id_to_name_api = None):
             language['B'] += st
     return f'{language}'
 
+@profiled('messages')
 def language_to_MCTS_convert(language):
     msg = {}
     try:
@@ -6,6 +6,7 @@ import numpy as np
 
 from . import vision_pipeline
 from LLM import *
+from utils.profiling import profiled
 # from maskrcnn_benchmark.engine.predictor_glip import GLIPDemo
 # from maskrcnn_benchmark.config import cfg
 
@@ -188,6 +189,7 @@ class vision_LLM_agent:
 		return f"{action} <{x['class_name']}> ({x['id']}) <{y['class_name']}> ({y['id']})"
 
 
+	@profiled('llm')
 	def LLM_plan(self):
 		if len(self.grabbed_objects) == 2:
 			return f"[goput] {self.goal_location}", {}
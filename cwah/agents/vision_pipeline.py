@@ -2,6 +2,7 @@ import numpy as np
 import open3d as o3d
 import re
 from . import utils
+from utils.profiling import profiled
 #from mmdet.apis import init_detector, inference_detector
 
 '''
@@ -21,6 +22,48 @@ class agent_vision_config:
         self.agent_id = agent_id
         self.gt_seg = gt_seg
 
+class Object_Map:
+    r'''
+        Persistent voxel hashed point clouds of the objects. New observations are fused into the voxels of the object.
+    '''
+    def __init__(self, voxel_size = 0.01):
+        self.voxel_size = voxel_size
+        self.voxels = {} # id -> (sorted voxel keys, sum of the points in each voxel, number of points in each voxel)
+
+    def voxel_keys(self, pos):
+        # pack the voxel coordinates into one int64, 21 bits for each axis
+        v = np.floor(pos / self.voxel_size).astype(np.int64) + (1 << 20)
+        return (v[:, 0] << 42) | (v[:, 1] << 21) | v[:, 2]
+
+    def fuse(self, id, pos):
+        r'''
+            Fuse the points of a new observation into the object, return whether the object got new voxels.
+            If the new points are away from the stored ones, the object has been moved and the old voxels are dropped.
+        '''
+        pos = np.asarray(pos).reshape(-1, 3)
+        if len(pos) == 0: return False
+        keys, sums, counts = self.voxels.get(id, (np.zeros(0, dtype = np.int64), np.zeros((0, 3)), np.zeros(0)))
+        if len(keys) > 0:
+            points = sums / counts[:, None]
+            if np.any(pos.min(axis = 0) > points.max(axis = 0) + 0.1) or np.any(pos.max(axis = 0) < points.min(axis = 0) - 0.1):
+                keys, sums, counts = keys[:0], sums[:0], counts[:0]
+        all_keys, inverse = np.unique(np.concatenate([keys, self.voxel_keys(pos)]), return_inverse = True)
+        inverse = inverse.reshape(-1)
+        all_pos = np.concatenate([sums, pos])
+        all_counts = np.concatenate([counts, np.ones(len(pos))])
+        sums = np.stack([np.bincount(inverse, weights = all_pos[:, k], minlength = len(all_keys)) for k in range(3)], axis = 1)
+        counts = np.bincount(inverse, weights = all_counts, minlength = len(all_keys))
+        changed = not np.array_equal(all_keys, keys)
+        self.voxels[id] = (all_keys, sums, counts)
+        return changed
+
+    def remove(self, id):
+        self.voxels.pop(id, None)
+
+    def points(self, id):
+        keys, sums, counts = self.voxels[id]
+        return sums / counts[:, None]
+
 class Vision_Pipeline:
     def __init__(self, config: agent_vision_config, init_obs):
         self.config = config
@@ -31,6 +74,9 @@ class Vision_Pipeline:
         self.last_action = None
         self.see_this_step = [] # The objects that are seen this step
         self.consider_upd = [] # The objects that are considered to be updated this step, the list contains the object id in last action
+        self.object_map = Object_Map() # the fused point clouds, object_info[id]['pcd'] is rebuilt from it when the object gets new voxels
+        self.bbox_cache = {} # id -> (pcd, points, min corner, max corner) of the point cloud of the object
+        self.cluster_cache = {} # id -> (voxels of the object, main cluster) in the last frame, to skip clustering unchanged objects
         for x in init_obs['room_info']:
             self.object_info[x['id']] = {
                 'class_name': self.obs['get_class_name'](x['id']),
@@ -122,8 +168,9 @@ class Vision_Pipeline:
 
     def update_object_info(self, pcd):
         if pcd['id'] not in self.object_info.keys():
+            self.object_map.fuse(pcd['id'], pcd['pos'])
             self.object_info[pcd['id']] = {
-                'pcd': utils.read_pcd_from_point_array(pcd['pos'], pcd['col']),
+                'pcd': utils.read_pcd_from_point_array(self.object_map.points(pcd['id'])),
                 'class_name': pcd['name'],
                 'properties': self.obs['get_properties'](pcd['id']),
                 'category': self.obs['get_category'](pcd['id']),
@@ -131,43 +178,70 @@ class Vision_Pipeline:
             }
         else:
             if pcd['id'] in self.with_character_id or 'pcd' not in self.object_info[pcd['id']]: return
-            self.object_info[pcd['id']]['pcd'] = utils.read_pcd_from_point_array(pcd['pos'], pcd['col'])
-            self.object_info[pcd['id']]['pcd'] = self.object_info[pcd['id']]['pcd'].voxel_down_sample(voxel_size=0.01)
+            if self.object_map.fuse(pcd['id'], pcd['pos']):
+                self.object_info[pcd['id']]['pcd'] = utils.read_pcd_from_point_array(self.object_map.points(pcd['id']))
+
+    def clear_object_pcd(self, id):
+        self.object_info[id]['pcd'] = o3d.geometry.PointCloud()
+        self.object_map.remove(id)
     
     def obj_pcd_from_seg(self, obs):
+        r'''
+            Group the points of all frames by object id with one sort, voxelize all objects in one pass (one point per occupied 1cm voxel),
+            and cluster only the objects whose voxels changed since the last call.
+        '''
+        pos, col, image_location, frame, camera_pos = utils.image2coords_batch(obs['seg_info'], obs['depth'], obs['camera_info'], far_away_remove = False)
+        pos, ids = pos[col >= 0], col[col >= 0].astype(np.int64)
         seg_map = {}
-        for i in range(len(obs['seg_info'])):
-            pos, col, image_location, camera_pos = utils.image2coords(obs['seg_info'][i], obs['depth'][i], obs['camera_info'][i], far_away_remove = False)
-            for j in range(len(col)):
-                if (col[j] >= 0):
-                    if (col[j] in seg_map.keys()):
-                        seg_map[col[j]]['pos'].append(pos[j])
-                    else:
-                        seg_map[col[j]] = {'id': int(col[j]), 'pos': [pos[j]], 'name': self.obs['get_class_name'](col[j]), 'col': None}
-        removed = []
-        len_removed = {}
-        for id in seg_map.keys():
-            pcd = utils.read_pcd_from_point_array(seg_map[id]['pos'])
-            pcd = pcd.voxel_down_sample(voxel_size=0.01)
-            pos = np.asarray(pcd.points)
-            labels = np.array(pcd.cluster_dbscan(eps=0.1, min_points=3))
-            vis_labels = labels[labels >= 0]
-            if (len(vis_labels) == 0 or len(labels) < 5):
+        if len(ids) == 0:
+            self.cluster_cache = {}
+            return seg_map
+        # rows sorted by (id, voxel), so the voxels of each object are contiguous
+        keys = np.concatenate([ids[:, None], np.floor(pos / 0.01).astype(np.int64)], axis = 1)
+        keys, inverse = np.unique(keys, axis = 0, return_inverse = True)
+        inverse = inverse.reshape(-1)
+        counts = np.bincount(inverse, minlength = len(keys))
+        voxel_pos = np.stack([np.bincount(inverse, weights = pos[:, k], minlength = len(keys)) for k in range(3)], axis = 1) / counts[:, None]
+        starts = np.nonzero(np.diff(keys[:, 0]))[0] + 1
+        cluster_cache = {}
+        for group in np.split(np.arange(len(keys)), starts):
+            id = int(keys[group[0], 0])
+            voxels = keys[group, 1:].tobytes()
+            if id in self.cluster_cache and self.cluster_cache[id][0] == voxels:
+                cluster_cache[id] = self.cluster_cache[id]
+            else:
+                cluster_cache[id] = (voxels, self.main_cluster(voxel_pos[group]))
+            if cluster_cache[id][1] is None:
                 # The object is too far, leave it later.
                 # depends on image size, leave it later.
-                removed.append(id)
-                len_removed[id] = len(labels)
                 continue
-            else:
-                self.see_this_step.append(id)
-            true_label = np.argmax(np.bincount(vis_labels))
-            labels = (labels == true_label) # the main cluster
-            pos = pos[labels]
-            seg_map[id]['pos'] = pos
-        for id in removed:
-            seg_map.pop(id)
+            self.see_this_step.append(id)
+            seg_map[id] = {'id': id, 'pos': cluster_cache[id][1], 'name': self.obs['get_class_name'](id), 'col': None}
+        self.cluster_cache = cluster_cache
         return seg_map
+
+    def main_cluster(self, pos):
+        r'''
+            The points of the main cluster of an object, None if the object is too far (too few points).
+        '''
+        pcd = utils.read_pcd_from_point_array(pos)
+        labels = np.array(pcd.cluster_dbscan(eps=0.1, min_points=3))
+        vis_labels = labels[labels >= 0]
+        if (len(vis_labels) == 0 or len(labels) < 5):
+            return None
+        true_label = np.argmax(np.bincount(vis_labels))
+        return pos[labels == true_label] # the main cluster
     
+    def get_bbox(self, id, pcd):
+        r'''
+            The points and the axis aligned bbox of the point cloud of an object, recomputed only when the point cloud is replaced
+        '''
+        if id not in self.bbox_cache or self.bbox_cache[id][0] is not pcd:
+            points = np.asarray(pcd.points)
+            self.bbox_cache[id] = (pcd, points, points.min(axis = 0), points.max(axis = 0))
+        return self.bbox_cache[id][1:]
+
+    @profiled('vision')
     def get_graph(self):
         r'''
             get the graph from the object info
@@ -193,74 +267,85 @@ class Vision_Pipeline:
         detected_edges = []
         inside_node = np.zeros(len(nodes))
 
+        # bboxes of the visible objects, the objects with the character are at the location of the agent
+        location = np.array(self.obs['location'], dtype = float)
+        lo, hi = np.zeros((len(nodes), 3)), np.zeros((len(nodes), 3))
+        points = [None] * len(nodes)
+        visible = np.zeros(len(nodes), dtype = bool)
+        for i in range(len(nodes)):
+            if nodes[i]['category'] in ['Rooms']: continue
+            if nodes[i]['id'] in self.with_character_id:
+                lo[i], hi[i], visible[i] = location, location, True
+            elif nodes[i]['id'] in self.see_this_step and 'pcd' in nodes[i]:
+                points[i], lo[i], hi[i] = self.get_bbox(nodes[i]['id'], nodes[i]['pcd'])
+                visible[i] = True
+        near_agent = np.linalg.norm((lo + hi)[:, [0, 2]] / 2 - location[[0, 2]], axis = 1) < 2.5
+
         close_object = []
         # detect the edges between the agent and the object
         for i in range(len(nodes)):
             if nodes[i]['category'] in ['Rooms'] or nodes[i]['class_name'] in ['character']: continue
             self.object_relation[(self.config.agent_id, nodes[i]['id'])] = [0, 0, 0]
             self.object_relation[(nodes[i]['id'], self.config.agent_id)] = [0, 0, 0]
-            bbox_my = utils.bbox_from_point(self.obs['location'])
-            if nodes[i]['id'] not in self.see_this_step and nodes[i]['id'] not in self.with_character_id: continue
-            if nodes[i]['id'] in self.with_character_id: bbox_i = utils.bbox_from_point(self.obs['location'])
-            else: bbox_i = nodes[i]['pcd'].get_axis_aligned_bounding_box()
-            self.object_relation[(self.config.agent_id, nodes[i]['id'])] = [0, 0, utils.relationship_detection(bbox_my, bbox_i)[2]]
-            self.object_relation[(nodes[i]['id'], self.config.agent_id)] = [0, 0, utils.relationship_detection(bbox_i, bbox_my)[2]]
-            if self.object_relation[(self.config.agent_id, nodes[i]['id'])][2]:
-                close_object.append(nodes[i]['id'])
+            if not visible[i]: continue
+            self.object_relation[(self.config.agent_id, nodes[i]['id'])] = [0, 0, near_agent[i]]
+            self.object_relation[(nodes[i]['id'], self.config.agent_id)] = [0, 0, near_agent[i]]
+            if near_agent[i]:
+                close_object.append(i)
         # If an object is close in vision, we calculate the relationship between the ojbect.
         # The truly close relationship come from gt.
 
-        # detect the edges between objects
-        for i in range(len(nodes)):
-            if nodes[i]['id'] not in close_object: continue
-            # not detect the edges of far-away objects
-            for j in range(len(nodes)):
-                if i == j: continue
-                if nodes[i]['category'] in ['Rooms'] or nodes[j]['category'] in ['Rooms']: continue
-                if nodes[i]['id'] not in self.see_this_step and nodes[i]['id'] not in self.with_character_id: continue
-                if nodes[j]['id'] not in self.see_this_step and nodes[j]['id'] not in self.with_character_id: continue
-                if nodes[i]['id'] in self.with_character_id: bbox_i = utils.bbox_from_point(self.obs['location'])
-                elif 'pcd' in nodes[i]: bbox_i = nodes[i]['pcd']
-                else: continue
-                if nodes[j]['id'] in self.with_character_id: bbox_j = utils.bbox_from_point(self.obs['location'])
-                elif 'pcd' in nodes[j]: bbox_j = nodes[j]['pcd']
-                else: continue
-                temp_relation = utils.relationship_detection(bbox_i, bbox_j)
-                if 'CAN_OPEN' not in nodes[j]['properties'] or 'CAN_OPEN' in nodes[i]['properties'] or nodes[j]['class_name'] not in self.container_classes: temp_relation[1] = 0
-                if 'SURFACES' not in nodes[j]['properties']: temp_relation[0] = 0
-                if temp_relation[2] == 1 and (nodes[i]['id'], nodes[j]['id']) in self.object_relation.keys():
-                    self.object_relation[(nodes[i]['id'], nodes[j]['id'])] = np.array([temp_relation[x] or self.object_relation[(nodes[i]['id'], nodes[j]['id'])][x] for x in range(3)])
-                else:
-                    self.object_relation[(nodes[i]['id'], nodes[j]['id'])] = temp_relation
-                #If still close and not grab, the error is due to detection error.
-                if nodes[i]['id'] in self.with_character_id: self.object_relation[(nodes[i]['id'], nodes[j]['id'])][0: 2] = 0
-                #If (nodes[i]['id'] in [386, 390, 391, 384] and nodes[j]['id'] in [130]):
-                #    print(nodes[i]['id'], nodes[j]['id'], self.object_relation[(nodes[i]['id'], nodes[j]['id'])])
-                #    print(utils.relationship_detection(bbox_i, bbox_j, outlog = True))
+        # detect the edges between objects, not detect the edges of far-away objects
+        # only the candidate pairs from the grid can be related, the other pairs of close and visible objects are reset
+        targets = np.nonzero(visible)[0]
+        pair_a, pair_b = utils.candidate_pairs(lo, hi, close_object, targets)
+        id_a = {nodes[i]['id'] for i in close_object}
+        id_b = {nodes[j]['id'] for j in targets}
+        candidates = {(nodes[i]['id'], nodes[j]['id']) for i, j in zip(pair_a, pair_b)}
+        for key in self.object_relation.keys():
+            if key[0] in id_a and key[1] in id_b and key[0] != key[1] and key not in candidates:
+                self.object_relation[key] = np.zeros(3, dtype = bool)
+        clip_lo, clip_hi = lo[pair_b].copy(), hi[pair_b].copy()
+        for j in np.unique(pair_b):
+            if points[j] is None: continue
+            k = np.nonzero(pair_b == j)[0]
+            clip_lo[k], clip_hi[k] = utils.clip_bboxes(points[j], lo[pair_a[k]], hi[pair_a[k]])
+        relations = utils.batch_relationship_detection(lo[pair_a], hi[pair_a], lo[pair_b], hi[pair_b], clip_lo, clip_hi)
+        for i, j, temp_relation in zip(pair_a, pair_b, relations):
+            if 'CAN_OPEN' not in nodes[j]['properties'] or 'CAN_OPEN' in nodes[i]['properties'] or nodes[j]['class_name'] not in self.container_classes: temp_relation[1] = 0
+            if 'SURFACES' not in nodes[j]['properties']: temp_relation[0] = 0
+            if temp_relation[2] == 1 and (nodes[i]['id'], nodes[j]['id']) in self.object_relation.keys():
+                self.object_relation[(nodes[i]['id'], nodes[j]['id'])] = np.array([temp_relation[x] or self.object_relation[(nodes[i]['id'], nodes[j]['id'])][x] for x in range(3)])
+            else:
+                self.object_relation[(nodes[i]['id'], nodes[j]['id'])] = temp_relation
+            #If still close and not grab, the error is due to detection error.
+            if nodes[i]['id'] in self.with_character_id: self.object_relation[(nodes[i]['id'], nodes[j]['id'])][0: 2] = 0
 
-        for i in range(len(nodes)):
-            for j in range(len(nodes)):
-                if i == j: continue
-                if nodes[i]['category'] in ['Rooms'] or nodes[j]['category'] in ['Rooms']: continue
-                if (nodes[i]['id'], nodes[j]['id']) not in self.object_relation.keys(): continue
-                relation = self.object_relation[(nodes[i]['id'], nodes[j]['id'])]
-                if relation[0] and nodes[i]['category'] not in ['Rooms', 'Characters']:
-                    detected_edges.append({'from_id': nodes[i]['id'], 'to_id': nodes[j]['id'], 'relation_type': 'ON'})
-                if relation[1] and nodes[i]['category'] not in ['Rooms', 'Characters'] and inside_node[i] == 0:
-                    detected_edges.append({'from_id': nodes[i]['id'], 'to_id': nodes[j]['id'], 'relation_type': 'INSIDE'})
-                    inside_node[i] = nodes[j]['id']
+        # the relations between nodes in the order of nodes, the first INSIDE relation of a node is kept
+        node_index = {nodes[i]['id']: i for i in range(len(nodes)) if nodes[i]['category'] not in ['Rooms']}
+        pairs = sorted((node_index[a], node_index[b]) for (a, b) in self.object_relation.keys() if a in node_index and b in node_index and a != b)
+        for i, j in pairs:
+            relation = self.object_relation[(nodes[i]['id'], nodes[j]['id'])]
+            if relation[0] and nodes[i]['category'] not in ['Rooms', 'Characters']:
+                detected_edges.append({'from_id': nodes[i]['id'], 'to_id': nodes[j]['id'], 'relation_type': 'ON'})
+            if relation[1] and nodes[i]['category'] not in ['Rooms', 'Characters'] and inside_node[i] == 0:
+                detected_edges.append({'from_id': nodes[i]['id'], 'to_id': nodes[j]['id'], 'relation_type': 'INSIDE'})
+                inside_node[i] = nodes[j]['id']
         
         for i in range(len(nodes)):
             if inside_node[i] == 0 and nodes[i]['category'] not in ['Rooms']:
                 detected_edges.append({'from_id': nodes[i]['id'], 'to_id': self.obs['current_room'], 'relation_type': 'INSIDE'})
 
+        all_nodes = set([x['id'] for x in nodes])
         for node in self.obs['nodes']: 
-            if node['id'] not in [x['id'] for x in nodes]: nodes.append(node)
-        all_nodes = [x['id'] for x in nodes]
+            if node['id'] not in all_nodes:
+                nodes.append(node)
+                all_nodes.add(node['id'])
+        visiable_ids = set(self.visiable_ids)
         for edge in self.obs['edges']:
             if edge['from_id'] not in all_nodes: continue
             if edge['to_id'] not in all_nodes and self.obs['get_category'](edge['to_id']) != 'Rooms': continue
-            if edge['from_id'] not in self.visiable_ids or edge['relation_type'] not in ['INSIDE']: detected_edges.append(edge)
+            if edge['from_id'] not in visiable_ids or edge['relation_type'] not in ['INSIDE']: detected_edges.append(edge)
         # Only consider the visible special edges, such as hold, CLOSE
 
         for node in nodes:
@@ -268,7 +353,8 @@ class Vision_Pipeline:
 
         detected_edges = [{**x, 'obs': True} for x in detected_edges]
         return self.obs['remove_duplicate_graph']({'nodes': nodes, 'edges': detected_edges})
-    
+
+    @profiled('vision')
     def deal_with_obs(self, obs, last_action = None):
         self.obs = obs
         self.last_action = last_action
@@ -312,6 +398,7 @@ class Vision_Pipeline:
                         for item_id in removed:
                             self.object_info.pop(item_id)
                         for item_id in ids:
+                            self.object_map.remove(item_id)
                             self.object_info[item_id] = {
                                 'pcd': o3d.geometry.PointCloud(),
                                 'class_name': id2node_sent[item_id]['class_name'],
@@ -342,7 +429,7 @@ class Vision_Pipeline:
                     self.consider_upd.append(to_grab_id)
                     if to_grab_id in self.object_info.keys():
                         if 'pcd' in self.object_info[to_grab_id]:
-                            self.object_info[to_grab_id]['pcd'] = o3d.geometry.PointCloud()
+                            self.clear_object_pcd(to_grab_id)
                     else:
                         print('grab an object that is not in the object_info')
                     # Clear the pcd
@@ -11,11 +11,14 @@ import ipdb
 import ray
 import json
 import atexit
+from utils.profiling import profiler, profile
+from utils.episode_log import EpisodeLogWriter
 
 # @ray.remote
 class ArenaMP(object):
-    def __init__(self, max_number_steps, arena_id, environment_fn, agent_fn, record_dir='out', debug=False, run_predefined_actions=False):
+    def __init__(self, max_number_steps, arena_id, environment_fn, agent_fn, record_dir='out', debug=False, run_predefined_actions=False, profile_dir=None):
         # run_predefined_actions is a parameter that you can use predefined_actions.json to strictly set the agents' actions instead of using algorithm to calculate the action.
+        # profile_dir: if set, the phases of each step are timed and written to profile_dir, one file per episode, see utils/profiling.py
         self.agents = []
         self.env_fn = environment_fn
         self.agent_fn = agent_fn
@@ -32,6 +35,10 @@ class ArenaMP(object):
         self.max_episode_length = self.env.max_episode_length
         self.max_number_steps = max_number_steps
         self.run_predefined_actions = run_predefined_actions
+        self.profile_dir = profile_dir
+        if self.profile_dir is not None:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            profiler.enabled = True
         atexit.register(self.close)
 
     def close(self):
@@ -84,34 +91,37 @@ class ArenaMP(object):
         op_subgoal = {0: None, 1: None}
         # pdb.set_trace()
         for it, agent in enumerate(self.agents):
-            if self.task_goal is None:
-                goal_spec = self.env.get_goal(self.env.task_goal[it], self.env.agent_goals[it])
+            profiler.agent = it
+            with profile('get_action'):
+                if self.task_goal is None:
+                    goal_spec = self.env.get_goal(self.env.task_goal[it], self.env.agent_goals[it])
 
-            else:
-                goal_spec = self.env.get_goal(self.task_goal[it], self.env.agent_goals[it])
+                else:
+                    goal_spec = self.env.get_goal(self.task_goal[it], self.env.agent_goals[it])
             
-            if agent.agent_type in ['MCTS', 'Random', 'MCTS_vision']:
-                opponent_subgoal = None
-                if agent.recursive:
-                    opponent_subgoal = self.agents[1 - it].last_subgoal
+                if agent.agent_type in ['MCTS', 'Random', 'MCTS_vision']:
+                    opponent_subgoal = None
+                    if agent.recursive:
+                        opponent_subgoal = self.agents[1 - it].last_subgoal
                 
-                dict_actions[it], dict_info[it] = agent.get_action(obs[it], goal_spec, opponent_subgoal)
+                    dict_actions[it], dict_info[it] = agent.get_action(obs[it], goal_spec, opponent_subgoal)
                 
-            elif 'RL' in agent.agent_type:
-                if 'MCTS' in agent.agent_type or 'Random' in agent.agent_type:
-                    if true_graph:
-                        full_graph = self.env.get_graph()
-                    else:
-                        full_graph = None
-                    dict_actions[it], dict_info[it] = agent.get_action(obs[it], goal_spec,
-                                                                       action_space_ids=action_space[it], full_graph=full_graph)
+                elif 'RL' in agent.agent_type:
+                    if 'MCTS' in agent.agent_type or 'Random' in agent.agent_type:
+                        if true_graph:
+                            full_graph = self.env.get_graph()
+                        else:
+                            full_graph = None
+                        dict_actions[it], dict_info[it] = agent.get_action(obs[it], goal_spec,
+                                                                           action_space_ids=action_space[it], full_graph=full_graph)
 
-                else:
-                    # RL_RL agent
-                    dict_actions[it], dict_info[it] = agent.get_action(obs[it], self.task_goal, action_space_ids=action_space[it])
+                    else:
+                        # RL_RL agent
+                        dict_actions[it], dict_info[it] = agent.get_action(obs[it], self.task_goal, action_space_ids=action_space[it])
 
-            elif 'LLM' in agent.agent_type:
-                dict_actions[it], dict_info[it] = agent.get_action(obs[it], goal_spec)
+                elif 'LLM' in agent.agent_type:
+                    dict_actions[it], dict_info[it] = agent.get_action(obs[it], goal_spec)
+        profiler.agent = -1
 
         return dict_actions, dict_info
 
@@ -364,8 +374,11 @@ class ArenaMP(object):
         if self.env.steps == 0:
             pass
             #self.env.changed_graph = True
-        obs = self.env.get_observations()
-        action_space = self.env.get_action_space()
+        profiler.step = self.env.steps
+        with profile('get_observations'):
+            obs = self.env.get_observations()
+        with profile('action_space'):
+            action_space = self.env.get_action_space()
         dict_actions, dict_info = self.get_actions(obs, action_space, true_graph=true_graph)
         for i in range(len(dict_info)):
             if len(dict_info) > 1 and 'subgoals' in dict_info[i]:
@@ -374,16 +387,26 @@ class ArenaMP(object):
                 if i == 0 and 'subgoals' in dict_info[i + 1].keys() and dict_info[i]['subgoals'] == dict_info[i + 1]['subgoals']:
                     self.cnt_duplicate_subgoal += 1
         try:
-            step_info = self.env.step(dict_actions)
+            with profile('env_step'):
+                step_info = self.env.step(dict_actions)
         except Exception as e:
             print("Exception occurs when performing action: ", dict_actions)
             raise Exception
         return step_info, dict_actions, dict_info
 
-    def run(self, random_goal=False, pred_goal=None, cnt_subgoal_info = False):
+    def save_profile(self):
+        prefix = os.path.join(self.profile_dir, 'profile_{}_{}'.format(self.env.task_id, self.env.task_name))
+        trial = 0
+        while os.path.exists('{}_{}.npz'.format(prefix, trial)):
+            trial += 1
+        profiler.save('{}_{}.npz'.format(prefix, trial))
+
+    def run(self, random_goal=False, pred_goal=None, cnt_subgoal_info = False, log_path=None):
         """
         self.task_goal: goal inference
         self.env.task_goal: ground-truth goal
+        log_path: if set, the per-step data is streamed to this file (see utils/episode_log.py),
+                  and saved_info only keeps the actions, plans, subgoals and LLM outputs, with log_path pointing to the rest
         """
         self.task_goal = copy.deepcopy(self.env.task_goal)
         if random_goal:
@@ -412,39 +435,57 @@ class ArenaMP(object):
                       'graph': {0: [], 1: []},
                       'progress': [],
                     }
+        log = None
+        if log_path is not None:
+            log = EpisodeLogWriter(log_path, chunk_steps=1 if self.debug else 10)
+            log.write_header({key: saved_info[key] for key in ['task_id', 'env_id', 'task_name', 'gt_goals', 'goals', 'init_unity_graph']})
+            saved_info['log_path'] = log_path
         success = False
-        while True:
-            (obs, reward, done, infos, messages), actions, agent_info = self.step()
-            success = infos['finished']
-            # if infos['failed_exec']:
-            #     raise ValueError(infos)
-            if 'satisfied_goals' in infos:
-                saved_info['goals_finished'].append(infos['satisfied_goals'])
-            for agent_id, action in actions.items():
-                saved_info['action'][agent_id].append(action)
+        profiler.reset()
+        try:
+            while True:
+                (obs, reward, done, infos, messages), actions, agent_info = self.step()
+                success = infos['finished']
+                if log is not None:
+                    log.write_step(len(saved_info['action'][0]), actions, agent_info, infos.get('satisfied_goals'), infos.get('progress'))
+                # if infos['failed_exec']:
+                #     raise ValueError(infos)
+                if 'satisfied_goals' in infos:
+                    saved_info['goals_finished'].append(infos['satisfied_goals'])
+                for agent_id, action in actions.items():
+                    saved_info['action'][agent_id].append(action)
             
-            if 'progress' in infos:
-                saved_info['progress'].append(infos['progress'])
-            for agent_id, info in agent_info.items():
-                if 'belief_graph' in info:
-                    saved_info['belief_graph'][agent_id].append(info['belief_graph'])
-                if 'belief' in info:
-                    saved_info['belief'][agent_id].append(info['belief'])
-                if 'plan' in info:
-                    saved_info['plan'][agent_id].append(info['plan'])
-                if 'subgoals' in info:
-                    saved_info['subgoals'][agent_id].append(info['subgoals'])
-                if 'obs' in info:
-                    saved_info['obs'][agent_id].append(copy.deepcopy(info['obs']))
-                if 'LLM' in info:
-                    saved_info['LLM'][agent_id].append(info['LLM'])
-                if 'graph' in info:
-                    saved_info['graph'][agent_id].append(copy.deepcopy(info['graph']))
-                if self.debug:
-                    pickle.dump(saved_info, open(os.path.join(self.record_dir, 'log.pik'), 'wb'))
-            if done:
-                break
-        saved_info['finished'] = success
+                if 'progress' in infos:
+                    saved_info['progress'].append(infos['progress'])
+                for agent_id, info in agent_info.items():
+                    if 'belief_graph' in info and log is None:
+                        saved_info['belief_graph'][agent_id].append(info['belief_graph'])
+                    if 'belief' in info and log is None:
+                        saved_info['belief'][agent_id].append(info['belief'])
+                    if 'plan' in info:
+                        saved_info['plan'][agent_id].append(info['plan'])
+                    if 'subgoals' in info:
+                        saved_info['subgoals'][agent_id].append(info['subgoals'])
+                    if 'obs' in info and log is None:
+                        saved_info['obs'][agent_id].append(copy.deepcopy(info['obs']))
+                    if 'LLM' in info:
+                        saved_info['LLM'][agent_id].append(info['LLM'])
+                    if 'graph' in info and log is None:
+                        saved_info['graph'][agent_id].append(copy.deepcopy(info['graph']))
+                    if self.debug:
+                        # with a log, the steps are already on disk and log.pik only points to them
+                        pickle.dump(saved_info, open(os.path.join(self.record_dir, 'log.pik'), 'wb'))
+                if done:
+                    break
+            saved_info['finished'] = success
+            if log is not None:
+                log.write_end({'finished': success, 'cnt_duplicate_subgoal': self.cnt_duplicate_subgoal, 'cnt_nouse_subgoal': self.cnt_nouse_subgoal})
+        finally:
+            # the buffered steps are kept when a step raises
+            if log is not None:
+                log.close()
+        if self.profile_dir is not None:
+            self.save_profile()
         if cnt_subgoal_info:
             saved_info['cnt_duplicate_subgoal'] = self.cnt_duplicate_subgoal
             saved_info['cnt_nouse_subgoal'] = self.cnt_nouse_subgoal
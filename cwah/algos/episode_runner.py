@@ -0,0 +1,241 @@
+"""
+Shared episode loop of the testing_agents scripts.
+Every (try, episode) pair is a job. A job is skipped if its logs_agent_{task_id}_{task_name}_{try}.pik already exists, so a killed run can be resumed.
+With num_workers > 1 the main process hands out the jobs to idle worker processes, each with its own ArenaMP, built by arena_fn(worker_id).
+The worker id is used as the arena id, which is the port_id of its UnityEnvironment, so the workers talk to distinct Unity instances.
+A job that raises restarts the Unity instance of its worker (ArenaMP.reset_env) and is tried again, a worker process that dies is replaced
+and its job is tried again, up to max_retries times for both.
+Only the main process writes results.pik, after every finished job, through a temporary file and os.replace.
+"""
+
+import os
+import json
+import time
+import pickle
+import traceback
+import multiprocessing as mp
+import queue as queue_lib
+
+import numpy as np
+
+from utils.episode_summary import read_summary, write_summary
+
+
+def log_file_name(record_dir, task, iter_id):
+    return os.path.join(record_dir, 'logs_agent_{}_{}_{}.pik'.format(task['task_id'], task['task_name'], iter_id))
+
+def atomic_dump(obj, path, as_json=False):
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    if as_json:
+        with open(tmp_path, 'w+') as f:
+            f.write(json.dumps(obj, indent=4))
+    else:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(obj, f)
+    os.replace(tmp_path, path)
+
+def read_result(path):
+    r'''
+    The result of a finished job from the summary of its log file, (finished, steps, [cnt_duplicate_subgoal, cnt_nouse_subgoal] or None)
+    '''
+    summary = read_summary(path)
+    return summary['finished'], summary['max_steps'], summary['cnt_subgoal']
+
+
+class EpisodeRunner:
+    def __init__(self, args, env_task_set, arena_fn, cnt_subgoal_info=False, max_retries=1):
+        # arena_fn(worker_id) -> ArenaMP, called in the process of the worker
+        self.args = args
+        self.env_task_set = env_task_set
+        self.arena_fn = arena_fn
+        self.cnt_subgoal_info = cnt_subgoal_info
+        self.max_retries = max_retries
+        self.num_workers = max(1, getattr(args, 'num_workers', 1))
+        self.record_dir = args.record_dir
+        self.results_path = os.path.join(self.record_dir, 'results.pik')
+        self.arena = None
+
+    def run_job(self, arena, job):
+        r'''
+        Run one episode, write its log file and return (finished, steps, cnt_subgoal)
+        '''
+        iter_id, episode_id = job
+        log_name = log_file_name(self.record_dir, self.env_task_set[episode_id], iter_id)
+        print('episode:', episode_id, 'try:', iter_id, 'port:', arena.get_port())
+        for it_agent, agent in enumerate(arena.agents):
+            agent.seed = it_agent + iter_id * 2
+
+        arena.reset(episode_id)
+        success, steps, saved_info = arena.run(cnt_subgoal_info=self.cnt_subgoal_info, log_path=os.path.splitext(log_name)[0] + '.steps')
+        print('-------------------------------------')
+        print('episode:', episode_id, 'success' if success else 'failure')
+        print('steps:', steps)
+        print('-------------------------------------')
+        # the log file marks the job as done, so it is only visible once it is complete
+        atomic_dump(saved_info, log_name, as_json=len(saved_info['obs']) == 0)
+        # the counters of the episode, for the resume of the run and utils/statistics.py
+        write_summary(log_name, saved_info)
+        cnt_subgoal = [saved_info['cnt_duplicate_subgoal'], saved_info['cnt_nouse_subgoal']] if self.cnt_subgoal_info else None
+        return 1 if success else 0, steps, cnt_subgoal
+
+    def try_job(self, arena, job):
+        r'''
+        run_job, restarting the Unity instance after a failure, None if all the tries failed
+        '''
+        for trial in range(self.max_retries + 1):
+            try:
+                return self.run_job(arena, job)
+            except Exception:
+                traceback.print_exc()
+                if self.num_workers == 1 and self.args.debug:
+                    raise
+                print('job {} failed (trial {}), restarting the environment on port {}'.format(job, trial, arena.get_port()))
+                arena.reset_env()
+        return None
+
+    def worker(self, worker_id, jobs, job_queue, results):
+        arena = self.arena_fn(worker_id)
+        # ready for a job
+        results.put((worker_id, None, None))
+        while True:
+            index = job_queue.get()
+            if index is None:
+                break
+            results.put((worker_id, index, self.try_job(arena, jobs[index])))
+        arena.close()
+
+    def pending_jobs(self, test_episodes, num_tries):
+        done, jobs = {}, []
+        for iter_id in range(num_tries):
+            for episode_id in test_episodes:
+                log_name = log_file_name(self.record_dir, self.env_task_set[episode_id], iter_id)
+                if os.path.isfile(log_name):
+                    done[(iter_id, episode_id)] = read_result(log_name)
+                else:
+                    jobs.append((iter_id, episode_id))
+        return done, jobs
+
+    def save_results(self, done):
+        r'''
+        Merge the results of the finished jobs into results.pik, the lists of an episode are ordered by try
+        '''
+        if os.path.isfile(self.results_path):
+            with open(self.results_path, 'rb') as f:
+                test_results = pickle.load(f)
+        else:
+            test_results = {}
+        episodes = {}
+        for (iter_id, episode_id), result in sorted(done.items()):
+            if result is None:
+                continue
+            finished, steps, cnt_subgoal = result
+            entry = episodes.setdefault(episode_id, {'S': [], 'L': []})
+            entry['S'].append(finished)
+            entry['L'].append(steps)
+            if self.cnt_subgoal_info and cnt_subgoal is not None:
+                entry.setdefault('cnt_subgoal', []).append(cnt_subgoal)
+        test_results.update(episodes)
+        atomic_dump(test_results, self.results_path)
+        return test_results
+
+    def run_serial(self, jobs, done):
+        if self.arena is None:
+            self.arena = self.arena_fn(0)
+        for job in jobs:
+            done[job] = self.try_job(self.arena, job)
+            self.save_results(done)
+
+    def run_parallel(self, jobs, done):
+        ctx = mp.get_context('fork')
+        result_queue = ctx.Queue()
+        workers, job_queues = {}, {}
+        # the job given to each worker, None when the worker is idle or not ready yet, kept here so that it is not lost if the worker dies
+        assigned, ready = {}, {}
+        # times a worker was started since it was last ready, a worker whose Unity instance can not start is given up after max_retries
+        starts = {}
+        def start_worker(worker_id):
+            job_queues[worker_id] = ctx.Queue()
+            workers[worker_id] = ctx.Process(target=self.worker, args=(worker_id, jobs, job_queues[worker_id], result_queue))
+            workers[worker_id].start()
+            assigned[worker_id] = None
+            ready[worker_id] = False
+            starts[worker_id] = starts.get(worker_id, 0) + 1
+        for worker_id in range(min(self.num_workers, len(jobs))):
+            start_worker(worker_id)
+        pending = list(range(len(jobs)))
+        remaining = set(pending)
+        retries = {}
+        def retry(index):
+            retries[index] = retries.get(index, 0) + 1
+            if retries[index] <= self.max_retries:
+                pending.append(index)
+            else:
+                done[jobs[index]] = None
+                remaining.discard(index)
+        while len(remaining) > 0:
+            # hand out the jobs to the idle workers
+            for worker_id in workers:
+                if ready[worker_id] and assigned[worker_id] is None and len(pending) > 0:
+                    assigned[worker_id] = pending.pop(0)
+                    job_queues[worker_id].put(assigned[worker_id])
+            try:
+                worker_id, index, result = result_queue.get(timeout=10)
+            except queue_lib.Empty:
+                for worker_id, process in list(workers.items()):
+                    if process.is_alive():
+                        continue
+                    # the worker died (e.g. a crash of Unity that killed the process), its job is tried again and a new worker is started
+                    print('worker {} died with exit code {}'.format(worker_id, process.exitcode))
+                    if assigned[worker_id] is not None:
+                        retry(assigned[worker_id])
+                    if starts[worker_id] > self.max_retries:
+                        print('worker {} failed to start {} times, giving it up'.format(worker_id, starts[worker_id]))
+                        del workers[worker_id]
+                    else:
+                        start_worker(worker_id)
+                if len(workers) == 0:
+                    print('no worker left, {} jobs not run'.format(len(remaining)))
+                    for index in remaining:
+                        done[jobs[index]] = None
+                    break
+                continue
+            if worker_id not in workers:
+                continue
+            ready[worker_id] = True
+            starts[worker_id] = 0
+            if index is None or assigned[worker_id] != index:
+                continue
+            assigned[worker_id] = None
+            done[jobs[index]] = result
+            remaining.discard(index)
+            self.save_results(done)
+        for worker_id in workers:
+            job_queues[worker_id].put(None)
+        for process in workers.values():
+            process.join()
+
+    def run(self, test_episodes, num_tries):
+        r'''
+        Run all the tries of test_episodes that have no log file yet, return the merged results
+        '''
+        done, jobs = self.pending_jobs(test_episodes, num_tries)
+        print('{} jobs done, {} to run with {} workers'.format(len(done), len(jobs), self.num_workers))
+        start = time.time()
+        if self.num_workers == 1 or len(jobs) <= 1:
+            self.run_serial(jobs, done)
+        else:
+            self.run_parallel(jobs, done)
+        test_results = self.save_results(done)
+
+        for iter_id in range(num_tries):
+            results = [(episode_id, done.get((iter_id, episode_id))) for episode_id in test_episodes]
+            steps_list = [result[1] for _, result in results if result is not None and result[0]]
+            failed_tasks = [episode_id for episode_id, result in results if result is None or not result[0]]
+            print('try:', iter_id)
+            print('average steps (finishing the tasks):', np.array(steps_list).mean() if len(steps_list) > 0 else None)
+            print('failed_tasks:', failed_tasks)
+        errors = [job for job, result in done.items() if result is None]
+        if len(errors) > 0:
+            print('jobs that failed after {} retries, run again to resume: {}'.format(self.max_retries, errors))
+        print('time: {:.1f}s'.format(time.time() - start))
+        return test_results
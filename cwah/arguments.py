@@ -145,6 +145,9 @@ def get_args():
     parser.add_argument("--config", default = None, type = str, help="config file")
     parser.add_argument("--save_image", action='store_true', help="save image")
     parser.add_argument("--debugging", action='store_true', help="debug mode")
+    parser.add_argument("--profile", action='store_true', help="time the phases of each step, written to <record_dir>/profile, see utils/profiling.py")
+    parser.add_argument("--num_workers", default=1, type=int, help="number of arenas run in parallel, each on its own port (port_id = worker id)")
+    parser.add_argument("--python-env", action='store_true', default=False, help="run symbolic episodes in the graph simulator (PythonEnvironment) instead of Unity")
 
     args = parser.parse_args()
     return args
@@ -11,7 +11,7 @@ sys.path.append(f'{curr_dir}/../../virtualhome/simulation/')
 
 from evolving_graph.utils import load_graph_dict, graph_dict_helper
 from evolving_graph.execution import ScriptExecutor, ExecutionInfo
-from evolving_graph.scripts import read_script_from_string
+from evolving_graph.scripts import read_script_from_string, Action
 
 from evolving_graph.environment import EnvironmentGraph, EnvironmentState
 
@@ -100,6 +100,9 @@ class VhGraphEnv():
         self.observable_object_ids_n = [None for i in range(self.n_chars)]
         self.pomdp = False
         self.executor_n = [ScriptExecutor(EnvironmentGraph(self.state), self.name_equivalence, i) for i in range(self.n_chars)]
+        self.property_ids = {} # property -> ids of the nodes of the scene with it
+        self.feasible_cache = {} # (char_index, action, object ids, local state) -> result of check_one_step
+        self.max_feasible_cache = 200000
     
 
         
@@ -239,6 +242,7 @@ class VhGraphEnv():
             if node["category"] == "Rooms":
                 self.rooms.append(node)
         self.rooms_ids = [n["id"] for n in self.rooms]
+        self.index_properties(state)
         self.state = state
         self.vh_state = self.get_vh_state(state)
 
@@ -288,10 +292,12 @@ class VhGraphEnv():
             if node["category"] == "Rooms":
                 self.rooms.append(node)
         self.rooms_ids = [n["id"] for n in self.rooms]
+        self.index_properties(state)
         self.state = state
         self.vh_state = self.get_vh_state(state)
 
         ############ Reward ############
+        self.prev_progress_n = [0 for i in range(self.n_chars)]
         observable_state_n = [self._mask_state(state, i) if self.pomdp else state for i in range(self.n_chars)]
         self.observable_state_n = observable_state_n
         self.observable_object_ids_n = [[node['id'] for node in obs_state['nodes']] for obs_state in observable_state_n]
@@ -357,25 +363,63 @@ class VhGraphEnv():
 
         return valid
     
+    def index_properties(self, state):
+        r'''
+        Index the nodes of a new scene by property, and drop the feasibility checks of the previous one
+        '''
+        self.property_ids = {}
+        for node in state['nodes']:
+            if node['class_name'] == 'character':
+                continue
+            for prop in node['properties']:
+                self.property_ids.setdefault(prop, set()).add(node['id'])
+        self.feasible_cache = {}
+
+    def local_state(self, state, ids):
+        r'''
+        What check_one_step can look at for these nodes: their states, their edges, and the states of the nodes they are inside
+        '''
+        id2node = {node['id']: node for node in state['nodes']}
+        ids = set(ids)
+        edges = {x: [] for x in ids}
+        containers = {x: [] for x in ids}
+        for edge in state['edges']:
+            if edge['from_id'] in ids:
+                edges[edge['from_id']].append((edge['relation_type'], edge['to_id'], 0))
+                if edge['relation_type'] == 'INSIDE':
+                    containers[edge['from_id']].append(edge['to_id'])
+            if edge['to_id'] in ids:
+                edges[edge['to_id']].append((edge['relation_type'], edge['from_id'], 1))
+        local = {}
+        for x in ids:
+            container_states = tuple(sorted((y, tuple(sorted(id2node[y]['states']))) for y in containers[x] if y in id2node))
+            local[x] = (tuple(sorted(id2node[x]['states'])) if x in id2node else None, tuple(sorted(edges[x])), container_states)
+        return local
+
     def get_action_space(self, vh_state=None, char_index=0, action=None, obj1=None, obj2=None, structured_actions=False):
         # TODO: this could probably just go into virtualhome
+        # The candidates of each parameter come from the property index, and the result of check_one_step is cached on the local state
+        # of the character and the objects, so it is recomputed only when one of them changed.
 
         if vh_state is None:
             vh_state = self.vh_state
+            state = self.state
             nodes = self.observable_state_n[char_index]['nodes']
         else:
-            nodes = self._mask_state(vh_state.to_dict(), char_index)['nodes']
+            state = vh_state.to_dict()
+            nodes = self._mask_state(state, char_index)['nodes']
         node_ids = [x['id'] for x in nodes]
+        visible = set(node_ids)
+        id_order = {x: i for i, x in enumerate(node_ids)}
+        id2node = {x['id']: x for x in nodes}
 
-        action_executors = self.executor_n[char_index]._action_executors
-        
-        if obj1 is not None and obj1['id'] not in node_ids: return []
-    
+        if obj1 is not None and obj1['id'] not in visible: return []
 
         action_list = []
         action_candidates = self.actions if action is None else [action]
         action_list_sep = []
-        
+        character_id = self.character_n[char_index]['id']
+        local = None
 
         for action in action_candidates:
             curr_action = Action[action.upper()]
@@ -383,51 +427,50 @@ class VhGraphEnv():
             objects = [[] for _ in range(num_params)]
             for param in range(num_params):
                 properties_params = curr_action.value[2][param]
-                if param == 0:
-                    node_candidates = nodes if obj1 not in nodes else [obj1]
-                elif param == 1:
-                    node_candidates = nodes if obj2 not in nodes else [obj2]
+                if param == 0 and obj1 is not None:
+                    candidate_ids = [obj1['id']]
+                elif param == 1 and obj2 is not None and obj2['id'] in visible:
+                    candidate_ids = [obj2['id']]
                 else:
-                    node_candidates = nodes
-                # if param == 0:
-                #     node_candidates = nodes if obj1 is None else [obj1]
-                # elif param == 1:
-                #     node_candidates = nodes if obj2 is None else [obj2]
-                # else:
-                #     node_candidates = nodes
-                
+                    candidate_ids = node_ids
+                if len(properties_params) > 0:
+                    allowed = set()
+                    for prop in properties_params:
+                        allowed |= self.property_ids.get(prop, set())
+                    candidate_ids = sorted(allowed.intersection(candidate_ids), key=lambda x: id_order[x])
                 # remove character from candidates
-                node_candidates = [x for x in node_candidates if x['class_name'] != 'character']
+                objects[param] = [id2node[x] for x in candidate_ids if id2node[x]['class_name'] != 'character']
 
-                # if obj1 is not None and obj1['id'] == 2038:
-                #     print('node candidates:', [node['id'] for node in node_candidates])
-
-                for node in node_candidates:
-                    if (len(properties_params) == 0 or 
-                        len(set(node['properties']).intersection(properties_params)) > 0):
-                            objects[param].append(node)
-    
             if any([len(x) == 0 for x in objects]):
                 continue
             prod = list(itertools.product(*objects))
             for obj_candidates in prod:
                 obj_cand_list = list(obj_candidates)
                 string_instr = self.obtain_formatted_action(action, obj_cand_list)
-                action_list_tuple = [action] + obj_cand_list 
+                action_list_tuple = [action] + obj_cand_list
                 if action in ['Walk', 'Find', 'Run']:
                     succeed = True
                 else:
-                    script = read_script_from_string(string_instr)
-                    # This fails, it is modifyng the graph
-                    succeed = self.executor_n[char_index].check_one_step(script, vh_state)
-                    self.executor_n[char_index].info = ExecutionInfo()
+                    if local is None:
+                        local = self.local_state(state, [character_id] + [x['id'] for x in nodes])
+                    ids = tuple(x['id'] for x in obj_cand_list)
+                    key = (char_index, action, ids, local[character_id]) + tuple(local[x] for x in ids)
+                    succeed = self.feasible_cache.get(key)
+                    if succeed is None:
+                        script = read_script_from_string(string_instr)
+                        # This fails, it is modifyng the graph
+                        succeed = self.executor_n[char_index].check_one_step(script, vh_state)
+                        self.executor_n[char_index].info = ExecutionInfo()
+                        if len(self.feasible_cache) >= self.max_feasible_cache:
+                            self.feasible_cache = {}
+                        self.feasible_cache[key] = succeed
                 if succeed:
                     action_list.append(string_instr.lower())
                     action_list_sep.append(action_list_tuple)
 
         if structured_actions:
             return action_list_sep
-        else: 
+        else:
             return action_list
 
     def obtain_formatted_action(self, action, obj_cand_list, debug=False):
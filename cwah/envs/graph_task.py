@@ -0,0 +1,229 @@
+"""
+Task logic shared by UnityEnvironment and PythonEnvironment: goals, reward, subgoal checks and queries on the scene graph.
+It only needs the graph of the scene, so both the renderer and the graph simulator give the agents the same goals and the same success checks.
+The class using it sets full_graph, goal_spec, goal_class, id_to_name and rnd, and defines get_graph.
+"""
+
+from utils import utils_environment as utils
+
+
+class GraphTaskMixin:
+    def reward(self):
+        reward = 0.
+        done = True
+        satisfied, unsatisfied = utils.check_progress(self.get_graph(), self.goal_spec[0])
+        for key, value in satisfied.items():
+            preds_needed, mandatory, reward_per_pred = self.goal_spec[0][key]
+            # How many predicates achieved
+            value_pred = min(len(value), preds_needed)
+            reward += value_pred * reward_per_pred
+
+            if mandatory and unsatisfied[key] > 0:
+                done = False
+
+        self.prev_reward = reward
+        return reward, done, {'satisfied_goals': satisfied}
+
+    def check_subgoal(self, subgoal):
+        # Check if the subgoal is satisfied
+        # If the subgoal is satisfied, return True
+        # If the subgoal is not satisfied, return False
+        if subgoal is None: return False
+        if type(subgoal) == list:
+            if len(subgoal) == 0: return False
+            else: subgoal = subgoal[0]
+        id_to_grab = int(subgoal.split('_')[1])
+        class_to_grab = self.id_to_name[id_to_grab]
+        satisfied, unsatisfied = utils.check_progress(self.get_graph(), self.goal_spec[0])
+        for x in satisfied.keys():
+            for t in satisfied[x]:
+                if t is None: continue
+                if str(id_to_grab) in t:
+                    print(subgoal, 'is satisfied')
+                    return True
+        for x in unsatisfied.keys():
+            if class_to_grab in x and unsatisfied[x] == 0:
+                print(subgoal, 'is satisfied')
+                return True
+        return False
+
+    def get_goal(self, task_spec, agent_goal):
+        if agent_goal == 'full':
+            pred = [x for x, y in task_spec.items() if y > 0 and x.split('_')[0] in ['on', 'inside']]
+            # object_grab = [pr.split('_')[1] for pr in pred]
+            # predicates_grab = {'holds_{}_1'.format(obj_gr): [1, False, 2] for obj_gr in object_grab}
+            res_dict = {goal_k: [goal_c, True, 2] for goal_k, goal_c in task_spec.items()}
+            # res_dict.update(predicates_grab)
+            return res_dict
+        elif agent_goal == 'grab':
+            candidates = [x.split('_')[1] for x, y in task_spec.items() if
+                          y > 0 and x.split('_')[0] in ['on', 'inside']]
+            object_grab = self.rnd.choice(candidates)
+            # print('GOAL', candidates, object_grab)
+            return {'holds_' + object_grab + '_' + '1': [1, True, 10],
+                    'close_' + object_grab + '_' + '1': [1, False, 0.1]}
+        elif agent_goal == 'put':
+            pred = self.rnd.choice([x for x, y in task_spec.items() if y > 0 and x.split('_')[0] in ['on', 'inside']])
+            object_grab = pred.split('_')[1]
+            return {
+                pred: [1, True, 60],
+                'holds_' + object_grab + '_' + '1': [1, False, 2],
+                'close_' + object_grab + '_' + '1': [1, False, 0.05]
+
+            }
+        elif agent_goal == 'LLM':  # todo: Hongxin added
+            '''
+            Hongxin changed task_goal from "on_cupcake_268" to "on_cupcake_<coffeetable> (268)"
+            '''
+            goal_class = {}
+            for predicate in self.goal_class.keys():
+                rel, obj1, obj2 = predicate.split('_')
+                goal_class[f"{rel}_{obj1}"] = obj2
+            new_task_goal = {}
+            for predicate, count in task_spec.items():
+                if count == 0:
+                    continue
+                rel, obj1, obj2 = predicate.split('_')
+                obj2_name = goal_class[f"{rel}_{obj1}"]
+                new_predicate = predicate.replace(obj2, f"<{obj2_name}> ({obj2})")
+                new_task_goal[new_predicate] = count
+            # print(new_task_goal)
+            res_dict = {goal_k: [goal_c, True, 2] for goal_k, goal_c in new_task_goal.items()}
+            # res_dict.update(predicates_grab)
+            return res_dict
+        else:
+            raise NotImplementedError
+
+    @property
+    def all_relative_name(self) -> list:
+        return self.all_containers_name + self.all_goal_objects_name + ['character']
+
+    @property
+    def all_relative_id(self) -> list:
+        return [node['id'] for node in self.full_graph['nodes'] if node['class_name'] in self.all_relative_name]
+
+    @property
+    def all_detection_id(self) -> list:
+        return [node['id'] for node in self.full_graph['nodes'] if node['class_name'] in self.detection_all_object]
+
+    @property
+    def all_containers_name(self) -> list:
+        r'''
+         get all containers in the scene, exclude rooms and containers with no objects inside.
+        '''
+        '''
+        id2node = {node['id']: node for node in self.full_graph['nodes']}
+        room_name = [node['class_name'] for node in self.full_graph['nodes'] if node['category'] == 'Rooms']
+        all_container = list(set([id2node[link['to_id']]['class_name'] for link in self.full_graph['edges'] if
+                                  link['relation_type'] == 'INSIDE']))
+        all_container = [x for x in all_container if x not in room_name]
+        '''
+        container_classes = [
+            'bathroomcabinet',
+            'kitchencabinet',
+            'cabinet',
+            'fridge',
+            'stove',
+            # 'coffeepot',
+            'dishwasher',
+            'microwave']
+        return container_classes
+
+    @property
+    def all_goal_objects_name(self) -> list:
+        r'''
+         get all objects that related to goal.
+        ZHX: update to adapt to new goal_spec of LLM
+        '''
+        goal_objects = []
+        id2node = {node['id']: node for node in self.full_graph['nodes']}
+        for predicate in self.goal_spec[0]:
+            elements = predicate.split('_')
+            for x in elements[1:]:
+                if x.isdigit():
+                    goal_objects += [id2node[int(x)]['class_name']]
+                elif '(' in x:
+                    y = x.split('(')[1].split(')')[0]
+                    if y.isdigit():
+                        goal_objects += [id2node[int(y)]['class_name']]
+                else:
+                    goal_objects += [x]
+        goal_obj = list(set(goal_objects))
+        # if ('character' not in goal_obj):
+        # 	goal_obj += ['character']
+        return goal_obj
+
+    @property
+    def room_info(self):
+        r'''
+         get room info in the scene.
+        '''
+        return [node for node in self.full_graph['nodes'] if node['id'] in self.all_room_and_character_id]
+
+    @property
+    def all_room_name(self) -> list:
+        r'''
+         get all rooms in the scene.
+        '''
+        # room_name = [node['class_name'] for node in self.full_graph['nodes'] if node['category'] == 'Rooms']
+        room_name = ["livingroom", "kitchen", "bedroom", "bathroom"]
+        return room_name
+
+
+    @property
+    def all_room_and_character_id(self) -> list:
+        r'''
+        get all room_and_character_ids in the scene.
+        '''
+        return [node['id'] for node in self.full_graph['nodes'] if
+                          node['class_name'] == 'character' or node['category'] in ['Rooms']]
+
+    @property
+    def all_room_id(self) -> list:
+        r'''
+        get all room_and_character_ids in the scene.
+        '''
+        return [node['id'] for node in self.full_graph['nodes'] if node['category'] in ['Rooms']]
+
+    def filter_graph(self, obs):
+        relative_id = self.all_relative_id + self.all_room_id
+        new_graph = {
+            "edges": [edge for edge in obs['edges'] if
+                    edge['from_id'] in relative_id and edge['to_id'] in relative_id],
+            "nodes": [node for node in obs['nodes'] if node['id'] in relative_id]
+        }
+        return new_graph
+
+    def id_to_inside_room(self, id):
+        r'''
+            Given an id, return the id of the room it is inside.
+            api for agent to get the id of the room it is inside.
+
+            return: id and name of the room, if the main object is not relative object, return (-1, None).
+        '''
+        while (id not in self.all_room_id):
+            id = [edge['to_id'] for edge in self.full_graph['edges'] if edge['from_id'] == id and edge['relation_type'] == 'INSIDE'][0]
+        return id
+
+    def get_properties(self, id):
+        r'''
+            return 'properties' of the object with id.
+        '''
+        return [node['properties'] for node in self.full_graph['nodes'] if node['id'] == id][0]
+
+    def get_category(self, id):
+        r'''
+            return 'category' of the object with id.
+        '''
+        return [node['category'] for node in self.full_graph['nodes'] if node['id'] == id][0]
+
+    def get_states(self, id):
+        r'''
+            return 'states' of the object with id.
+        '''
+        return [node['states'] for node in self.full_graph['nodes'] if node['id'] == id][0]
+
+    def get_class_name(self, id):
+        r'''
+            return 'states' of the object with id.
+        '''
@@ -1,4 +1,6 @@
 from .base_environment import BaseEnvironment
+from .graph_task import GraphTaskMixin
+from .graph_env import VhGraphEnv
 from utils import utils_environment as utils
 
 import sys
@@ -8,17 +10,20 @@ import os
 
 curr_dir = os.path.dirname(os.path.realpath(__file__))
 
-sys.path.append(f'{curr_dir}/../../virtualhome/')
-sys.path.append(f'{curr_dir}/../../vh_mdp/')
+sys.path.append(f'{curr_dir}/../../virtualhome/simulation/')
 
-from vh_graph.envs import belief, vh_env
+from evolving_graph import utils as utils_env
 import pdb
 import random
 import numpy as np
 import copy
 
-class PythonEnvironment(BaseEnvironment):
-
+class PythonEnvironment(GraphTaskMixin, BaseEnvironment):
+    r'''
+    Drop-in replacement of UnityEnvironment for symbolic observations, the actions are executed by the graph simulator (VhGraphEnv) instead of Unity.
+    Observations, messages, goals, reward and the info of step follow UnityEnvironment, see testing_agents/check_python_env.py for a comparison on recorded Unity episodes.
+    Differences: a walk (or walktowards) reaches its target in one step, and there is no agent position, the location is the center of the agent's room.
+    '''
 
     def __init__(self,
                  num_agents=2,
@@ -27,17 +32,22 @@ class PythonEnvironment(BaseEnvironment):
                  observation_types=None,
                  agent_goals=None,
                  output_folder=None,
-                 seed=123):
+                 port_id=0,
+                 base_port=0,
+                 seed=123,
+                 **unity_kwargs):
+        # unity_kwargs (use_editor, executable_args, save_image...) are accepted so that the env_fn of a test script can switch envs, and ignored
 
         self.seed = seed
-        random.seed(seed)
+        self.rnd = random.Random(seed)
         np.random.seed(seed)
 
         self.steps = 0
         self.env_id = None
         self.max_ids = {}
+        self.port_number = base_port + port_id
 
-        self.pythnon_graph = None
+        self.python_graph = None
         self.env_task_set = env_task_set
 
         self.num_agents = num_agents
@@ -49,7 +59,7 @@ class PythonEnvironment(BaseEnvironment):
         if observation_types is not None:
             self.observation_types = observation_types
         else:
-            self.observation_types = ['mcts' for _ in range(num_agents)]
+            self.observation_types = ['partial' for _ in range(num_agents)]
 
         if agent_goals is not None:
             self.agent_goals = agent_goals
@@ -63,44 +73,14 @@ class PythonEnvironment(BaseEnvironment):
         self.changed_graph = False
         self.rooms = None
         self.id2node = None
-        self.offset_cameras = None
-
-
-        self.env = vh_env.VhGraphEnv(n_chars=self.num_agents)
-
-    def reward(self):
-        reward = 0.
-        done = True
-        # TODO: we should specify goal per agent maybe
-        satisfied, unsatisfied = utils.check_progress(self.get_graph(), self.goal_spec[0])
-        for key, value in satisfied.items():
-            preds_needed, mandatory, reward_per_pred = self.goal_spec[0][key]
-            # How many predicates achieved
-            value_pred = min(len(value), preds_needed)
-            reward += value_pred * reward_per_pred
-
-            if mandatory and unsatisfied[key] > 0:
-                done = False
+        self.full_graph = None
+        self.message_said = [None for _ in range(num_agents)]
 
-        # print(satisfied)
-        return reward, done, {}
 
-    def step(self, action_dict):
-        new_action_dict = {char_id: action for char_id, action in action_dict.items() if action is not None}
-        self.env.step(new_action_dict)
-        self.changed_graph = True
+        self.env = VhGraphEnv(n_chars=self.num_agents)
 
-
-        reward, done, info = self.reward()
-        obs = self.get_observations()
-        self.steps += 1
-        info['finished'] = done
-        info['graph'] = self.get_graph()
-        if self.steps == self.max_episode_length:
-            done = True
-        # if done:
-        #     pdb.set_trace()
-        return obs, reward, done, info
+    def close(self):
+        pass
 
     def python_graph_reset(self, graph):
         new_graph = utils.inside_not_trans(graph)
@@ -108,57 +88,33 @@ class PythonEnvironment(BaseEnvironment):
         self.env.reset(new_graph, self.task_goal)
         self.env.to_pomdp()
 
-    def get_goal(self, task_spec, agent_goal):
-
-        if agent_goal == 'full':
-            task_spec_new = {goal_name: [cnt_val, True, 0] for goal_name, cnt_val in task_spec.items()}
-            return task_spec_new
-        elif agent_goal == 'grab':
-            candidates = [x.split('_')[1] for x,y in task_spec.items() if y > 0 and x.split('_')[0] in ['on', 'inside']]
-            object_grab = random.choice(candidates)
-            # print('GOAL', candidates, object_grab)
-            return {'holds_'+object_grab+'_'+'1': [1, True, 10], 'close_'+object_grab+'_'+'1': [1, False, 0.1]}
-        elif agent_goal == 'put':
-            pred = random.choice([x for x, y in task_spec.items() if y > 0 and x.split('_')[0] in ['on', 'inside']])
-            object_grab = pred.split('_')[1]
-            return {
-                pred: [1, True, 60],
-                'holds_' + object_grab + '_' + '1': [1, False, 2],
-                'close_' + object_grab + '_' + '1': [1, False, 0.05]
-
-            }
-        else:
-            raise NotImplementedError
-
     def reset(self, environment_graph=None, task_id=None):
 
         # Make sure that characters are out of graph, and ids are ok
         if task_id is None:
-            env_task = random.choice(self.env_task_set)
-        else:
-            env_task = self.env_task_set[task_id]
+            task_id = self.rnd.choice(list(range(len(self.env_task_set))))
+        env_task = self.env_task_set[task_id]
 
         self.task_id = env_task['task_id']
-        self.init_graph = env_task['init_graph']
+        self.init_graph = copy.deepcopy(env_task['init_graph'])
         self.init_rooms = env_task['init_rooms']
         self.task_goal = env_task['task_goal']
-
+        print('task_goal: ', self.task_goal)
+        self.goal_class = env_task['goal_class']
         self.task_name = env_task['task_name']
         self.env_id = env_task['env_id']
-
-
+        print("Resetting... Envid: {}. Taskid: {}. Index: {}".format(self.env_id, self.task_id, task_id))
 
         # TODO: in the future we may want different goals
         self.goal_spec = {agent_id: self.get_goal(self.task_goal[agent_id], self.agent_goals[agent_id])
                           for agent_id in range(self.num_agents)}
-        print("Goal: ", self.goal_spec)
 
         if environment_graph is None:
             environment_graph = env_task['init_graph']
 
 
         if self.init_rooms[0] not in ['kitchen', 'bedroom', 'livingroom', 'bathroom']:
-            rooms = random.sample(['kitchen', 'bedroom', 'livingroom', 'bathroom'], 2)
+            rooms = self.rnd.sample(['kitchen', 'bedroom', 'livingroom', 'bathroom'], 2)
         else:
             rooms = list(self.init_rooms)
 
@@ -172,27 +128,107 @@ class PythonEnvironment(BaseEnvironment):
                 'properties': []
             }
             room_name = rooms[i]
-            #try:
             room_id = [node['id'] for node in environment_graph['nodes'] if node['class_name'] == room_name][0]
-            #except:
-            #    pdb.set_trace()
             environment_graph['nodes'].append(new_char_node)
             environment_graph['edges'].append({'from_id': i+1, 'relation_type': 'INSIDE', 'to_id': room_id})
+        self.init_unity_graph = copy.deepcopy(environment_graph)
 
 
         self.python_graph_reset(environment_graph)
-        self.rooms = [(node['class_name'], node['id']) for node in environment_graph['nodes'] if node['category'] == 'Rooms']
-        self.id2node = {node['id']: node for node in environment_graph['nodes']}
+        self.changed_graph = True
+        graph = self.get_graph()
+        self.rooms = [(node['class_name'], node['id']) for node in graph['nodes'] if node['category'] == 'Rooms']
+        self.id2node = {node['id']: node for node in graph['nodes']}
+
+        self.full_graph = self.get_full_graph()
+        self.id_to_name = {node['id']: node['class_name'] for node in self.full_graph['nodes']}
+        self.message_said = [None for _ in range(self.num_agents)]
 
         obs = self.get_observations()
         self.steps = 0
+        self.prev_reward = 0.
         return obs
 
     def get_graph(self):
-        out_graph = self.env.state
-        return out_graph
+        return self.env.state
+
+    def get_full_graph(self):
+        r'''
+        The graph with a non transitive inside relation, as UnityEnvironment.full_graph, without changing the state of the simulator
+        '''
+        graph = self.get_graph()
+        return utils.inside_not_trans({'nodes': graph['nodes'], 'edges': list(graph['edges'])})
+
+    def split_actions(self, action_dict, K=500):
+        r'''
+        The scripts to execute per agent, and what each agent says
+        '''
+        saying = [None for _ in range(self.num_agents)]
+        actions = {}
+        for agent_id, action in action_dict.items():
+            if action is None:
+                continue
+            if utils.get_action_name(action) == 'send_message':
+                saying[agent_id] = utils.get_message_name(action)
+                if len(saying[agent_id]) > K:
+                    saying[agent_id] = saying[agent_id][:K]
+                    print("Message too long, truncating to {}".format(K))
+                continue
+            # the graph simulator has no partial walk
+            actions[agent_id] = action.replace('[walktowards]', '[walk]')
+        # the same agent selection as UnityEnvironment when both agents interact with one object
+        script_list = utils.convert_action(actions)
+        scripts = {}
+        if len(script_list[0]) > 0:
+            for script in script_list[0].split('|'):
+                char, script = script.split(' ', 1)
+                scripts[int(char[len('<char'):-1])] = script
+        return scripts, saying
+
+    def step(self, action_dict):
+        scripts, saying = self.split_actions(action_dict)
+        print(f"Step {self.steps}, Executing script: {scripts}")
+        failed_execution = False
+        valid_scripts = {}
+        for agent_id, script in scripts.items():
+            # Unity fails on an object the agent can not see, the simulator asserts
+            if self.env._is_action_valid(script, agent_id):
+                valid_scripts[agent_id] = script
+            else:
+                print("NO SUCCESS")
+                print('invalid action', script)
+                failed_execution = True
+        if len(valid_scripts) > 0:
+            _, _, info_n = self.env.step(valid_scripts)
+            for info_agent in info_n['n']:
+                if not info_agent['succeed']:
+                    print("NO SUCCESS")
+                    print(info_agent['error_message'], valid_scripts)
+                    failed_execution = True
+            self.changed_graph = True
+
+        # Obtain reward
+        reward, done, info = self.reward()
+
+        graph = self.get_graph()
+        self.steps += 1
+        obs = None
+
+        info['finished'] = done
+        info['graph'] = graph
+        info['failed_exec'] = failed_execution
+        satisfied, unsatisfied = utils.check_progress(graph, self.goal_spec[0])
+        info['progress'] = {'satisfied': satisfied, 'unsatisfied': unsatisfied}
+
+        if self.steps == self.max_episode_length:
+            done = True
+        messages = saying
+        self.message_said = saying
+        return obs, reward, done, info, messages
 
     def get_observations(self):
+        self.full_graph = self.get_full_graph()
+        self.dict_graph = {node['id']: node for node in self.full_graph['nodes']}
         dict_observations = {}
         for agent_id in range(self.num_agents):
             obs_type = self.observation_types[agent_id]
@@ -202,21 +238,39 @@ class PythonEnvironment(BaseEnvironment):
     def get_action_space(self):
         dict_action_space = {}
         for agent_id in range(self.num_agents):
-            if self.observation_types[agent_id] not in ['mcts', 'full']:
+            if self.observation_types[agent_id] not in ['partial', 'full', 'mcts']:
                 raise NotImplementedError
             else:
-                obs_type = 'mcts'
+                # Even if you can see all the graph, you can only interact with visible objects
+                obs_type = 'partial'
             visible_graph = self.get_observation(agent_id, obs_type)
             dict_action_space[agent_id] = [node['id'] for node in visible_graph['nodes']]
         return dict_action_space
 
+    def get_agent_location(self, agent_id):
+        r'''
+        The position of the agent if the graph has it, else the center of its room
+        '''
+        node = self.dict_graph[agent_id + 1]
+        if 'obj_transform' in node:
+            return node['obj_transform']['position']
+        room = self.dict_graph[self.id_to_inside_room(agent_id + 1)]
+        if 'bounding_box' in room:
+            return list(room['bounding_box']['center'])
+        return [0., 0., 0.]
+
     def get_observation(self, agent_id, obs_type, info={}):
 
-        if obs_type == 'mcts':
+        if obs_type == 'partial':
+            # agent 0 has id (0 + 1)
+            obs = utils_env.get_visible_nodes(self.full_graph, agent_id=(agent_id + 1))
+            return {'messages': self.message_said, **obs, 'location': self.get_agent_location(agent_id)}
+
+        elif obs_type == 'mcts':
             return self.env.get_observations(char_index=agent_id)
 
         elif obs_type == 'full':
-            return self.get_graph()
+            return self.full_graph
 
         else:
             pdb.set_trace()
@@ -12,10 +12,12 @@ import numpy as np
 import copy
 import ipdb
 from functools import lru_cache, partial
+from utils.profiling import profile
+from .graph_task import GraphTaskMixin
 import re
 
 
-class UnityEnvironment(BaseUnityEnvironment):
+class UnityEnvironment(GraphTaskMixin, BaseUnityEnvironment):
 
 	def __init__(self,
 				 num_agents=2,
@@ -86,22 +88,6 @@ class UnityEnvironment(BaseUnityEnvironment):
 		self.location = None
 		self.keep_move_steps = None
  
-	def reward(self):
-		reward = 0.
-		done = True
-		satisfied, unsatisfied = utils.check_progress(self.get_graph(), self.goal_spec[0])
-		for key, value in satisfied.items():
-			preds_needed, mandatory, reward_per_pred = self.goal_spec[0][key]
-			# How many predicates achieved
-			value_pred = min(len(value), preds_needed)
-			reward += value_pred * reward_per_pred
-
-			if mandatory and unsatisfied[key] > 0:
-				done = False
-
-		self.prev_reward = reward
-		return reward, done, {'satisfied_goals': satisfied}
-
 	def get_action_space(self):
 		dict_action_space = {}
 		for agent_id in range(self.num_agents):
@@ -118,176 +104,6 @@ class UnityEnvironment(BaseUnityEnvironment):
 			dict_action_space[agent_id] = [node['id'] for node in visible_graph['nodes']]
 		return dict_action_space
 
-	def check_subgoal(self, subgoal):
-		# Check if the subgoal is satisfied
-		# If the subgoal is satisfied, return True
-		# If the subgoal is not satisfied, return False
-		if subgoal is None: return False
-		if type(subgoal) == list: 
-			if len(subgoal) == 0: return False
-			else: subgoal = subgoal[0]
-		id_to_grab = int(subgoal.split('_')[1])
-		class_to_grab = self.id_to_name[id_to_grab]
-		satisfied, unsatisfied = utils.check_progress(self.get_graph(), self.goal_spec[0])
-		for x in satisfied.keys():
-			for t in satisfied[x]:
-				if t is None: continue
-				if str(id_to_grab) in t:
-					print(subgoal, 'is satisfied')
-					return True
-		for x in unsatisfied.keys():
-			if class_to_grab in x and unsatisfied[x] == 0:
-				print(subgoal, 'is satisfied')
-				return True
-		return False
-	
-	def get_goal(self, task_spec, agent_goal):
-		if agent_goal == 'full':
-			pred = [x for x, y in task_spec.items() if y > 0 and x.split('_')[0] in ['on', 'inside']]
-			# object_grab = [pr.split('_')[1] for pr in pred]
-			# predicates_grab = {'holds_{}_1'.format(obj_gr): [1, False, 2] for obj_gr in object_grab}
-			res_dict = {goal_k: [goal_c, True, 2] for goal_k, goal_c in task_spec.items()}
-			# res_dict.update(predicates_grab)
-			return res_dict
-		elif agent_goal == 'grab':
-			candidates = [x.split('_')[1] for x, y in task_spec.items() if
-						  y > 0 and x.split('_')[0] in ['on', 'inside']]
-			object_grab = self.rnd.choice(candidates)
-			# print('GOAL', candidates, object_grab)
-			return {'holds_' + object_grab + '_' + '1': [1, True, 10],
-					'close_' + object_grab + '_' + '1': [1, False, 0.1]}
-		elif agent_goal == 'put':
-			pred = self.rnd.choice([x for x, y in task_spec.items() if y > 0 and x.split('_')[0] in ['on', 'inside']])
-			object_grab = pred.split('_')[1]
-			return {
-				pred: [1, True, 60],
-				'holds_' + object_grab + '_' + '1': [1, False, 2],
-				'close_' + object_grab + '_' + '1': [1, False, 0.05]
-
-			}
-		elif agent_goal == 'LLM':  # todo: Hongxin added
-			'''
-			Hongxin changed task_goal from "on_cupcake_268" to "on_cupcake_<coffeetable> (268)"
-			'''
-			goal_class = {}
-			for predicate in self.goal_class.keys():
-				rel, obj1, obj2 = predicate.split('_')
-				goal_class[f"{rel}_{obj1}"] = obj2
-			new_task_goal = {}
-			for predicate, count in task_spec.items():
-				if count == 0:
-					continue
-				rel, obj1, obj2 = predicate.split('_')
-				obj2_name = goal_class[f"{rel}_{obj1}"]
-				new_predicate = predicate.replace(obj2, f"<{obj2_name}> ({obj2})")
-				new_task_goal[new_predicate] = count
-			# print(new_task_goal)
-			res_dict = {goal_k: [goal_c, True, 2] for goal_k, goal_c in new_task_goal.items()}
-			# res_dict.update(predicates_grab)
-			return res_dict
-		else:
-			raise NotImplementedError
-
-	@property
-	def all_relative_name(self) -> list:
-		return self.all_containers_name + self.all_goal_objects_name + ['character']
-
-	@property
-	def all_relative_id(self) -> list:
-		return [node['id'] for node in self.full_graph['nodes'] if node['class_name'] in self.all_relative_name]
-
-	@property
-	def all_detection_id(self) -> list:
-		return [node['id'] for node in self.full_graph['nodes'] if node['class_name'] in self.detection_all_object]
-
-	@property
-	def all_containers_name(self) -> list:
-		r'''
-		 get all containers in the scene, exclude rooms and containers with no objects inside.
-		'''
-		'''
-		id2node = {node['id']: node for node in self.full_graph['nodes']}
-		room_name = [node['class_name'] for node in self.full_graph['nodes'] if node['category'] == 'Rooms']
-		all_container = list(set([id2node[link['to_id']]['class_name'] for link in self.full_graph['edges'] if
-								  link['relation_type'] == 'INSIDE']))
-		all_container = [x for x in all_container if x not in room_name]
-		'''
-		container_classes = [
-			'bathroomcabinet',
-			'kitchencabinet',
-			'cabinet',
-			'fridge',
-			'stove',
-			# 'coffeepot',
-			'dishwasher',
-			'microwave']
-		return container_classes
-
-	@property
-	def all_goal_objects_name(self) -> list:
-		r'''
-		 get all objects that related to goal.
-		ZHX: update to adapt to new goal_spec of LLM
-		'''
-		goal_objects = []
-		id2node = {node['id']: node for node in self.full_graph['nodes']}
-		for predicate in self.goal_spec[0]:
-			elements = predicate.split('_')
-			for x in elements[1:]:
-				if x.isdigit():
-					goal_objects += [id2node[int(x)]['class_name']]
-				elif '(' in x:
-					y = x.split('(')[1].split(')')[0]
-					if y.isdigit():
-						goal_objects += [id2node[int(y)]['class_name']]
-				else:
-					goal_objects += [x]
-		goal_obj = list(set(goal_objects))
-		# if ('character' not in goal_obj):
-		# 	goal_obj += ['character']
-		return goal_obj
-
-	@property
-	def room_info(self):
-		r'''
-		 get room info in the scene.
-		'''
-		return [node for node in self.full_graph['nodes'] if node['id'] in self.all_room_and_character_id]
-
-	@property
-	def all_room_name(self) -> list:
-		r'''
-		 get all rooms in the scene.
-		'''
-		# room_name = [node['class_name'] for node in self.full_graph['nodes'] if node['category'] == 'Rooms']
-		room_name = ["livingroom", "kitchen", "bedroom", "bathroom"]
-		return room_name
-
-
-	@property
-	def all_room_and_character_id(self) -> list:
-		r'''
-		get all room_and_character_ids in the scene.
-		'''
-		return [node['id'] for node in self.full_graph['nodes'] if
-						  node['class_name'] == 'character' or node['category'] in ['Rooms']]
-	
-	@property
-	def all_room_id(self) -> list:
-		r'''
-		get all room_and_character_ids in the scene.
-		'''
-		return [node['id'] for node in self.full_graph['nodes'] if node['category'] in ['Rooms']]
-
-	def filter_graph(self, obs):
-		relative_id = self.all_relative_id + self.all_room_id
-		new_graph = {
-			"edges": [edge for edge in obs['edges'] if
-					edge['from_id'] in relative_id and edge['to_id'] in relative_id],
-			"nodes": [node for node in obs['nodes'] if node['id'] in relative_id]
-		}
-		return new_graph
-
 	def reset(self, environment_graph=None, task_id=None):
 		# Make sure that characters are out of graph, and ids are ok
 		# ipdb.set_trace()
@@ -449,11 +265,12 @@ class UnityEnvironment(BaseUnityEnvironment):
 			else:
 				individual_script = script_list[0].split('|')
 				for i in range(len(individual_script)):
-					success, message = self.comm.render_script([individual_script[i]],
-														   recording=False,
-														   image_synthesis=[],
-														   # gen_vid=False,
-														   skip_animation=True)
+					with profile('render_script', agent=-1):
+						success, message = self.comm.render_script([individual_script[i]],
+															   recording=False,
+															   image_synthesis=[],
+															   # gen_vid=False,
+															   skip_animation=True)
 					if not success:
 						print("NO SUCCESS")
 						print(message, script_list)
@@ -506,30 +323,8 @@ class UnityEnvironment(BaseUnityEnvironment):
 													 image_height=image_height)
 				s, inst_colors = self.comm.instance_colors()
 
-				def find_id_by_colors(rgb):
-					if rgb in self.cache_id_map.keys():
-						return self.cache_id_map[rgb]
-					ans_id = []
-					for k, v in inst_colors.items():
-						if abs(rgb[0] - v[2] * 255) + abs(rgb[1] - v[1] * 255) + abs(rgb[2] - v[0] * 255) < 10:
-							if int(k) in self.all_relative_id:
-								ans_id.append(int(k))
-					ans = ans_id[0] if len(ans_id) == 1 else -1
-					assert(len(ans_id) <= 1)
-					self.cache_id_map[rgb] = ans
-					return ans
-
-				ids = np.empty((len(camera_ids), image_height, image_width))
-				inside_info = {}
-				for t in range(len(camera_ids)):
-					for i in range(image_height):
-						for j in range(image_width):
-							ids[t, i, j] = find_id_by_colors(tuple(seg_inst[t][i, j]))
-							if (ids[t, i, j] != -1):
-								if (ids[t, i, j] not in inside_info.keys()):
-									inside_info[ids[t, i, j]] = [edge['to_id'] for edge in self.full_graph['edges'] if edge['from_id'] == ids[t, i, j] and edge['relation_type'] == 'INSIDE'][0]
-								if (self.dict_graph[inside_info[ids[t, i, j]]]['category'] not in ['Rooms'] and 'CLOSED' in self.dict_graph[inside_info[ids[t, i, j]]]['states']): 
-									ids[t, i, j] = -1
+				ids = self.decode_seg_inst(seg_inst, inst_colors, set(self.all_relative_id), self.cache_id_map)
+				self.mask_closed_containers(ids)
 				self.id_map.append(ids)
 				colorids = np.stack(((ids % 10) * 10, ((ids // 10) % 10) * 10, ((ids // 100) % 10) * 10), axis=3)
 				if self.save_image:
@@ -542,35 +337,13 @@ class UnityEnvironment(BaseUnityEnvironment):
 			dict_observations[agent_id] = self.get_observation(agent_id, obs_type)
 			self.location[agent_id].append(dict_observations[agent_id]['location'])
 			if self.data_collection:
-				def find_data_by_colors(rgb):
-					if rgb in self.cache_data_map.keys():
-						return self.cache_data_map[rgb]
-					ans_id = []
-					for k, v in inst_colors.items():
-						if abs(rgb[0] - v[2] * 255) + abs(rgb[1] - v[1] * 255) + abs(rgb[2] - v[0] * 255) < 10:
-							if (int(k) in self.all_detection_id):
-								ans_id.append(int(k))
-					ans = ans_id[0] if len(ans_id) == 1 else -1
-					assert(len(ans_id) <= 1)
-					self.cache_data_map[rgb] = ans
-					return ans
-				inside_info = {}
-				ids_class = np.empty((len(camera_ids), image_height, image_width))
-				ids_instance = np.empty((len(camera_ids), image_height, image_width))
-				for t in range(len(camera_ids)):
-					for i in range(image_height):
-						for j in range(image_width):
-							ids_class[t, i, j] = find_data_by_colors(tuple(seg_inst[t][i, j]))
-							if ids_class[t, i, j] != -1:
-								if ids_class[t, i, j] not in inside_info.keys():
-									inside_info[ids_class[t, i, j]] = [edge['to_id'] for edge in self.full_graph['edges'] if edge['from_id'] == ids_class[t, i, j] and edge['relation_type'] == 'INSIDE'][0]
-								if self.dict_graph[inside_info[ids_class[t, i, j]]]['category'] not in ['Rooms'] and 'CLOSED' in self.dict_graph[inside_info[ids_class[t, i, j]]]['states']:
-									ids[t, i, j] = -1
-							if ids_class[t, i, j] != -1:
-								ids_instance[t, i, j] = ids_class[t, i, j]
-								ids_class[t, i, j] = self.detection_name_id_map[self.id_to_name[ids_class[t, i, j]]]
-							else:
-								ids_instance[t, i, j] = -1
+				# objects inside closed containers are kept in the collected data
+				ids_instance = self.decode_seg_inst(seg_inst, inst_colors, set(self.all_detection_id), self.cache_data_map)
+				detection_ids = np.unique(ids_instance)
+				detection_ids = detection_ids[detection_ids != -1]
+				ids_class = np.full(ids_instance.shape, -1.)
+				for detection_id in detection_ids:
+					ids_class[ids_instance == detection_id] = self.detection_name_id_map[self.id_to_name[int(detection_id)]]
 				color_id_instance = np.stack(((ids_instance % 10) * 10, ((ids_instance // 10) % 10) * 10, ((ids_instance // 100) % 10) * 10), axis=3)
 				if 'bgr' not in dict_observations[agent_id].keys():
 					s, dict_observations[agent_id]['bgr'] = self.comm.camera_image(camera_ids, mode='normal', image_width=image_width,
@@ -585,6 +358,46 @@ class UnityEnvironment(BaseUnityEnvironment):
 					cv2.imwrite(self.data_collection_dir + str(self.global_episode_id) + '_' + str(self.env_id) + '/' + str(self.steps) + '_' + str(agent_id) + '_rgb.png', dict_observations[agent_id]['bgr'][t])
 		return dict_observations
 
+	def decode_seg_inst(self, seg_inst, inst_colors, candidate_ids, cache):
+		r'''
+			Map each pixel of the instance segmentation images to the id of the object among candidate_ids with this instance color, -1 if there is none.
+			The colors are packed into integers, and only the distinct colors of the images are matched against inst_colors. The matches are cached in cache.
+		'''
+		seg_inst = np.asarray(seg_inst).astype(np.int64)
+		packed = (seg_inst[..., 0] << 16) | (seg_inst[..., 1] << 8) | seg_inst[..., 2]
+		colors, inverse = np.unique(packed.reshape(-1), return_inverse=True)
+		new_colors = np.array([c for c in colors.tolist() if c not in cache], dtype=np.int64)
+		if len(new_colors) > 0:
+			keys = [k for k in inst_colors.keys() if int(k) in candidate_ids]
+			# the image is in BGR order while the instance colors are RGB in [0, 1]
+			ref = np.array([[inst_colors[k][2], inst_colors[k][1], inst_colors[k][0]] for k in keys]).reshape(-1, 3) * 255
+			rgb = np.stack(((new_colors >> 16) & 255, (new_colors >> 8) & 255, new_colors & 255), axis=1)
+			matched = np.abs(rgb[:, None, :] - ref[None, :, :]).sum(axis=2) < 10
+			for c, match in zip(new_colors.tolist(), matched):
+				ans_id = np.nonzero(match)[0]
+				assert(len(ans_id) <= 1)
+				cache[c] = int(keys[ans_id[0]]) if len(ans_id) == 1 else -1
+		lut = np.array([cache[c] for c in colors.tolist()], dtype=np.float64)
+		return lut[inverse].reshape(packed.shape)
+
+	def mask_closed_containers(self, ids):
+		r'''
+			Set the ids of objects inside a closed container (not a room) to -1, in place.
+		'''
+		inside_info = {}
+		for edge in self.full_graph['edges']:
+			if edge['relation_type'] == 'INSIDE' and edge['from_id'] not in inside_info:
+				inside_info[edge['from_id']] = edge['to_id']
+		hidden = []
+		for obj_id in np.unique(ids).astype(int).tolist():
+			if obj_id == -1:
+				continue
+			container = self.dict_graph[inside_info[obj_id]]
+			if container['category'] not in ['Rooms'] and 'CLOSED' in container['states']:
+				hidden.append(obj_id)
+		ids[np.isin(ids, hidden)] = -1
+		return ids
+
 	def get_agent_location(self, agent_id):
 		graph = self.full_graph
 		agent_node = \
@@ -629,46 +442,15 @@ class UnityEnvironment(BaseUnityEnvironment):
 		else:
 			return -1, None
 		
-	def id_to_inside_room(self, id):
-		r'''
-			Given an id, return the id of the room it is inside.
-			api for agent to get the id of the room it is inside.
-
-			return: id and name of the room, if the main object is not relative object, return (-1, None).
-		'''
-		while (id not in self.all_room_id):
-			id = [edge['to_id'] for edge in self.full_graph['edges'] if edge['from_id'] == id and edge['relation_type'] == 'INSIDE'][0]
-		return id
-
-	def get_properties(self, id):
-		r'''
-			return 'properties' of the object with id.
-		'''
-		return [node['properties'] for node in self.full_graph['nodes'] if node['id'] == id][0]
-	
-	def get_category(self, id):
-		r'''
-			return 'category' of the object with id.
-		'''
-		return [node['category'] for node in self.full_graph['nodes'] if node['id'] == id][0]
-	
-	def get_states(self, id):
-		r'''
-			return 'states' of the object with id.
-		'''
-		return [node['states'] for node in self.full_graph['nodes'] if node['id'] == id][0]
-	
-	def get_class_name(self, id):
-		r'''
-			return 'states' of the object with id.
-		'''
-		return [node['class_name'] for node in self.full_graph['nodes'] if node['id'] == id][0]
-
 	def nodes_in_same_room(self, nodes, agent_id = 0):
 		same_room_node =  [node for node in nodes if self.id_to_inside_room(node['id']) == self.id_to_inside_room(agent_id)]
 		not_inside_node = []
+		inside_edges = {}
+		for edge in self.full_graph['edges']:
+			if edge['relation_type'] == 'INSIDE':
+				inside_edges.setdefault(edge['from_id'], []).append(edge['to_id'])
 		for node in same_room_node:								
-			inside_info = [edge['to_id'] for edge in self.full_graph['edges'] if edge['from_id'] == node['id'] and edge['relation_type'] == 'INSIDE']
+			inside_info = inside_edges.get(node['id'], [])
 			assert (len(inside_info) <= 1)
 			if len(inside_info) == 0:
 				not_inside_node.append(node)
@@ -690,14 +472,14 @@ class UnityEnvironment(BaseUnityEnvironment):
 
 	def remove_duplicate_graph(self, graph):
 		# remove duplicate nodes / edges
-		allnode = [node['id'] for node in graph['nodes']]
+		allnode = set([node['id'] for node in graph['nodes']])
 		simplify_edge = []
-		all_edge = []
+		all_edge = set()
 		for edge in graph['edges']:
 			if edge['from_id'] in allnode and (edge['to_id'] in allnode or self.id2node[edge['to_id']]['category'] == 'Rooms'):
 				if (edge['from_id'], edge['to_id'], edge['relation_type']) not in all_edge:
 					simplify_edge.append(edge)
-					all_edge.append((edge['from_id'], edge['to_id'], edge['relation_type']))
+					all_edge.add((edge['from_id'], edge['to_id'], edge['relation_type']))
 		return {
 			'nodes': graph['nodes'],
 			'edges': simplify_edge,
@@ -0,0 +1,97 @@
+"""
+Consistency and speed of PythonEnvironment against recorded Unity episodes.
+Each logs_agent_*.pik of a symbolic Unity run is replayed in PythonEnvironment with the recorded actions, and compared step by step:
+    goals    the satisfied goal predicates after each step (goals_finished of the log)
+    obs      the ids of the nodes an agent observed before each step, for agents that logged 'obs' (the MCTS agents)
+    finished whether the episode ended with the task done
+Replays use the rooms the agents started in (init_rooms of the task), walks reach their target in one step, so episodes with walks
+that Unity needed several steps for diverge in the observations of the following steps, the goal checks should not.
+
+    python testing_agents/check_python_env.py --dataset_path ./dataset/test_env_set_help.pik --record_dir ../test_results/symbolic_hp_10
+"""
+
+import sys
+import os
+curr_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(f'{curr_dir}/..')
+import glob
+import time
+import pickle
+import argparse
+
+import numpy as np
+
+from envs.python_environment import PythonEnvironment
+from utils.episode_log import load_episode
+
+
+def satisfied_predicates(satisfied):
+    return {key: sorted(x for x in value if x is not None) for key, value in satisfied.items()}
+
+def replay(env, episode_id, saved_info):
+    r'''
+    Replay the actions of a recorded episode, return the per-step comparison
+    '''
+    num_agents = env.num_agents
+    actions = saved_info['action']
+    num_steps = max(len(actions[agent_id]) for agent_id in range(num_agents))
+    obs = env.reset(task_id=episode_id)
+    result = {'steps': num_steps, 'goal_mismatch': [], 'obs_mismatch': [], 'failed_exec': 0, 'unknown_ids': 0, 'seconds': 0.}
+    start = time.perf_counter()
+    for step in range(num_steps):
+        for agent_id in range(num_agents):
+            recorded = saved_info['obs'][agent_id] if agent_id in saved_info['obs'] else []
+            if step < len(recorded) and recorded[step] is not None:
+                recorded_ids = set(node['id'] for node in recorded[step])
+                ids = set(node['id'] for node in obs[agent_id]['nodes'])
+                if recorded_ids != ids:
+                    result['obs_mismatch'].append((step, agent_id, len(recorded_ids - ids), len(ids - recorded_ids)))
+        action_dict = {agent_id: actions[agent_id][step] if step < len(actions[agent_id]) else None for agent_id in range(num_agents)}
+        for action in action_dict.values():
+            if action is not None and 'send_message' not in action and ')' in action:
+                object_id = int(action.split('(')[-1].split(')')[0])
+                result['unknown_ids'] += object_id not in env.id_to_name
+        t = time.perf_counter()
+        _, _, done, info, _ = env.step(action_dict)
+        obs = env.get_observations()
+        result['seconds'] += time.perf_counter() - t
+        result['failed_exec'] += info['failed_exec']
+        if step < len(saved_info['goals_finished']):
+            if satisfied_predicates(info['satisfied_goals']) != satisfied_predicates(saved_info['goals_finished'][step]):
+                result['goal_mismatch'].append(step)
+    result['finished'] = info['finished'] if num_steps > 0 else False
+    result['finished_match'] = bool(result['finished']) == bool(saved_info['finished'])
+    result['wall'] = time.perf_counter() - start
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay recorded Unity episodes in PythonEnvironment')
+    parser.add_argument('--dataset_path', default='./dataset/test_env_set_help.pik', type=str)
+    parser.add_argument('--record_dir', nargs='+', required=True, help='directories with logs_agent_*.pik of symbolic Unity runs')
+    parser.add_argument('--max_episodes', default=None, type=int)
+    args = parser.parse_args()
+
+    env_task_set = pickle.load(open(args.dataset_path, 'rb'))
+    task_index = {(task['task_id'], task['task_name']): i for i, task in enumerate(env_task_set)}
+    files = sorted(sum([glob.glob(os.path.join(x, 'logs_agent_*.pik')) for x in args.record_dir], []))[:args.max_episodes]
+
+    results = []
+    envs = {}
+    for file in files:
+        saved_info = load_episode(file)
+        num_agents = 2 if len(saved_info['action'][1]) > 0 else 1
+        if num_agents not in envs:
+            envs[num_agents] = PythonEnvironment(num_agents=num_agents, env_task_set=env_task_set, observation_types=['partial'] * num_agents)
+        result = replay(envs[num_agents], task_index[(saved_info['task_id'], saved_info['task_name'])], saved_info)
+        results.append(result)
+        print('{}: {} steps, goals diverge at {}, obs mismatches {}, failed actions {}, unknown ids {}, finished {} ({}), {:.1f} ms/step'.format(
+            os.path.basename(file), result['steps'], result['goal_mismatch'][:1] or None, len(result['obs_mismatch']), result['failed_exec'],
+            result['unknown_ids'], result['finished'], 'same' if result['finished_match'] else 'different', result['seconds'] / max(result['steps'], 1) * 1000))
+
+    if len(results) > 0:
+        steps = sum(x['steps'] for x in results)
+        print('{} episodes, {} steps'.format(len(results), steps))
+        print('same goal progress at every step: {:.1%} of the episodes'.format(np.mean([len(x['goal_mismatch']) == 0 for x in results])))
+        print('same outcome: {:.1%} of the episodes'.format(np.mean([x['finished_match'] for x in results])))
+        print('steps with the same observations: {:.1%}'.format(1 - sum(len(set(s for s, _, _, _ in x['obs_mismatch'])) for x in results) / max(steps, 1)))
+        print('python env: {:.2f} ms per step (step and observations), {:.1f}s in total'.format(sum(x['seconds'] for x in results) / max(steps, 1) * 1000, sum(x['wall'] for x in results)))
@@ -0,0 +1,324 @@
+"""
+Streaming episode log of ArenaMP.run, replacing the per-step deep copies kept in saved_info.
+The log is append-only, a sequence of chunks, each one is a little-endian header (length, first step, last step)
+followed by a zlib-compressed pickle of a list of pickled records:
+    ('header', info)         task_id, env_id, task_name, gt_goals, goals, init_unity_graph
+    ('step', step, data)     {'action': {agent_id: action}, 'goals_finished': ..., 'progress': ..., 'agent': {agent_id: {key: value}}}
+    ('end', info)            finished, cnt_duplicate_subgoal, cnt_nouse_subgoal
+Graphs ('graph', 'belief_graph', and the node list in 'obs') are stored as ('delta', delta) to the previous value of the same agent,
+and as ('full', value) every keyframe_interval values or when the value can not be rebuilt from a delta (unhashable edges, nodes with the same id).
+The edges of a delta keep their order: when it differs from the kept edges followed by the added ones, the delta has the new position of each edge.
+A crash loses at most the steps of the last chunk.
+
+EpisodeLog reads a log lazily: the small fields are loaded when it is opened, and the graphs of a step are rebuilt from the closest full value.
+load_episode loads a logs_agent_*.pik file, and attaches the log it points to as lazy lists.
+"""
+
+import os
+import pickle
+import struct
+import zlib
+
+LOG_KEYS = ['belief_graph', 'belief', 'plan', 'subgoals', 'obs', 'LLM', 'graph']
+DELTA_KEYS = ['belief_graph', 'obs', 'graph']
+LAZY_KEYS = ['belief_graph', 'belief', 'obs', 'graph']
+HEADER = struct.Struct('<Iii')
+
+def edge_key(edge):
+    return tuple(sorted(edge.items()))
+
+def is_graph(value):
+    if isinstance(value, dict):
+        return isinstance(value.get('nodes'), list) and isinstance(value.get('edges', []), list)
+    return isinstance(value, list) and all(isinstance(x, dict) and 'id' in x for x in value)
+
+def copy_value(value):
+    return pickle.loads(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+def nodes_delta(prev, nodes):
+    order = [x['id'] for x in nodes]
+    if len(set(order)) != len(order):
+        # nodes with the same id can not be rebuilt by id
+        return None
+    prev_by_id = {x['id']: x for x in prev}
+    return {'changed': [x for x in nodes if x['id'] not in prev_by_id or prev_by_id[x['id']] != x],
+            'order': order}
+
+def apply_nodes_delta(prev, delta):
+    by_id = {x['id']: x for x in prev}
+    by_id.update({x['id']: x for x in delta['changed']})
+    return [by_id[x] for x in delta['order']]
+
+def edges_delta(prev, edges):
+    prev_keys = set(edge_key(x) for x in prev)
+    keys = [edge_key(x) for x in edges]
+    key_set = set(keys)
+    delta = {'added': [x for x, key in zip(edges, keys) if key not in prev_keys], 'removed': list(prev_keys - key_set)}
+    # the edges rebuilt from prev are the kept ones in their former order then the added ones, when the order changed
+    # the delta also has the position of each edge in that list (equal keys are equal edges)
+    base = [edge_key(x) for x in prev if edge_key(x) in key_set] + [edge_key(x) for x in delta['added']]
+    if base != keys:
+        index = {}
+        for i, key in enumerate(base):
+            index.setdefault(key, i)
+        delta['order'] = [index[key] for key in keys]
+    return delta
+
+def apply_edges_delta(prev, delta):
+    removed = set(delta['removed'])
+    edges = [x for x in prev if edge_key(x) not in removed] + delta['added']
+    if 'order' in delta:
+        edges = [edges[i] for i in delta['order']]
+    return edges
+
+def graph_delta(prev, value):
+    r'''
+    The delta from prev to value, None if they are not graphs of the same kind
+    '''
+    if not is_graph(prev) or not is_graph(value) or type(prev) != type(value):
+        return None
+    nodes = nodes_delta(prev if isinstance(value, list) else prev['nodes'], value if isinstance(value, list) else value['nodes'])
+    if nodes is None:
+        return None
+    if isinstance(value, list):
+        return {'nodes': nodes}
+    delta = {'nodes': nodes,
+             'rest': {k: v for k, v in value.items() if k not in ['nodes', 'edges'] and (k not in prev or prev[k] != v)},
+             'dropped': [k for k in prev if k not in value]}
+    if 'edges' in value:
+        delta['edges'] = edges_delta(prev.get('edges', []), value['edges'])
+    return delta
+
+def apply_graph_delta(prev, delta):
+    if isinstance(prev, list):
+        return apply_nodes_delta(prev, delta['nodes'])
+    value = {k: v for k, v in prev.items() if k not in delta['dropped']}
+    value.update(delta['rest'])
+    value['nodes'] = apply_nodes_delta(prev['nodes'], delta['nodes'])
+    if 'edges' in delta:
+        value['edges'] = apply_edges_delta(prev.get('edges', []), delta['edges'])
+    return value
+
+class EpisodeLogWriter:
+    def __init__(self, path, keyframe_interval = 20, chunk_steps = 10):
+        self.f = open(path, 'wb')
+        self.keyframe_interval = keyframe_interval
+        self.chunk_steps = chunk_steps
+        self.records = []
+        self.steps = []
+        self.prev = {} # (agent_id, key) -> copy of the last value
+        self.since_full = {}
+
+    def write(self, record, step = -1):
+        # pickle now, so later changes of the agents' objects do not leak into the log
+        self.records.append(pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL))
+        if step >= 0:
+            self.steps.append(step)
+        if len(self.steps) >= self.chunk_steps:
+            self.flush()
+
+    def encode(self, agent_id, key, value):
+        prev = self.prev.get((agent_id, key))
+        if prev is not None and self.since_full[(agent_id, key)] < self.keyframe_interval:
+            try:
+                delta = graph_delta(prev, value)
+            except TypeError:
+                # unhashable edges, store the value
+                delta = None
+            if delta is not None:
+                # the deltas rebuild the value exactly, the previous value is updated with a copy of the delta only,
+                # so later changes of the agents' objects do not leak into it
+                self.prev[(agent_id, key)] = apply_graph_delta(prev, copy_value(delta))
+                self.since_full[(agent_id, key)] += 1
+                return ('delta', delta)
+        self.prev[(agent_id, key)] = copy_value(value)
+        self.since_full[(agent_id, key)] = 0
+        return ('full', value)
+
+    def write_header(self, info):
+        self.write(('header', info))
+
+    def write_step(self, step, actions, agent_info, goals_finished = None, progress = None):
+        data = {'action': dict(actions), 'agent': {}}
+        if goals_finished is not None:
+            data['goals_finished'] = goals_finished
+        if progress is not None:
+            data['progress'] = progress
+        for agent_id, info in agent_info.items():
+            data['agent'][agent_id] = {}
+            for key in LOG_KEYS:
+                if key not in info: continue
+                data['agent'][agent_id][key] = self.encode(agent_id, key, info[key]) if key in DELTA_KEYS else info[key]
+        self.write(('step', step, data), step)
+
+    def write_end(self, info):
+        self.write(('end', info))
+        self.flush()
+
+    def flush(self):
+        if len(self.records) == 0:
+            return
+        data = zlib.compress(pickle.dumps(self.records, protocol=pickle.HIGHEST_PROTOCOL))
+        first, last = (self.steps[0], self.steps[-1]) if len(self.steps) > 0 else (-1, -1)
+        self.f.write(HEADER.pack(len(data), first, last))
+        self.f.write(data)
+        self.f.flush()
+        self.records, self.steps = [], []
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+class LazySeries:
+    r'''
+    The values of one key of one agent, in the order of the steps that have it, rebuilt when indexed
+    '''
+    def __init__(self, log, agent_id, key):
+        self.log = log
+        self.agent_id = agent_id
+        self.key = key
+        self.steps = log.present.get((agent_id, key), [])
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return self.log.value(self.steps[index], self.agent_id, self.key)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+class EpisodeLog:
+    def __init__(self, path):
+        self.path = path
+        self.header, self.end = {}, {}
+        self.chunks = [] # (offset, length)
+        self.step_chunk = {} # step -> index of its chunk
+        self.present = {} # (agent_id, key) -> steps that have the key
+        self.full_steps = {} # (agent_id, key) -> steps where the value is stored in full
+        self.small = {'action': {}, 'goals_finished': [], 'progress': []}
+        self.cache = {} # chunk index -> decoded records of the last chunk read
+        self.last = {} # (agent_id, key) -> (step, value) last rebuilt, for sequential reads
+        self.scan()
+
+    def scan(self):
+        with open(self.path, 'rb') as f:
+            while True:
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    break
+                length, first, last = HEADER.unpack(header)
+                offset = f.tell()
+                data = f.read(length)
+                if len(data) < length:
+                    # a chunk cut by a crash
+                    break
+                self.chunks.append((offset, length))
+                for record in self.decode(data):
+                    self.index(record, len(self.chunks) - 1)
+
+    def decode(self, data):
+        return [pickle.loads(x) for x in pickle.loads(zlib.decompress(data))]
+
+    def index(self, record, chunk):
+        if record[0] == 'header':
+            self.header = record[1]
+        elif record[0] == 'end':
+            self.end = record[1]
+        else:
+            _, step, data = record
+            self.step_chunk[step] = chunk
+            for agent_id, action in data['action'].items():
+                self.small['action'].setdefault(agent_id, []).append(action)
+            for key in ['goals_finished', 'progress']:
+                if key in data:
+                    self.small[key].append(data[key])
+            for agent_id, info in data['agent'].items():
+                for key, value in info.items():
+                    self.present.setdefault((agent_id, key), []).append(step)
+                    if key in DELTA_KEYS and value[0] == 'full':
+                        self.full_steps.setdefault((agent_id, key), []).append(step)
+                    if key not in LAZY_KEYS:
+                        self.small.setdefault(key, {}).setdefault(agent_id, []).append(value)
+
+    def steps(self):
+        return sorted(self.step_chunk.keys())
+
+    def __len__(self):
+        return len(self.step_chunk)
+
+    def record(self, step):
+        chunk = self.step_chunk[step]
+        if chunk not in self.cache:
+            offset, length = self.chunks[chunk]
+            with open(self.path, 'rb') as f:
+                f.seek(offset)
+                records = self.decode(f.read(length))
+            self.cache = {chunk: {x[1]: x[2] for x in records if x[0] == 'step'}}
+        return self.cache[chunk][step]
+
+    def value(self, step, agent_id, key):
+        r'''
+        The value of key of agent_id at step, as it was given to the writer
+        '''
+        stored = self.record(step)['agent'][agent_id][key]
+        if key not in DELTA_KEYS:
+            return stored
+        if stored[0] == 'full':
+            value = stored[1]
+        else:
+            steps = self.present[(agent_id, key)]
+            last = self.last.get((agent_id, key))
+            full = max(x for x in self.full_steps[(agent_id, key)] if x <= step)
+            if last is not None and full <= last[0] < step:
+                start, value = last
+            else:
+                start, value = full, self.record(full)['agent'][agent_id][key][1]
+            for x in steps[steps.index(start) + 1: steps.index(step) + 1]:
+                value = apply_graph_delta(value, self.record(x)['agent'][agent_id][key][1])
+        self.last[(agent_id, key)] = (step, value)
+        return value
+
+    def step(self, step):
+        r'''
+        All the values of a step
+        '''
+        data = self.record(step)
+        return {**{k: v for k, v in data.items() if k != 'agent'},
+                'agent': {agent_id: {key: self.value(step, agent_id, key) for key in info} for agent_id, info in data['agent'].items()}}
+
+    def to_saved_info(self):
+        r'''
+        The saved_info dict of ArenaMP.run, with lazy lists for the per-step graphs, beliefs and observations
+        '''
+        saved_info = dict(self.header)
+        saved_info.update(self.end)
+        agent_ids = sorted(set([0, 1] + list(self.small['action'].keys())))
+        saved_info['action'] = {x: self.small['action'].get(x, []) for x in agent_ids}
+        saved_info['goals_finished'] = self.small['goals_finished']
+        saved_info['progress'] = self.small['progress']
+        for key in LOG_KEYS:
+            if key in LAZY_KEYS:
+                saved_info[key] = {x: LazySeries(self, x, key) for x in agent_ids}
+            else:
+                saved_info[key] = {x: self.small.get(key, {}).get(x, []) for x in agent_ids}
+        return saved_info
+
+def load_episode(path):
+    r'''
+    Load a logs_agent_*.pik (or log.pik) file, the per-step data of a streamed episode is read lazily from its log
+    '''
+    with open(path, 'rb') as f:
+        saved_info = pickle.load(f)
+    if 'log_path' not in saved_info:
+        return saved_info
+    log_path = os.path.join(os.path.dirname(path), os.path.basename(saved_info['log_path']))
+    if not os.path.exists(log_path):
+        log_path = saved_info['log_path']
+    lazy = EpisodeLog(log_path).to_saved_info()
+    for key in LAZY_KEYS:
+        saved_info[key] = lazy[key]
+    return saved_info
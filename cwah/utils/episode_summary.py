@@ -0,0 +1,175 @@
+"""
+Per-episode summaries of the logs_agent_*.pik files, so that results can be aggregated without unpickling the per-step graphs and beliefs.
+EpisodeRunner writes logs_agent_{task_id}_{task_name}_{try}.summary.json next to every log file it writes, with the counters that
+utils/statistics.py and the resume of a run need. SummaryIndex keeps the summaries of a record directory in summaries.pik, refreshed
+incrementally: only the log files that are new or changed since the last refresh are read, from their summary if they have one,
+otherwise from the log itself (and their summary is written then).
+"""
+
+import os
+import re
+import json
+import pickle
+
+try:
+    from .episode_log import load_episode
+except ImportError:
+    # imported by the scripts of utils (statistics.py), without the package
+    from episode_log import load_episode
+
+LOG_PATTERN = re.compile(r'logs_agent_(\d+)_(.*)_(\d+)\.pik$')
+STEP_KEYS = ['comm', 'S', 'B', 'E', 'None', 'others', 'navigation', 'interaction']
+SUMMARY_VERSION = 1
+
+def summary_path(log_name):
+    return os.path.splitext(log_name)[0] + '.summary.json'
+
+def count_actions(actions, agent_index):
+    r'''
+    The number of steps of each kind of action (STEP_KEYS) of each agent
+    '''
+    agent = {k: [0] * len(agent_index) for k in STEP_KEYS}
+    for index in agent_index:
+        for i in actions[index]:
+            if i is None:
+                agent['None'][index] += 1
+            else:
+                act = i[i.find('[') + 1 :i.find(']')]
+                if act == 'send_message':
+                    if "'S':" in i:
+                        agent['S'][index] += 1
+                    if "'B':" in i:
+                        agent['B'][index] += 1
+                    if "'E':" in i:
+                        agent['E'][index] += 1
+                    agent['comm'][index] += 1
+                elif act in ['walktowards', 'turnleft', 'TurnLeft']:
+                    agent['navigation'][index] += 1
+                elif act in ['open', 'close', 'grab', 'putin', 'putback']:
+                    agent['interaction'][index] += 1
+                else:
+                    print(f'unknown action {i}')
+                    agent['others'][index] += 1
+    return agent
+
+def summarize_episode(file_data):
+    r'''
+    The summary of the saved_info of an episode: everything but its per-step data
+    '''
+    actions = file_data['action']
+    two_agent = len(actions[1]) != 0
+    subgoals = file_data['subgoals']
+    min_subgoal_len = min(len(subgoals[0]), len(subgoals[1])) if two_agent else len(subgoals[0])
+    # subgoals both agents had at the same step, except the run of equal subgoals at the end
+    cnt_duplicate_subgoal = 0
+    if two_agent:
+        for i in range(min_subgoal_len):
+            if subgoals[0][i] == subgoals[1][i]:
+                cnt_duplicate_subgoal += 1
+        for i in reversed(range(min_subgoal_len)):
+            if i == 0 or subgoals[0][i] == subgoals[1][i] == subgoals[0][i-1] == subgoals[1][i-1]:
+                cnt_duplicate_subgoal -= 1
+            else:
+                break
+    # messages after which the other agent changed its subgoal
+    cnt_influence = 0
+    comm_num = 0
+    if two_agent:
+        for i in range(0, min_subgoal_len-1):
+            for sender, receiver in [(0, 1), (1, 0)]:
+                if actions[sender][i] is not None and actions[sender][i].startswith('[send_message]'):
+                    comm_num += 1
+                    if subgoals[receiver][i] != subgoals[receiver][i+1]:
+                        cnt_influence += 1
+    steps_remove_comm = max(len([i for i in actions[0] if ((not i) or (not i.startswith('[send_message]')))]),
+                            len([i for i in actions[1] if ((not i) or (not i.startswith('[send_message]')))]))
+    return {
+        'version': SUMMARY_VERSION,
+        'task_id': file_data.get('task_id'),
+        'task_name': file_data.get('task_name'),
+        'env_id': file_data['env_id'],
+        'finished': file_data['finished'],
+        'two_agent': two_agent,
+        'steps': len(actions[0]),
+        'max_steps': max(len(actions[0]), len(actions[1])),
+        'steps_remove_comm': steps_remove_comm,
+        'cnt_duplicate_subgoal': cnt_duplicate_subgoal,
+        'influence': cnt_influence / comm_num if comm_num != 0 else 0,
+        'step_data': count_actions(actions, [0, 1] if two_agent else [0]),
+        # as counted by the arena, only with cnt_subgoal_info
+        'cnt_subgoal': [file_data['cnt_duplicate_subgoal'], file_data['cnt_nouse_subgoal']] if 'cnt_duplicate_subgoal' in file_data else None,
+        'cnt_nouse_subgoal': file_data.get('cnt_nouse_subgoal'),
+    }
+
+def write_summary(log_name, file_data):
+    path = summary_path(log_name)
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(summarize_episode(file_data), f)
+    os.replace(tmp_path, path)
+
+def read_summary(log_name):
+    r'''
+    The summary of a log file, from its summary file if it is up to date, else from the log (and the summary file is written)
+    '''
+    path = summary_path(log_name)
+    if os.path.isfile(path) and os.path.getmtime(path) >= os.path.getmtime(log_name):
+        with open(path, 'r') as f:
+            summary = json.load(f)
+        if summary.get('version') == SUMMARY_VERSION:
+            return summary
+    file_data = load_episode(log_name)
+    try:
+        write_summary(log_name, file_data)
+    except OSError:
+        # a read-only record directory
+        pass
+    return summarize_episode(file_data)
+
+class SummaryIndex:
+    def __init__(self, record_dir, index_name = 'summaries.pik'):
+        self.record_dir = record_dir
+        self.index_path = os.path.join(record_dir, index_name)
+        # file name -> (mtime, size, summary)
+        self.entries = {}
+        if os.path.isfile(self.index_path):
+            try:
+                with open(self.index_path, 'rb') as f:
+                    index = pickle.load(f)
+                if index.get('version') == SUMMARY_VERSION:
+                    self.entries = index['entries']
+            except (OSError, EOFError, pickle.UnpicklingError):
+                print(f'Warning! Can not read {self.index_path}, building it again.')
+
+    def refresh(self):
+        r'''
+        Read the summaries of the new and changed log files, drop the removed ones
+        return: {(task_id, task_name, try): summary}
+        '''
+        entries = {}
+        changed = False
+        for filename in os.listdir(self.record_dir):
+            if LOG_PATTERN.match(filename) is None:
+                continue
+            file_path = os.path.join(self.record_dir, filename)
+            stat = os.stat(file_path)
+            entry = self.entries.get(filename)
+            if entry is None or entry[0] != stat.st_mtime or entry[1] != stat.st_size:
+                entry = (stat.st_mtime, stat.st_size, read_summary(file_path))
+                changed = True
+            entries[filename] = entry
+        changed = changed or len(entries) != len(self.entries)
+        self.entries = entries
+        if changed:
+            tmp_path = '{}.tmp{}'.format(self.index_path, os.getpid())
+            try:
+                with open(tmp_path, 'wb') as f:
+                    pickle.dump({'version': SUMMARY_VERSION, 'entries': entries}, f)
+                os.replace(tmp_path, self.index_path)
+            except OSError:
+                pass
+        summaries = {}
+        for filename, (_, _, summary) in entries.items():
+            task_id, task_name, seed = LOG_PATTERN.match(filename).groups()
+            summaries[(int(task_id), task_name, int(seed))] = summary
+        return summaries
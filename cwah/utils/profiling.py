@@ -0,0 +1,124 @@
+"""
+Opt-in timing of the phases of the arena loop.
+The phases are timed with ``profile(name)`` (a context manager) or ``profiled(name)`` (a decorator), both do nothing until the profiler is enabled.
+ArenaMP enables it when it gets a profile_dir, and writes one columnar .npz file per episode:
+    step, agent, phase (index into phase_names), start (seconds since the episode start), seconds
+Phases can be nested, e.g. 'vision' and 'mcts' are inside 'get_action' of the same agent.
+
+Summary of a test run:
+    python utils/profiling.py ../test_results/<mode>/profile [--by_agent]
+"""
+
+import os
+import glob
+import time
+import argparse
+import contextlib
+from functools import wraps
+
+import numpy as np
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.step = -1
+        self.agent = -1 # the agent whose action is being computed, -1 for the env
+        self.reset()
+
+    def reset(self):
+        self.phase_names = []
+        self.phase_code = {}
+        self.columns = {'step': [], 'agent': [], 'phase': [], 'start': [], 'seconds': []}
+        self.start_time = time.perf_counter()
+
+    @contextlib.contextmanager
+    def timer(self, name, agent):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            if name not in self.phase_code:
+                self.phase_code[name] = len(self.phase_names)
+                self.phase_names.append(name)
+            self.columns['step'].append(self.step)
+            self.columns['agent'].append(self.agent if agent is None else agent)
+            self.columns['phase'].append(self.phase_code[name])
+            self.columns['start'].append(start - self.start_time)
+            self.columns['seconds'].append(end - start)
+
+    def phase(self, name, agent = None):
+        if not self.enabled:
+            return NULL_CONTEXT
+        return self.timer(name, agent)
+
+    def save(self, path):
+        np.savez_compressed(path,
+                            step=np.array(self.columns['step'], dtype=np.int32),
+                            agent=np.array(self.columns['agent'], dtype=np.int8),
+                            phase=np.array(self.columns['phase'], dtype=np.int16),
+                            start=np.array(self.columns['start'], dtype=np.float32),
+                            seconds=np.array(self.columns['seconds'], dtype=np.float32),
+                            phase_names=np.array(self.phase_names),
+                            wall=np.float64(time.perf_counter() - self.start_time))
+
+NULL_CONTEXT = contextlib.nullcontext()
+profiler = Profiler()
+
+def profile(name, agent = None):
+    return profiler.phase(name, agent)
+
+def profiled(name):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return func(*args, **kwargs)
+            with profiler.timer(name, None):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def load_profiles(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(glob.glob(os.path.join(path, '**', 'profile_*.npz'), recursive=True))
+        else:
+            files.append(path)
+    profiles = []
+    for file in files:
+        with np.load(file) as data:
+            profiles.append({key: data[key] for key in data.files})
+    return files, profiles
+
+def summarize(profiles, by_agent = False):
+    r'''
+    Total time, number of calls and mean / p95 time of each phase over all the episodes
+    '''
+    seconds = {}
+    for data in profiles:
+        names = data['phase_names']
+        for phase, agent, t in zip(data['phase'], data['agent'], data['seconds']):
+            key = (str(names[phase]), int(agent)) if by_agent else (str(names[phase]), None)
+            seconds.setdefault(key, []).append(t)
+    wall = sum(float(data['wall']) for data in profiles)
+    rows = []
+    for key, t in seconds.items():
+        t = np.array(t)
+        rows.append({'phase': key[0], 'agent': key[1], 'calls': len(t), 'total': t.sum(), 'mean': t.mean(), 'p95': np.percentile(t, 95), 'share': t.sum() / max(wall, 1e-9)})
+    rows.sort(key=lambda x: -x['total'])
+    return wall, rows
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Where the wall time of a test run goes')
+    parser.add_argument('paths', nargs='+', help='profile directories or files')
+    parser.add_argument('--by_agent', action='store_true', help='split the phases by agent, -1 is the env')
+    args = parser.parse_args()
+    files, profiles = load_profiles(args.paths)
+    wall, rows = summarize(profiles, args.by_agent)
+    print(f'{len(files)} episodes, wall time {wall:.1f}s')
+    print(f"{'phase':<20}{'agent':>6}{'calls':>9}{'total (s)':>12}{'mean (ms)':>12}{'p95 (ms)':>12}{'share':>8}")
+    for row in rows:
+        agent = '' if row['agent'] is None else row['agent']
+        print(f"{row['phase']:<20}{agent:>6}{row['calls']:>9}{row['total']:>12.2f}{row['mean'] * 1000:>12.1f}{row['p95'] * 1000:>12.1f}{row['share']:>8.1%}")
@@ -12,6 +12,8 @@ import seaborn as sns
 import matplotlib.pyplot as plt
 import re
 from copy import deepcopy
+from episode_log import load_episode
+from episode_summary import SummaryIndex
 
 parser = argparse.ArgumentParser()
 '''old dataset'''
@@ -95,15 +97,9 @@ def generate_result():
 	if args.also_generate_single_dir_result and args.single_dir not in generate_dir:
 		generate_dir.append(args.single_dir)
 	for record_dir in generate_dir:
-		pattern = re.compile(r'logs_agent_\d+_.*_(\d+)\.pik')
-		max_num_1 = -1
-		for filename in os.listdir(record_dir):
-			file_path = os.path.join(record_dir, filename)
-			if os.path.isfile(file_path):
-				match = pattern.match(filename)
-				if match:
-					num_1 = int(match.group(1))
-					max_num_1 = max(max_num_1, num_1)
+		# the summaries of the log files, only the logs that are new since the last call are read
+		summaries = SummaryIndex(record_dir).refresh()
+		max_num_1 = max([seed for _, _, seed in summaries.keys()], default=-1)
 
 		test_results = {}
 		env_id = [[] for _ in range(len(episode_ids))]
@@ -124,100 +120,28 @@ def generate_result():
 		have_nouse = True
 		for seed in range(max_num_1 + 1):
 			for episode_id in episode_ids:
-				curr_log_file_name = os.path.join(record_dir, 'logs_agent_{}_{}_{}.pik'.format(
-					env_task_set[episode_id]['task_id'],
-					env_task_set[episode_id]['task_name'],
-					seed))
-
-				if not os.path.isfile(curr_log_file_name):
+				key = (env_task_set[episode_id]['task_id'], env_task_set[episode_id]['task_name'], seed)
+				if key not in summaries:
 					continue
 					# raise ValueError(f"{curr_log_file_name} does not exist")
 				assert len(S[episode_id]) == seed, f"{S[episode_id]}, {seed}"
-				with open(curr_log_file_name, 'rb') as fd:
-					file_data = pickle.load(fd)
-				S[episode_id].append(file_data['finished'])
-				env_id[episode_id].append(file_data['env_id'])
-				two_agent = len(file_data['action'][1]) != 0
-				cnt_duplicate_subgoal = 0
-				min_subgoal_len = min(len(file_data['subgoals'][0]), len(file_data['subgoals'][1])) if two_agent else len(file_data['subgoals'][0])
-				if two_agent:
-					for i in range(min_subgoal_len):
-						if file_data['subgoals'][0][i] == file_data['subgoals'][1][i]:
-							cnt_duplicate_subgoal += 1
-					for i in reversed(range(min_subgoal_len)):
-						if i == 0 or file_data['subgoals'][0][i] == file_data['subgoals'][1][i] == file_data['subgoals'][0][i-1] == file_data['subgoals'][1][i-1]:
-							cnt_duplicate_subgoal -= 1
-						else:
-							break
-				cnt_influence = 0
-				comm_num = 0
-				if two_agent:
-					# calculate one agent send message and another agent change its subgoal
-					# for i in range(1, min_subgoal_len):
-					#     if file_data['subgoals'][1][i] != file_data['subgoals'][1][i-1]:
-					#         if file_data['action'][0][i-1] is not None and file_data['action'][0][i].startswith('[send_message]'):
-					#             cnt_influence += 1
-					#     if file_data['subgoals'][0][i] != file_data['subgoals'][0][i-1]:
-					#         if file_data['action'][1][i-1] is not None and file_data['action'][1][i].startswith('[send_message]'):
-					#             cnt_influence += 1
-					#another calc method
-					for i in range(0, min_subgoal_len-1):
-						if file_data['action'][0][i] is not None and file_data['action'][0][i].startswith('[send_message]'):
-							comm_num += 1
-							if file_data['subgoals'][1][i] != file_data['subgoals'][1][i+1]:
-								cnt_influence += 1
-						if file_data['action'][1][i] is not None and file_data['action'][1][i].startswith('[send_message]'):
-							comm_num += 1
-							if file_data['subgoals'][0][i] != file_data['subgoals'][0][i+1]:
-								cnt_influence += 1
-				cnt_influences[episode_id].append(cnt_influence/comm_num if comm_num != 0 else 0)
-				assert not two_agent or len(file_data['action'][0]) == len(file_data['action'][1])
-				if two_agent:
-					agent = {k:[0,0] for k in pie_chart_keys}
-				else:
-					agent = {k:[0] for k in pie_chart_keys}
-				agent_index = [0] if not two_agent else [0,1]
-				for index in agent_index:
-					for i in file_data['action'][index]:
-						if i is None:
-							agent['None'][index] += 1
-						else:
-							act = i[i.find('[') + 1 :i.find(']')]
-							if act == 'send_message':
-								if "'S':" in i:
-									agent['S'][index] += 1
-								if "'B':" in i:
-									agent['B'][index] += 1
-								if "'E':" in i:
-									agent['E'][index] += 1
-								agent['comm'][index] += 1
-							elif act in ['walktowards', 'turnleft', 'TurnLeft']:
-								agent['navigation'][index] += 1
-							elif act in ['open', 'close', 'grab', 'putin', 'putback']:
-								agent['interaction'][index] += 1
-							else:
-								print(i)
-								assert False
-
-				# agent_means = {k:v for k,v in agent_0.items()} if not two_agent else {k:(agent_0[k]+agent_1[k])/2 for k,v in agent_0.keys()}
-				steps = len(file_data['action'][0])
-				steps_remove_comm = max(len([i for i in file_data['action'][0] if ((not i) or (not i.startswith('[send_message]')))]), len([i for i in file_data['action'][1] if ((not i) or (not i.startswith('[send_message]')))]))
-				if 'cnt_nouse_subgoal'  not in file_data.keys():
+				summary = summaries[key]
+				S[episode_id].append(summary['finished'])
+				env_id[episode_id].append(summary['env_id'])
+				cnt_influences[episode_id].append(summary['influence'])
+				steps = summary['steps']
+				if summary['cnt_nouse_subgoal'] is None:
 					have_nouse = False
-				if have_nouse:
-					cnt_nouse_subgoal = file_data['cnt_nouse_subgoal']
-				# print(file_data['action'][0])
-				# steps_remove_comm = agent_means['others']
-				if file_data['finished']:
+				if summary['finished']:
 					steps_list.append(steps)
 				else:
-					failed_tasks.append(file_data['task_name'])
+					failed_tasks.append(summary['task_name'])
 				L[episode_id].append(steps)
-				L_remove_comm[episode_id].append(steps_remove_comm)
-				step_data[episode_id].append(agent)
-				dup_s[episode_id].append(cnt_duplicate_subgoal/steps)
+				L_remove_comm[episode_id].append(summary['steps_remove_comm'])
+				step_data[episode_id].append(summary['step_data'])
+				dup_s[episode_id].append(summary['cnt_duplicate_subgoal']/steps)
 				if have_nouse:
-					nouse_s[episode_id].append(cnt_nouse_subgoal/2/steps)
+					nouse_s[episode_id].append(summary['cnt_nouse_subgoal']/2/steps)
 
 		for episode_id in test_task:
 			item = {'S': S[episode_id], 'L': L[episode_id], 'L_remove_comm':L_remove_comm[episode_id], 'step_data': step_data[episode_id], 'duplicate_subgoal': dup_s[episode_id], 'influence': cnt_influences[episode_id], 'env_id': env_id[episode_id]}
@@ -565,7 +489,7 @@ def print_log(a, output_dir, task_id):
 	# print(json.dumps(o, indent=4))
 def pretty_print_pickle_logs():
 	if args.current_log:
-		a = pickle.load(open(os.path.join(args.record_dir[0], 'log.pik'), 'rb'))
+		a = load_episode(os.path.join(args.record_dir[0], 'log.pik'))
 		print_log(a, 'action.log', 0)
 	else:
 		for record_dir in args.record_dir:
@@ -576,7 +500,7 @@ def pretty_print_pickle_logs():
 			Path(output_dir).mkdir(parents=True, exist_ok=True)
 			for task_id in args.test_task:
 				for seed in range(args.num_runs):
-					a = pickle.load(open(os.path.join(record_dir, f'logs_agent_{task_id}_{task_names[task_id // 10]}_{seed}.pik'), "rb"))
+					a = load_episode(os.path.join(record_dir, f'logs_agent_{task_id}_{task_names[task_id // 10]}_{seed}.pik'))
 					print_log(a, os.path.join(output_dir, f"{task_id}_{seed}.log"), task_id)
 				# s = pickle.load(open(os.path.join(args.single_dir, f'logs_agent_{task_id}_{task_names[task_id // 20]}_{args.num_runs}.pik', "rb")))
 
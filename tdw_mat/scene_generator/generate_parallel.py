@@ -0,0 +1,77 @@
+"""
+Generate the scenes of a dataset with several TDW builds at the same time.
+Every (scene, layout, scene_id) is a job of scene_generate.generate_scene, the workers take jobs from a queue and each one owns a build on its
+own port (port, port + 1, ...). The outputs are the same files as running scene_generate.py for each job:
+    python scenes/generate_parallel.py --scenes 2a 5a --layouts 0 1 2 --scene_ids 0 1 --dataset_prefix dataset_test --num_workers 4
+"""
+
+import os
+import argparse
+import itertools
+import queue
+import traceback
+import multiprocessing as mp
+
+def kill_build(port):
+    os.system(f"ps ux | grep TDW.x86_64\\ -port\\ {port} | awk {{'print $2'}} | xargs kill")
+
+def worker(port, dataset_prefix, job_queue, result_queue):
+    # imported in the worker: utils reads the room types of ./dataset when imported
+    from scene_generate import generate_scene
+    while True:
+        job = job_queue.get()
+        if job is None:
+            break
+        scene, layout, scene_id, seed = job
+        try:
+            generate_scene(scene, layout, scene_id, dataset_prefix, port = port, seed = seed)
+            result_queue.put((job, None))
+        except Exception:
+            # the build of a failed job might still be running
+            kill_build(port)
+            result_queue.put((job, traceback.format_exc()))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenes", nargs='+', type=str, required=True)
+    parser.add_argument("--layouts", nargs='+', type=int, default=(0, 1, 2))
+    parser.add_argument("--scene_ids", nargs='+', type=int, default=(0, 1))
+    parser.add_argument("--dataset_prefix", type=str, required=True, help="the dataset directory in ./dataset")
+    parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument("--port", type=int, default=1077, help="the port of the first worker, the others use the next ones")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the first job, the others use the next ones. Random by default")
+    args = parser.parse_args()
+
+    jobs = [(scene, layout, scene_id, None if args.seed is None else args.seed + i)
+            for i, (scene, layout, scene_id) in enumerate(itertools.product(args.scenes, args.layouts, args.scene_ids))]
+    # spawned, not forked, so that the workers do not share the random state of this process
+    ctx = mp.get_context('spawn')
+    job_queue, result_queue = ctx.Queue(), ctx.Queue()
+    for job in jobs:
+        job_queue.put(job)
+    num_workers = min(args.num_workers, len(jobs))
+    for _ in range(num_workers):
+        job_queue.put(None)
+    workers = [ctx.Process(target=worker, args=(args.port + i, args.dataset_prefix, job_queue, result_queue)) for i in range(num_workers)]
+    for process in workers:
+        process.start()
+    failed = []
+    done = set()
+    while len(done) < len(jobs):
+        try:
+            job, error = result_queue.get(timeout = 10)
+        except queue.Empty:
+            if not any(process.is_alive() for process in workers):
+                # the workers died (e.g. a crash of the build that killed the process)
+                failed.extend(job for job in jobs if job not in done)
+                break
+            continue
+        done.add(job)
+        if error is not None:
+            print(f"{job[0]}_{job[1]}_{job[2]} failed:\n{error}")
+            failed.append(job)
+        else:
+            print(f"{job[0]}_{job[1]}_{job[2]} done")
+    for process in workers:
+        process.join()
+    print(f"{len(jobs) - len(failed)} scenes generated, failed: {[f'{x[0]}_{x[1]}_{x[2]}' for x in failed]}")
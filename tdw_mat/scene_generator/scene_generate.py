@@ -12,11 +12,12 @@ from utils import *
 import random
 import json
 import numpy as np
+from scipy.spatial import cKDTree
 
 import sys
 import os
 
-def check_maximum_count(obj_name, current_count, container_limit = 6, round = 0):
+def check_maximum_count(obj_name, current_count, object_place, container_limit = 6, round = 0):
     hard_bar = 4 if round == 0 else 6
     if obj_name in object_place['food']['target']: 
         if current_count["count_target_food"] >= 10: return False
@@ -36,7 +37,7 @@ def check_maximum_count(obj_name, current_count, container_limit = 6, round = 0)
         if current_count["count_target_stuff_common"] >= hard_bar: return False
     return True
 
-def update_maximum_count(obj_name, current_count):
+def update_maximum_count(obj_name, current_count, object_place):
     if obj_name in object_place['food']['target']: current_count["count_target_food"] += 1
     if obj_name in object_place['food']['container']: current_count["count_container_food"] += 1
     if obj_name in object_place['stuff']['target']: current_count["count_target_stuff"] += 1
@@ -46,77 +47,46 @@ def update_maximum_count(obj_name, current_count):
     if obj_name in object_place['stuff']['target_office']: current_count["count_target_stuff_office"] += 1
     if obj_name in object_place['stuff']['target_common']: current_count["count_target_stuff_common"] += 1
 
-def check_map(x, z, occ_map, positions, threshold = 0.65):
-    for i in range(occ_map.shape[0]):
-        for j in range(occ_map.shape[1]):
-            if occ_map[i, j] == 1 and (positions[i, j][0] - positions[x, z][0]) ** 2 + (positions[i, j][1] - positions[x, z][1]) ** 2 < threshold ** 2:
-                return False
-    return True
-
-#scene settings
-settings = sys.argv[1:]
-FLOORPLAN_SCENE_NAME = settings[0]
-FLOORPLAN_LAYOUT = int(settings[1])
-scene_id = int(settings[2])
-dataset_prefix = settings[3]
-print("FLOORPLAN_SCENE_NAME:", FLOORPLAN_SCENE_NAME)
-print("FLOORPLAN_LAYOUT:", FLOORPLAN_LAYOUT)
-print("scene_id:", scene_id)
-
-container_limit, container_room_limit = 0, 0
-if scene_id == 0: container_limit, container_room_limit = 5, 2
-if scene_id == 1: container_limit, container_room_limit = 2, 1
-if scene_id == 2: container_limit, container_room_limit = 4, 1
-
-#start simulator
-c = Controller(port = 1077)
-
-occ = OccupancyMap()
-occ.generate(cell_size=0.25, once=False)
-om = ObjectManager(transforms=True, rigidbodies=True, bounds=True)
-c.add_ons.extend([occ, om])
-
-floorplan = Floorplan()
-
-floorplan.init_scene(scene=FLOORPLAN_SCENE_NAME, layout=FLOORPLAN_LAYOUT)
-
-with open('./dataset/list.json', 'r') as f:
-    object_place = json.loads(f.read())
-
-with open('./dataset/name_map.json', 'r') as f:
-    name_map = json.loads(f.read())
-
-with open('./dataset/object_scale.json', 'r') as f:
-    object_scale = json.loads(f.read())
+class PlacementMap:
+    """
+    Clearance checks of the floor placement: whether there is no occupied cell of the occupancy map closer than a threshold to a cell.
+    The occupied cells of the scene are in a KD-tree, the cells of the objects placed since then are few and checked directly.
+    """
 
-os.makedirs("./dataset/", exist_ok=True)
-os.makedirs(f"./dataset/{dataset_prefix}/", exist_ok=True)
+    def __init__(self, occ_map, positions):
+        """
+        :param occ_map: The occupancy map of the scene, cells with value 1 are occupied.
+        :param positions: The (x, z) position of each cell.
+        """
 
-random_object_list_on_floor = object_place['floor_objects']
+        self.positions = positions
+        occupied = positions[occ_map == 1].reshape(-1, 2)
+        self.tree = cKDTree(occupied) if len(occupied) > 0 else None
+        self.placed = np.zeros((0, 2))
 
-commands_init_scene = [{"$type": "set_screen_size", "width": 1920, "height": 1080}] # Set screen size
-commands_init_scene.extend(floorplan.commands)
-commands_init_scene.append({"$type": "set_floorplan_roof", "show": False}) # Hide roof
+    def is_free(self, x, z, threshold = 0.65):
+        """
+        :param x: The x index of the cell.
+        :param z: The z index of the cell.
+        :param threshold: The clearance.
 
-response = c.communicate(commands_init_scene)
+        :return: True if no occupied cell is closer than `threshold` to the cell.
+        """
 
-resp = c.communicate([{"$type": "send_scene_regions"}])
-scene_bounds = SceneBounds(resp=resp)
+        p = self.positions[x, z]
+        if self.tree is not None and self.tree.query(p)[0] < threshold:
+            return False
+        return not np.any(np.sum((self.placed - p) ** 2, axis = 1) < threshold ** 2)
 
-commands = []
-object_room_list = []
-camera = ThirdPersonCamera(position={"x": 0, "y": 30, "z": 0},
-                           look_at={"x": 0, "y": 0, "z": 0},
-                           avatar_id="a")
+    def occupy(self, x, z):
+        """
+        Mark a cell as occupied.
 
-screenshot_path = f"./dataset/{dataset_prefix}/screenshots/{FLOORPLAN_SCENE_NAME}_{FLOORPLAN_LAYOUT}_{scene_id}"
-if not os.path.exists(screenshot_path):
-    os.makedirs(screenshot_path)
-print(f"Images will be saved to: {screenshot_path}")
+        :param x: The x index of the cell.
+        :param z: The z index of the cell.
+        """
 
-capture = ImageCapture(avatar_ids=["a"], path=screenshot_path, pass_masks=["_img"])
-commands.extend(camera.get_initialization_commands()) # Init camera
-c.add_ons.extend([capture]) # Capture images
+        self.placed = np.vstack([self.placed, self.positions[x, z][None]])
 
 def get_scale(obj_name, object_scale):
     if obj_name in object_scale:
@@ -140,61 +110,136 @@ def object_choice(object_list):
         else:
             return object_list[random.randint(3, 5)]
 
+def generate_scene(FLOORPLAN_SCENE_NAME, FLOORPLAN_LAYOUT, scene_id, dataset_prefix, port = 1077, seed = None):
+    """
+    Place random objects in a floorplan scene and write the scene commands and metadata to `./dataset/{dataset_prefix}/`.
 
-count = {}
-current_count = {
-    "count_target_food": 0,
-    "count_container_food": 0,
-    "count_target_stuff": 0,
-    "count_container_stuff": 0,
-    "count_target_food_fruit": 0,
-    "count_target_food_bread": 0,
-    "count_target_stuff_office": 0,
-    "count_target_stuff_common": 0
-}
-
-place_list = []
-for object_id in om.objects_static:
-    place_list.append(object_id)
-np.random.shuffle(place_list)
-
-for object_id in place_list:
-    id = belongs_to_which_room(om.bounds[object_id].top[0], om.bounds[object_id].top[2], scene_bounds)
-    if id == -1: continue
-    func_name = get_room_functional_by_id(FLOORPLAN_SCENE_NAME, FLOORPLAN_LAYOUT, id)
-    if om.objects_static[object_id].category in ['table', 'sofa', 'chair']: # place objects on specific objects
-        if om.objects_static[object_id].category in ['table']:
-            num = np.random.randint(1, 3) # more than 3 objects on a table is too crowded
-        else:
-            num = np.random.randint(0, 2)
-        for i in range(num):
-            if len(object_place[om.objects_static[object_id].category][func_name]) == 0: continue
-            obj = c.get_unique_id()
-            p = shift(om.bounds[object_id], i)
-            obj_name = object_choice(object_place[om.objects_static[object_id].category][func_name])
-            if not check_maximum_count(obj_name, current_count, container_limit, round = 0):
-                continue
-            update_maximum_count(obj_name, current_count)
-            if obj_name not in count: count[obj_name] = 0
-            count[obj_name] += 1
-            object_room_list.append([obj_name, func_name])
-            commands.extend(c.get_add_physics_object(obj_name,
-                                    object_id=obj,
-                                    position=TDWUtils.array_to_vector3(p),
-                                    scale_factor = {
-                                        "x": get_scale(obj_name, object_scale),
-                                        "y": get_scale(obj_name, object_scale),
-                                        "z": get_scale(obj_name, object_scale),
-                                    }))
-
-object_probability = 1
-curr_occ_map = occ.occupancy_map.copy()
-food_container_room_count, stuff_container_room_count = 0, 0
-has_container = {}
-for _ in range(occ.occupancy_map.shape[0] * occ.occupancy_map.shape[1] * 3):
+    :param FLOORPLAN_SCENE_NAME: The floorplan scene, e.g. `"2a"`.
+    :param FLOORPLAN_LAYOUT: The layout of the scene.
+    :param scene_id: 0, 1 or 2, the number of containers: enough, rare or in between.
+    :param dataset_prefix: The dataset directory in `./dataset/`.
+    :param port: The port of the build.
+    :param seed: The random seed, if None the random state is left as it is.
+
+    :return: The metadata of the scene.
+    """
+
+    if seed is not None:
+        random.seed(seed)
+        np.random.seed(seed)
+    print("FLOORPLAN_SCENE_NAME:", FLOORPLAN_SCENE_NAME)
+    print("FLOORPLAN_LAYOUT:", FLOORPLAN_LAYOUT)
+    print("scene_id:", scene_id)
+
+    container_limit, container_room_limit = 0, 0
+    if scene_id == 0: container_limit, container_room_limit = 5, 2
+    if scene_id == 1: container_limit, container_room_limit = 2, 1
+    if scene_id == 2: container_limit, container_room_limit = 4, 1
+
+    #start simulator
+    c = Controller(port = port)
+
+    occ = OccupancyMap()
+    occ.generate(cell_size=0.25, once=False)
+    om = ObjectManager(transforms=True, rigidbodies=True, bounds=True)
+    c.add_ons.extend([occ, om])
+
+    floorplan = Floorplan()
+
+    floorplan.init_scene(scene=FLOORPLAN_SCENE_NAME, layout=FLOORPLAN_LAYOUT)
+
+    with open('./dataset/list.json', 'r') as f:
+        object_place = json.loads(f.read())
+
+    with open('./dataset/name_map.json', 'r') as f:
+        name_map = json.loads(f.read())
+
+    with open('./dataset/object_scale.json', 'r') as f:
+        object_scale = json.loads(f.read())
+
+    os.makedirs("./dataset/", exist_ok=True)
+    os.makedirs(f"./dataset/{dataset_prefix}/", exist_ok=True)
+
+    random_object_list_on_floor = object_place['floor_objects']
+
+    commands_init_scene = [{"$type": "set_screen_size", "width": 1920, "height": 1080}] # Set screen size
+    commands_init_scene.extend(floorplan.commands)
+    commands_init_scene.append({"$type": "set_floorplan_roof", "show": False}) # Hide roof
+
+    response = c.communicate(commands_init_scene)
+
+    resp = c.communicate([{"$type": "send_scene_regions"}])
+    scene_bounds = SceneBounds(resp=resp)
+
+    commands = []
+    object_room_list = []
+    camera = ThirdPersonCamera(position={"x": 0, "y": 30, "z": 0},
+                               look_at={"x": 0, "y": 0, "z": 0},
+                               avatar_id="a")
+
+    screenshot_path = f"./dataset/{dataset_prefix}/screenshots/{FLOORPLAN_SCENE_NAME}_{FLOORPLAN_LAYOUT}_{scene_id}"
+    if not os.path.exists(screenshot_path):
+        os.makedirs(screenshot_path)
+    print(f"Images will be saved to: {screenshot_path}")
+
+    capture = ImageCapture(avatar_ids=["a"], path=screenshot_path, pass_masks=["_img"])
+    commands.extend(camera.get_initialization_commands()) # Init camera
+    c.add_ons.extend([capture]) # Capture images
+
+    count = {}
+    current_count = {
+        "count_target_food": 0,
+        "count_container_food": 0,
+        "count_target_stuff": 0,
+        "count_container_stuff": 0,
+        "count_target_food_fruit": 0,
+        "count_target_food_bread": 0,
+        "count_target_stuff_office": 0,
+        "count_target_stuff_common": 0
+    }
+
+    place_list = []
+    for object_id in om.objects_static:
+        place_list.append(object_id)
+    np.random.shuffle(place_list)
+
+    for object_id in place_list:
+        id = belongs_to_which_room(om.bounds[object_id].top[0], om.bounds[object_id].top[2], scene_bounds)
+        if id == -1: continue
+        func_name = get_room_functional_by_id(FLOORPLAN_SCENE_NAME, FLOORPLAN_LAYOUT, id)
+        if om.objects_static[object_id].category in ['table', 'sofa', 'chair']: # place objects on specific objects
+            if om.objects_static[object_id].category in ['table']:
+                num = np.random.randint(1, 3) # more than 3 objects on a table is too crowded
+            else:
+                num = np.random.randint(0, 2)
+            for i in range(num):
+                if len(object_place[om.objects_static[object_id].category][func_name]) == 0: continue
+                obj = c.get_unique_id()
+                p = shift(om.bounds[object_id], i)
+                obj_name = object_choice(object_place[om.objects_static[object_id].category][func_name])
+                if not check_maximum_count(obj_name, current_count, object_place, container_limit, round = 0):
+                    continue
+                update_maximum_count(obj_name, current_count, object_place)
+                if obj_name not in count: count[obj_name] = 0
+                count[obj_name] += 1
+                object_room_list.append([obj_name, func_name])
+                commands.extend(c.get_add_physics_object(obj_name,
+                                        object_id=obj,
+                                        position=TDWUtils.array_to_vector3(p),
+                                        scale_factor = {
+                                            "x": get_scale(obj_name, object_scale),
+                                            "y": get_scale(obj_name, object_scale),
+                                            "z": get_scale(obj_name, object_scale),
+                                        }))
+
+    object_probability = 1
+    placement = PlacementMap(occ.occupancy_map, occ.positions)
+    food_container_room_count, stuff_container_room_count = 0, 0
+    has_container = {}
+    for _ in range(occ.occupancy_map.shape[0] * occ.occupancy_map.shape[1] * 3):
         x_index = np.random.randint(0, occ.occupancy_map.shape[0])
         z_index = np.random.randint(0, occ.occupancy_map.shape[1])
-        if check_map(x_index, z_index, curr_occ_map, occ.positions, 0.5): # Unoccupied
+        if placement.is_free(x_index, z_index, 0.5): # Unoccupied
             if np.random.random() < object_probability:
                 x = float(occ.positions[x_index, z_index][0])
                 z = float(occ.positions[x_index, z_index][1])
@@ -205,13 +250,13 @@ for _ in range(occ.occupancy_map.shape[0] * occ.occupancy_map.shape[1] * 3):
                     continue
                 else:
                     obj_name = np.random.choice(random_object_list_on_floor)
-                if not check_maximum_count(obj_name, current_count, container_limit, round = 1):
+                if not check_maximum_count(obj_name, current_count, object_place, container_limit, round = 1):
                     continue
                 if obj_name in object_place['food']['target']:
                     if obj_name not in object_place['ground'][func_name]: continue
                 if obj_name in object_place['food']['container']:
                     if not(room_id not in has_container or has_container[room_id] == 'food'): continue
-                    if 'Office' == func_name or not check_map(x_index, z_index, curr_occ_map, occ.positions): continue
+                    if 'Office' == func_name or not placement.is_free(x_index, z_index): continue
                     if room_id not in has_container:
                         if food_container_room_count >= container_room_limit:
                             continue 
@@ -221,13 +266,13 @@ for _ in range(occ.occupancy_map.shape[0] * occ.occupancy_map.shape[1] * 3):
                     if obj_name not in object_place['ground'][func_name]: continue
                 if obj_name in object_place['stuff']['container']:
                     if not(room_id not in has_container or has_container[room_id] == 'stuff'): continue
-                    if 'Kitchen' == func_name or not check_map(x_index, z_index, curr_occ_map, occ.positions): continue
+                    if 'Kitchen' == func_name or not placement.is_free(x_index, z_index): continue
                     if room_id not in has_container:
                         if stuff_container_room_count >= container_room_limit:
                             continue 
                         has_container[room_id] = 'stuff'
                         stuff_container_room_count += 1
-                update_maximum_count(obj_name, current_count)
+                update_maximum_count(obj_name, current_count, object_place)
                 object_room_list.append([obj_name, func_name])
                 if obj_name not in count: count[obj_name] = 0
                 count[obj_name] += 1
@@ -240,45 +285,51 @@ for _ in range(occ.occupancy_map.shape[0] * occ.occupancy_map.shape[1] * 3):
                                                  "y": get_scale(obj_name, object_scale),
                                                  "z": get_scale(obj_name, object_scale),
                                                 }))
-                curr_occ_map[x_index][z_index] = 1
+                placement.occupy(x_index, z_index)
                 print(x_index, z_index, x, z, room_id, obj_name, occ.positions[x_index, z_index])
-                
-commands.append({"$type": "step_physics", "frames": 100})
-
-print(count)
-print("Total number of objects: ", sum(count.values()))
-print("Total number of target food: ", current_count['count_target_food'])
-print("Total number of container food: ", current_count['count_container_food'])
-print("Total number of target stuff: ", current_count['count_target_stuff'])
-print("Total number of container stuff: ", current_count['count_container_stuff'])
-
-count_goal_container = {
-    'food': {
-        'target': current_count['count_target_food'],
-        'container': current_count['count_container_food'],
-    },
-    'stuff': {
-        'target': current_count['count_target_stuff'],
-        'container': current_count['count_container_stuff'],
+
+    commands.append({"$type": "step_physics", "frames": 100})
+
+    print(count)
+    print("Total number of objects: ", sum(count.values()))
+    print("Total number of target food: ", current_count['count_target_food'])
+    print("Total number of container food: ", current_count['count_container_food'])
+    print("Total number of target stuff: ", current_count['count_target_stuff'])
+    print("Total number of container stuff: ", current_count['count_container_stuff'])
+
+    count_goal_container = {
+        'food': {
+            'target': current_count['count_target_food'],
+            'container': current_count['count_container_food'],
+        },
+        'stuff': {
+            'target': current_count['count_target_stuff'],
+            'container': current_count['count_container_stuff'],
+        }
+    }
+
+    metadata = {
+        'floorplan_scene_name': FLOORPLAN_SCENE_NAME,
+        'floorplan_layout': FLOORPLAN_LAYOUT,
+        'scene_id': scene_id,
+        'object_room_list': object_room_list,
+        **count_goal_container,
     }
-}
 
-metadata = {
-    'floorplan_scene_name': FLOORPLAN_SCENE_NAME,
-    'floorplan_layout': FLOORPLAN_LAYOUT,
-    'scene_id': scene_id,
-    'object_room_list': object_room_list,
-    **count_goal_container,
-}
+    # Save commands and metadata to json
 
-# Save commands and metadata to json
 
+    with open(f"./dataset/{dataset_prefix}/{FLOORPLAN_SCENE_NAME}_{FLOORPLAN_LAYOUT}_{scene_id}.json", "w") as f:
+        f.write(json.dumps(commands, indent=4))
+    with open(f"./dataset/{dataset_prefix}/{FLOORPLAN_SCENE_NAME}_{FLOORPLAN_LAYOUT}_{scene_id}_metadata.json", "w") as f:
+        f.write(json.dumps(metadata, indent=4))
 
-with open(f"./dataset/{dataset_prefix}/{FLOORPLAN_SCENE_NAME}_{FLOORPLAN_LAYOUT}_{scene_id}.json", "w") as f:
-    f.write(json.dumps(commands, indent=4))
-with open(f"./dataset/{dataset_prefix}/{FLOORPLAN_SCENE_NAME}_{FLOORPLAN_LAYOUT}_{scene_id}_metadata.json", "w") as f:
-    f.write(json.dumps(metadata, indent=4))
+    response = c.communicate(commands)
 
-response = c.communicate(commands)
+    c.communicate({"$type": "terminate"})
+    return metadata
 
-c.communicate({"$type": "terminate"})
+if __name__ == "__main__":
+    #scene settings
+    settings = sys.argv[1:]
+    generate_scene(settings[0], int(settings[1]), int(settings[2]), settings[3], port = int(settings[4]) if len(settings) > 4 else 1077)
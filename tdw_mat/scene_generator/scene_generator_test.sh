@@ -1,15 +1,4 @@
-python scenes/scene_generate.py 2a 0 0 $1
-python scenes/scene_generate.py 2a 0 1 $1
-python scenes/scene_generate.py 2a 1 0 $1
-python scenes/scene_generate.py 2a 1 1 $1
-python scenes/scene_generate.py 2a 2 0 $1
-python scenes/scene_generate.py 2a 2 1 $1
-python scenes/scene_generate.py 5a 0 0 $1
-python scenes/scene_generate.py 5a 0 1 $1
-python scenes/scene_generate.py 5a 1 0 $1
-python scenes/scene_generate.py 5a 1 1 $1
-python scenes/scene_generate.py 5a 2 0 $1
-python scenes/scene_generate.py 5a 2 1 $1
+python scenes/generate_parallel.py --scenes 2a 5a --layouts 0 1 2 --scene_ids 0 1 --dataset_prefix $1
 cp dataset/list.json dataset/$1/list.json
 cp dataset/name_map.json dataset/$1/name_map.json
 cp dataset/room_types.json dataset/$1/room_types.json
@@ -0,0 +1,137 @@
+"""
+A binary action trace of the env, replacing the per-step text action log.
+The trace is a sequence of chunks, each one is a little-endian uint32 length followed by a zlib-compressed pickle of a list of records:
+    ('episode', scene_info, object_names, target_object_ids, container_ids)
+    ('containment', num_step, 'full' or 'delta', {container_id: tuple of object ids})
+    ('step', num_step, replicant_id, action_type, time, status_name, position, forward)
+Containment is stored as a delta to the previous step, unless its containers changed, then it is stored in full.
+"""
+
+import argparse
+import pickle
+import queue
+import struct
+import threading
+import zlib
+
+class ActionTraceWriter:
+    def __init__(self, path, chunk_size = 256):
+        self.f = open(path, 'wb')
+        self.chunk_size = chunk_size
+        self.records = []
+        self.containment = {}
+        self.queue = queue.Queue(maxsize = 64)
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            data = zlib.compress(pickle.dumps(chunk, protocol = pickle.HIGHEST_PROTOCOL))
+            self.f.write(struct.pack('<I', len(data)))
+            self.f.write(data)
+            self.f.flush()
+
+    def write(self, record):
+        self.records.append(record)
+        if len(self.records) >= self.chunk_size:
+            self.flush()
+
+    def write_episode(self, scene_info, object_names, target_object_ids, container_ids):
+        self.flush()
+        self.containment = {}
+        self.write(('episode', scene_info, dict(object_names), list(target_object_ids), list(container_ids)))
+
+    def write_containment(self, num_step, containment, changed = None):
+        r'''
+        changed: the containers that might have changed since the last call (the change feed of ChallengeState), None to compare all of them
+        '''
+        if changed is None:
+            changed = set(containment.keys()) | set(self.containment.keys())
+        current = dict(self.containment)
+        for x in changed:
+            if x in containment:
+                current[x] = tuple(sorted(containment[x]))
+            else:
+                current.pop(x, None)
+        if set(current.keys()) != set(self.containment.keys()):
+            self.write(('containment', num_step, 'full', current))
+        else:
+            self.write(('containment', num_step, 'delta', {x: current[x] for x in changed if x in current and current[x] != self.containment[x]}))
+        self.containment = current
+
+    def write_step(self, num_step, replicant_id, action_type, time, status, position, forward):
+        self.write(('step', num_step, replicant_id, action_type, time, status.name, position.copy(), forward.copy()))
+
+    def flush(self):
+        if len(self.records) > 0:
+            self.queue.put(self.records)
+            self.records = []
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        self.f.close()
+
+def read_trace(path):
+    r'''
+    Iterate over the records of a trace file
+    '''
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(4)
+            if len(header) < 4:
+                break
+            length = struct.unpack('<I', header)[0]
+            for record in pickle.loads(zlib.decompress(f.read(length))):
+                yield record
+
+def trace_to_text(path):
+    r'''
+    Convert a trace file to the lines of the text action log
+    '''
+    object_names = {}
+    container_ids = []
+    goal, container = [], []
+    containment = {}
+
+    def add_name(inst):
+        if type(inst) == int and inst in object_names:
+            return f'{inst}_{object_names[inst]}'
+        elif type(inst) == dict:
+            return {add_name(key): add_name(value) for key, value in inst.items()}
+        elif type(inst) == list:
+            return [add_name(item) for item in inst]
+        return inst
+
+    for record in read_trace(path):
+        if record[0] == 'episode':
+            _, _, object_names, target_object_ids, container_ids = record
+            goal, container = add_name(target_object_ids), add_name(container_ids)
+            containment = {}
+        elif record[0] == 'containment':
+            _, _, kind, data = record
+            if kind == 'full':
+                containment = dict(data)
+            else:
+                containment.update(data)
+        else:
+            _, num_step, replicant_id, action_type, time, status, position, forward = record
+            container_info = {x: list(containment[x]) for x in containment}
+            for x in container_ids:
+                if x not in container_info:
+                    container_info[x] = []
+            yield 'step: {}, action: {}, time: {}, status: {}\n'.format(num_step, action_type, time, f'ActionStatus.{status}')
+            yield 'position: {}, forward: {}, containment: {}, goal: {}, container: {}\n'.format(position, forward, add_name(container_info), goal, container)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("trace_path", type=str, help="action trace written by the env, e.g. action1071.trace")
+    parser.add_argument("--output_path", type=str, default=None, help="text action log, default: the trace path with .log")
+    args = parser.parse_args()
+    output_path = args.output_path if args.output_path is not None else args.trace_path.rsplit('.', 1)[0] + '.log'
+    with open(output_path, 'w') as f:
+        f.writelines(trace_to_text(args.trace_path))
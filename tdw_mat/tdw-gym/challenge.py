@@ -6,6 +6,7 @@ import time
 import pickle
 import logging
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 # add this dictionary to python env path:
 base_path = os.getcwd()
@@ -13,6 +14,8 @@ sys.path.append(base_path)
 
 from h_agent import H_agent
 from lm_agent import lm_agent
+from image_writer import init_image_writer
+from utils.results_store import ResultsStore
 
 gym.envs.registration.register(
     id='transport_challenge_MA',
@@ -20,8 +23,8 @@ gym.envs.registration.register(
 )
 
 class Challenge:
-    def __init__(self, logger, port, data_path, output_dir, number_of_agents = 2, max_frames = 3000, launch_build = True, screen_size = 512, data_prefix = 'dataset/nips_dataset/', gt_mask = True, save_img = True):
-        self.env = gym.make("transport_challenge_MA", port = port, number_of_agents = number_of_agents, save_dir = output_dir, max_frames = max_frames, launch_build = launch_build, screen_size = screen_size, data_prefix = data_prefix, gt_mask = gt_mask)
+    def __init__(self, logger, port, data_path, output_dir, number_of_agents = 2, max_frames = 3000, launch_build = True, screen_size = 512, data_prefix = 'dataset/nips_dataset/', gt_mask = True, save_img = True, async_agents = False, fast_forward = False, image_capture_interval = 1, warm_reset = False, detection_device = None, detection_quantize = False, save_img_interval = 1, image_queue_size = 64):
+        self.env = gym.make("transport_challenge_MA", port = port, number_of_agents = number_of_agents, save_dir = output_dir, max_frames = max_frames, launch_build = launch_build, screen_size = screen_size, data_prefix = data_prefix, gt_mask = gt_mask, fast_forward = fast_forward, image_capture_interval = image_capture_interval, warm_reset = warm_reset)
         self.gt_mask = gt_mask
         self.logger = logger
         self.logger.debug(port)
@@ -29,7 +32,18 @@ class Challenge:
         self.output_dir = output_dir
         self.max_frames = max_frames
         self.save_img = save_img
+        # the experiment directory (output_dir is a run of it) holds the results of all its runs
+        self.results_store = ResultsStore(os.path.dirname(self.output_dir))
+        # the images of the env and the maps of the agents are written by a background thread, keeping one frame every save_img_interval
+        init_image_writer(max_queue_size = image_queue_size, frame_interval = save_img_interval)
         self.data = json.load(open(os.path.join(data_prefix, data_path), "r"))
+        # agents that need a new decision act in parallel threads, so LLM calls of different agents overlap
+        self.agent_pool = ThreadPoolExecutor(max_workers = number_of_agents) if async_agents else None
+        # without gt masks, the frames of all agents of a step are detected in one batch
+        self.detector = None
+        if not gt_mask:
+            from detection import init_detection
+            self.detector = init_detection(device = detection_device, quantize = detection_quantize)
         self.logger.info("done")
 
     def submit(self, agents, logger, eval_episodes):
@@ -41,7 +55,6 @@ class Challenge:
         start = time.time()
         results = {}
         for i, episode in enumerate(eval_episodes):
-            start_time = time.time()
             if os.path.exists(os.path.join(self.output_dir, str(episode), 'result_episode.json')):
                 with open(os.path.join(self.output_dir, str(episode), 'result_episode.json'), 'r') as f:
                     result = json.load(f)
@@ -50,67 +63,115 @@ class Challenge:
                 continue
             # The episode has been evaluated before
 
-            if not os.path.exists(os.path.join(self.output_dir, str(episode))):
-                os.makedirs(os.path.join(self.output_dir, str(episode)))
             self.logger.info('Episode {} ({}/{})'.format(episode, i + 1, num_eval_episodes))
-            self.logger.info(f"Resetting Environment ... data is {self.data[episode]}")
-            state, info, env_api = self.env.reset(seed=self.data[episode]['seed'], options=self.data[episode], output_dir = os.path.join(self.output_dir, str(episode)))
-            for id, agent in enumerate(agents):
-                if type(env_api) == list:
-                    curr_api = env_api[id]
-                else: curr_api = env_api
-                if info['goal_description'] is not None:
-                    if agent.agent_type == 'h_agent':
-                        agent.reset(goal_objects = info['goal_description'], output_dir = os.path.join(self.output_dir, str(episode)), env_api = curr_api, agent_color = info['agent_colors'][id], agent_id = id, gt_mask = self.gt_mask, save_img = self.save_img)
-                    elif agent.agent_type == 'lm_agent':
-                        agent.reset(obs = state[str(id)], goal_objects = info['goal_description'], output_dir = os.path.join(self.output_dir, str(episode)), env_api = curr_api, agent_color = info['agent_colors'][id], agent_id = id, rooms_name=info['rooms_name'], gt_mask = self.gt_mask, save_img = self.save_img)
-                    else:
-                        raise Exception(f"{agent.agent_type} not available")
-                else:
-                    agent.reset(output_dir = os.path.join(self.output_dir, str(episode)))
-            self.logger.info(f"Environment Reset. Took {time.time() - start_time} secs")
-            local_finish = self.env.check_goal()
-            done = False
-            step_num = 0
-            local_reward = 0.0
-            while not done:
-                step_num += 1
-                actions = {}
-                if self.save_img: self.env.save_images(os.path.join(self.output_dir, str(episode), 'Images'))
-                for agent_id, agent in enumerate(agents):
-                    actions[str(agent_id)] = agent.act(state[str(agent_id)])
-                state, reward, done, info = self.env.step(actions)
-                local_reward += reward
-                local_finish = self.env.check_goal()
-                self.logger.info(f"Executing step {step_num} for episode: {episode}, actions: {actions}, finish: {local_finish}, frame: {self.env.num_frames}")
-                if done:
-                    break
-            total_finish += local_finish[0] / local_finish[1]
-            result = {
-                "finish": local_finish[0],
-                "total": local_finish[1],
-            }
-            with open(os.path.join(self.output_dir, str(episode), 'result_episode.json'), 'w') as f:
-                json.dump(result, f)
+            result = self.evaluate_episode(agents, episode)
+            total_finish += result['finish'] / result['total']
             results[episode] = result
         avg_finish = total_finish / num_eval_episodes
-        results = {
-            "episode_results": results,
-            "avg_finish": avg_finish
-        }
-        with open(os.path.join(self.output_dir, 'eval_result.json'), 'w') as f:
-            json.dump(results, f, indent=4)
+        write_eval_result(self.output_dir, results, avg_finish)
         self.logger.info(f'eval done, avg transport rate {avg_finish}')
         self.logger.info('time: {}'.format(time.time() - start))
         return avg_finish
 
+    def evaluate_episode(self, agents, episode):
+        r'''
+        Run a single episode and save its result_episode.json
+        '''
+        start_time = time.time()
+        if not os.path.exists(os.path.join(self.output_dir, str(episode))):
+            os.makedirs(os.path.join(self.output_dir, str(episode)))
+        self.logger.info(f"Resetting Environment ... data is {self.data[episode]}")
+        state, info, env_api = self.env.reset(seed=self.data[episode]['seed'], options=self.data[episode], output_dir = os.path.join(self.output_dir, str(episode)))
+        for id, agent in enumerate(agents):
+            if type(env_api) == list:
+                curr_api = env_api[id]
+            else: curr_api = env_api
+            if info['goal_description'] is not None:
+                if agent.agent_type == 'h_agent':
+                    agent.reset(goal_objects = info['goal_description'], output_dir = os.path.join(self.output_dir, str(episode)), env_api = curr_api, agent_color = info['agent_colors'][id], agent_id = id, gt_mask = self.gt_mask, save_img = self.save_img)
+                elif agent.agent_type == 'lm_agent':
+                    agent.reset(obs = state[str(id)], goal_objects = info['goal_description'], output_dir = os.path.join(self.output_dir, str(episode)), env_api = curr_api, agent_color = info['agent_colors'][id], agent_id = id, rooms_name=info['rooms_name'], gt_mask = self.gt_mask, save_img = self.save_img)
+                else:
+                    raise Exception(f"{agent.agent_type} not available")
+            else:
+                agent.reset(output_dir = os.path.join(self.output_dir, str(episode)))
+        self.logger.info(f"Environment Reset. Took {time.time() - start_time} secs")
+        local_finish = self.env.check_goal()
+        done = False
+        step_num = 0
+        local_reward = 0.0
+        episode_start = time.time()
+        act_time = 0.0
+        env_time = 0.0
+        while not done:
+            step_num += 1
+            act_start = time.time()
+            actions = self.get_actions(agents, state, os.path.join(self.output_dir, str(episode), 'Images'))
+            env_start = time.time()
+            act_time += env_start - act_start
+            state, reward, done, info = self.env.step(actions)
+            env_time += time.time() - env_start
+            local_reward += reward
+            local_finish = self.env.check_goal()
+            self.logger.info(f"Executing step {step_num} for episode: {episode}, actions: {actions}, finish: {local_finish}, frame: {self.env.num_frames}")
+            if done:
+                break
+        self.logger.info(f"Episode {episode} done. Took {time.time() - episode_start} secs, agents: {act_time} secs, env: {env_time} secs, fps: {info['fps']}")
+        result = {
+            "finish": local_finish[0],
+            "total": local_finish[1],
+        }
+        with open(os.path.join(self.output_dir, str(episode), 'result_episode.json'), 'w') as f:
+            json.dump(result, f)
+        run = os.path.basename(self.output_dir)
+        for agent in agents:
+            if hasattr(agent, 'llm_calls'):
+                self.results_store.append_llm_calls(run, episode, agent.agent_names[agent.agent_id], agent.llm_calls)
+        self.results_store.append_episode(run, episode, result, frames = self.env.num_frames, seconds = time.time() - episode_start)
+        return result
+
+    def get_actions(self, agents, state, image_dir):
+        r'''
+        Get the actions of all agents for the current step, and save the images of the step if needed
+        '''
+        if self.detector is not None:
+            # the agents find the result of their frame when they detect
+            for agent_id in range(len(agents)):
+                self.detector.submit(state[str(agent_id)]['rgb'].transpose(1, 2, 0)[..., [2, 1, 0]])
+        if self.agent_pool is None:
+            if self.save_img: self.env.save_images(image_dir)
+            return {str(agent_id): agent.act(state[str(agent_id)]) for agent_id, agent in enumerate(agents)}
+        # agents with an ongoing action only update their memory, so they act in this thread while the others are deciding
+        futures = {}
+        for agent_id, agent in enumerate(agents):
+            if state[str(agent_id)]['status'] != 0:
+                futures[str(agent_id)] = self.agent_pool.submit(agent.act, state[str(agent_id)])
+        if self.save_img: self.env.save_images(image_dir)
+        actions = {}
+        for agent_id, agent in enumerate(agents):
+            if str(agent_id) not in futures:
+                actions[str(agent_id)] = agent.act(state[str(agent_id)])
+        for agent_id in futures:
+            actions[agent_id] = futures[agent_id].result()
+        return {str(agent_id): actions[str(agent_id)] for agent_id in range(len(agents))}
+
     def close(self):
+        if self.agent_pool is not None:
+            self.agent_pool.shutdown()
         self.env.close()
 
-def init_logs(output_dir, name = 'simple_example'):
+def write_eval_result(output_dir, results, avg_finish):
+    results = {
+        "episode_results": results,
+        "avg_finish": avg_finish
+    }
+    with open(os.path.join(output_dir, 'eval_result.json'), 'w') as f:
+        json.dump(results, f, indent=4)
+
+def init_logs(output_dir, name = 'simple_example', log_name = 'output.log'):
     logger = logging.getLogger(name)
     logger.setLevel(logging.DEBUG)
-    fh = logging.FileHandler(os.path.join(output_dir, "output.log"))
+    fh = logging.FileHandler(os.path.join(output_dir, log_name))
     fh.setLevel(logging.DEBUG)
     ch = logging.StreamHandler()
     ch.setLevel(logging.INFO)
@@ -123,7 +184,7 @@ def init_logs(output_dir, name = 'simple_example'):
     return logger
 
 
-def main():
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--output_dir", type=str, default="results")
     parser.add_argument("--experiment_name", type = str, default = "try")
@@ -155,17 +216,28 @@ def main():
     parser.add_argument("--echo", action='store_true', help="to include prompt in the outputs")
     parser.add_argument("--screen_size", default=512, type=int)
     parser.add_argument("--no_save_img", action='store_true', help="do not save images", default=False)
-    args = parser.parse_args()
+    parser.add_argument("--async_agents", action='store_true', help="let agents that need a new decision act in parallel threads. Agents sharing the global random state (h_agent) are no longer deterministic", default=False)
+    parser.add_argument("--fast_forward", action='store_true', help="do not render the agents' cameras while both agents are navigating. One extra frame is needed to capture the observation when such an action ends", default=False)
+    parser.add_argument("--image_capture_interval", default=1, type=int, help="save a top down image every n frames")
+    parser.add_argument("--save_img_interval", default=1, type=int, help="save the images of the agents and their maps every n frames")
+    parser.add_argument("--image_queue_size", default=64, type=int, help="images waiting to be written in the background before saving blocks the episode")
+    parser.add_argument("--detection_device", type=str, default=None, help="device of the detection model with --no_gt_mask, cuda if available by default")
+    parser.add_argument("--detection_quantize", action='store_true', help="with --no_gt_mask on cpu, quantize the linear layers of the detection model to int8", default=False)
+    parser.add_argument("--warm_reset", action='store_true', help="keep the build alive between episodes instead of relaunching it, the occupancy map, scene regions and segmentation colors of a scene are computed once per build", default=False)
+    return parser
 
+def setup_output_dir(args):
     args.number_of_agents = len(args.agents)
     os.makedirs(args.output_dir, exist_ok = True)
     args.output_dir = os.path.join(args.output_dir, args.experiment_name)
     os.makedirs(args.output_dir, exist_ok = True)
     args.output_dir = os.path.join(args.output_dir, args.run_id)
     os.makedirs(args.output_dir, exist_ok = True)
-    logger = init_logs(args.output_dir)
 
-    challenge = Challenge(logger, args.port, args.data_path, args.output_dir, args.number_of_agents, args.max_frames, not args.no_launch_build, screen_size = args.screen_size, data_prefix=args.data_prefix, gt_mask = not args.no_gt_mask, save_img = not args.no_save_img)
+def build_challenge(args, logger, port):
+    return Challenge(logger, port, args.data_path, args.output_dir, args.number_of_agents, args.max_frames, not args.no_launch_build, screen_size = args.screen_size, data_prefix=args.data_prefix, gt_mask = not args.no_gt_mask, save_img = not args.no_save_img, async_agents = args.async_agents, fast_forward = args.fast_forward, image_capture_interval = args.image_capture_interval, warm_reset = args.warm_reset, detection_device = args.detection_device, detection_quantize = args.detection_quantize, save_img_interval = args.save_img_interval, image_queue_size = args.image_queue_size)
+
+def build_agents(args, logger):
     agents = []
     for i, agent in enumerate(args.agents):
         if agent == 'h_agent':
@@ -174,6 +246,15 @@ def main():
             agents.append(lm_agent(i, logger, args.max_frames, args, args.output_dir))
         else:
             pass
+    return agents
+
+def main():
+    args = get_parser().parse_args()
+    setup_output_dir(args)
+    logger = init_logs(args.output_dir)
+
+    challenge = build_challenge(args, logger, args.port)
+    agents = build_agents(args, logger)
     try:
         challenge.submit(agents, logger, args.eval_episodes)
     finally:
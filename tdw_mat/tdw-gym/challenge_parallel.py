@@ -0,0 +1,198 @@
+"""
+Evaluate the episodes of a challenge with several TDW builds at the same time.
+Each worker owns one build on its own port (port, port + 1, ...) and asks the driver for the next episode whenever it is idle,
+so fast workers take over the episodes that slow workers have not reached yet.
+A worker that raises an exception relaunches its build before the next episode, a worker process that dies is respawned on the same port
+once its build is killed, and the failed episode is queued again up to max_retries times.
+With --no_gt_mask and --detection_server, one process runs the detection model for all workers and batches their frames. It is restarted if it dies,
+up to max_retries times, and the episodes waiting for it time out and are retried.
+"""
+
+import os
+import json
+import time
+import queue
+import traceback
+import multiprocessing as mp
+
+from challenge import get_parser, setup_output_dir, build_challenge, build_agents, init_logs, write_eval_result
+
+def kill_build(port):
+    os.system(f"ps ux | grep TDW.x86_64\\ -port\\ {port} | awk {{'print $2'}} | xargs kill")
+
+def worker(worker_id, port, args, task_queue, event_queue, detection_queues = None):
+    logger = init_logs(args.output_dir, name = f'worker_{worker_id}', log_name = f'output_worker{worker_id}.log')
+    if detection_queues is not None:
+        from detection import DetectionClient, set_detection_client
+        set_detection_client(DetectionClient(worker_id, *detection_queues))
+    challenge = None
+    agents = None
+    while True:
+        episode = task_queue.get()
+        if episode is None:
+            break
+        try:
+            if challenge is None:
+                challenge = build_challenge(args, logger, port)
+                agents = build_agents(args, logger)
+            logger.info(f'Episode {episode} (worker {worker_id}, port {port})')
+            challenge.evaluate_episode(agents, episode)
+            event_queue.put(('done', worker_id, episode))
+        except Exception:
+            logger.error(f'Episode {episode} failed on worker {worker_id}:\n{traceback.format_exc()}')
+            # relaunch the build before the next episode
+            if challenge is not None:
+                try:
+                    challenge.close()
+                except Exception:
+                    pass
+            challenge = None
+            event_queue.put(('failed', worker_id, episode))
+    if challenge is not None:
+        challenge.close()
+
+def result_path(output_dir, episode):
+    return os.path.join(output_dir, str(episode), 'result_episode.json')
+
+def merge_results(output_dir, eval_episodes):
+    r'''
+    Merge result_episode.json files into eval_result.json, the same way as Challenge.submit
+    '''
+    total_finish = 0.0
+    results = {}
+    for episode in eval_episodes:
+        if not os.path.exists(result_path(output_dir, episode)):
+            continue
+        with open(result_path(output_dir, episode), 'r') as f:
+            result = json.load(f)
+        total_finish += result['finish'] / result['total']
+        results[episode] = result
+    avg_finish = total_finish / len(eval_episodes)
+    write_eval_result(output_dir, results, avg_finish)
+    return avg_finish
+
+def submit_parallel(args, logger):
+    if args.eval_episodes[0] == -1:
+        with open(os.path.join(args.data_prefix, args.data_path), 'r') as f:
+            eval_episodes = list(range(len(json.load(f))))
+    else:
+        eval_episodes = list(args.eval_episodes)
+    # The episode has been evaluated before
+    pending = [episode for episode in eval_episodes if not os.path.exists(result_path(args.output_dir, episode))]
+    logger.info(f'{len(eval_episodes) - len(pending)} episodes done before, {len(pending)} episodes to evaluate with {args.num_workers} workers')
+
+    start = time.time()
+    ctx = mp.get_context('spawn')
+    event_queue = ctx.Queue()
+    task_queues = {}
+    workers = {}
+    assigned = {}
+    retries = {episode: 0 for episode in pending}
+    server = None
+    detection_queues = {}
+    if args.no_gt_mask and args.detection_server:
+        from detection import detection_server
+        request_queue = ctx.Queue()
+        detection_queues = {worker_id: (request_queue, ctx.Queue()) for worker_id in range(args.num_workers)}
+    server_restarts = 0
+
+    def start_server():
+        process = ctx.Process(target = detection_server, args = (request_queue, {worker_id: x[1] for worker_id, x in detection_queues.items()}), kwargs = {'device': args.detection_device, 'quantize': args.detection_quantize}, daemon = True)
+        process.start()
+        return process
+
+    if len(detection_queues) > 0:
+        server = start_server()
+
+    def spawn(worker_id):
+        task_queues[worker_id] = ctx.Queue()
+        workers[worker_id] = ctx.Process(target = worker, args = (worker_id, args.port + worker_id, args, task_queues[worker_id], event_queue, detection_queues.get(worker_id)), daemon = True)
+        workers[worker_id].start()
+        assigned[worker_id] = None
+
+    def retry(episode):
+        retries[episode] += 1
+        if retries[episode] > args.max_retries:
+            logger.error(f'Episode {episode} failed {retries[episode]} times, giving up')
+            remaining.discard(episode)
+        else:
+            pending.append(episode)
+
+    def handle(event, worker_id, episode):
+        # an event of a dead worker can come after its episode was handed to its replacement
+        if assigned.get(worker_id) == episode:
+            assigned[worker_id] = None
+        if episode not in remaining:
+            return
+        if event == 'done':
+            remaining.discard(episode)
+            logger.info(f'Episode {episode} finished on worker {worker_id}, {len(remaining)} left, time: {time.time() - start}')
+        else:
+            retry(episode)
+
+    for worker_id in range(min(args.num_workers, len(pending))):
+        spawn(worker_id)
+    remaining = set(pending)
+    while len(remaining) > 0:
+        # hand out episodes to idle workers
+        for worker_id in workers:
+            if assigned[worker_id] is None and len(pending) > 0:
+                assigned[worker_id] = pending.pop(0)
+                task_queues[worker_id].put(assigned[worker_id])
+        try:
+            handle(*event_queue.get(timeout = 5))
+        except queue.Empty:
+            pass
+        if server is not None and not server.is_alive():
+            # the requests it had are lost, the workers waiting for them time out and their episodes are retried
+            server_restarts += 1
+            if server_restarts > args.max_retries:
+                for worker_id in workers:
+                    workers[worker_id].terminate()
+                    if not args.no_launch_build:
+                        kill_build(args.port + worker_id)
+                raise RuntimeError(f'the detection server exited with code {server.exitcode} {server_restarts} times, giving up')
+            logger.error(f'The detection server exited with code {server.exitcode}, restarting it')
+            server = start_server()
+        dead = [worker_id for worker_id in workers if not workers[worker_id].is_alive()]
+        if len(dead) > 0:
+            # the events a dead worker sent before it exited, so that an episode it finished is not run again
+            while True:
+                try:
+                    handle(*event_queue.get(timeout = 1))
+                except queue.Empty:
+                    break
+        for worker_id in dead:
+            logger.error(f'Worker {worker_id} exited with code {workers[worker_id].exitcode}, restarting it')
+            if assigned[worker_id] is not None:
+                retry(assigned[worker_id])
+            if not args.no_launch_build:
+                # the build of the dead worker might still hold its port
+                kill_build(args.port + worker_id)
+            spawn(worker_id)
+
+    for worker_id in workers:
+        task_queues[worker_id].put(None)
+    for worker_id in workers:
+        workers[worker_id].join()
+    if server is not None:
+        request_queue.put(None)
+        server.join()
+
+    avg_finish = merge_results(args.output_dir, eval_episodes)
+    logger.info(f'eval done, avg transport rate {avg_finish}')
+    logger.info('time: {}'.format(time.time() - start))
+    return avg_finish
+
+def main():
+    parser = get_parser()
+    parser.add_argument("--num_workers", default=2, type=int, help="number of TDW builds running at the same time, on ports port, port + 1, ...")
+    parser.add_argument("--max_retries", default=2, type=int, help="times to rerun an episode whose worker failed")
+    parser.add_argument("--detection_server", action='store_true', help="with --no_gt_mask, run the detection model in one process that batches the frames of all workers", default=False)
+    args = parser.parse_args()
+    setup_output_dir(args)
+    logger = init_logs(args.output_dir)
+    submit_parallel(args, logger)
+
+if __name__ == "__main__":
+    main()
@@ -3,40 +3,67 @@ from pycocotools import mask
 import cv2
 import numpy as np
 import os
+import time
+import queue
+import hashlib
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 os.environ['KMP_DUPLICATE_LIB_OK']="TRUE"
 detector = None
+
+NAME_MAP = {
+    0:    'b04_bowl_smooth',
+    1:    'plate06',
+    2:    'teatray',
+    3:    'basket_18inx18inx12iin_plastic_lattice',
+    4:    'basket_18inx18inx12iin_wicker',
+    5:    'basket_18inx18inx12iin_wood_mesh',
+    6:    'bread',
+    7:    'b03_burger',
+    8:    'b03_loafbread',
+    9:    'apple',
+    10:    'b04_banana',
+    11:    'b04_orange_00',
+    12:    'f10_apple_iphone_4',
+    13:    'b05_executive_pen',
+    14:    'key_brass',
+    15:    'apple_ipod_touch_yellow_vray',
+    16:    'b04_lighter',
+    17:    'small_purse',
+    18:    'b05_calculator',
+    19:    'pencil_all',
+    20:    'mouse_02_vray',
+    21:    'bed',
+}
+
+
+def decode_masks(result, indices):
+    r'''
+    The (H, W, len(indices)) binary masks of some detections of a detect_batch result, each one whole even where the detections overlap
+    '''
+    if len(indices) == 0:
+        return np.zeros(result['shape'] + (0,), dtype = np.uint8)
+    return mask.decode([result['masks'][i] for i in indices]).reshape(result['shape'] + (len(indices),))
+
 class tdw_detection:
-    def __init__(self):
+    def __init__(self, device = None, quantize = False):
+        r'''
+        device: 'cuda' or 'cpu', by default the TDW_DETECTION_DEVICE environment variable, else cuda if it is available
+        quantize: on cpu, run the linear layers of the model (the box and mask heads) with dynamic int8 quantization
+        '''
+        import torch
+        if device is None:
+            device = os.environ.get('TDW_DETECTION_DEVICE', 'cuda' if torch.cuda.is_available() else 'cpu')
+        self.device = device
         self.inferencer = DetInferencer(
             model = "detection_pipeline/config.py",
             weights = "detection_pipeline/epoch_1.pth",
-            device = "cuda"
+            device = device
         )
+        if quantize and device == 'cpu':
+            self.inferencer.model = torch.ao.quantization.quantize_dynamic(self.inferencer.model, {torch.nn.Linear}, dtype = torch.qint8)
 
-        self.name_map = {
-            0:    'b04_bowl_smooth',
-            1:    'plate06',
-            2:    'teatray',
-            3:    'basket_18inx18inx12iin_plastic_lattice',
-            4:    'basket_18inx18inx12iin_wicker',
-            5:    'basket_18inx18inx12iin_wood_mesh',
-            6:    'bread',
-            7:    'b03_burger',
-            8:    'b03_loafbread',
-            9:    'apple',
-            10:    'b04_banana',
-            11:    'b04_orange_00',
-            12:    'f10_apple_iphone_4',
-            13:    'b05_executive_pen',
-            14:    'key_brass',
-            15:    'apple_ipod_touch_yellow_vray',
-            16:    'b04_lighter',
-            17:    'small_purse',
-            18:    'b05_calculator',
-            19:    'pencil_all',
-            20:    'mouse_02_vray',
-            21:    'bed',
-        }
+        self.name_map = NAME_MAP
 
     def cls_to_name_map(self, cls_id):
         return self.name_map[cls_id]
@@ -52,10 +79,174 @@ class tdw_detection:
             result['predictions'][0]['masks'] = mask_format
         return result
 
-def init_detection():
+    def detect_batch(self, imgs):
+        r'''
+        Detect the objects of several BGR frames with one forward pass
+        return: for each frame, a dict with the 'labels', 'scores' and 'names' of the detections, their masks still in RLE (see decode_masks),
+        which keeps the results small to pass between processes, and the 'shape' of the frame
+        '''
+        predictions = self.inferencer(list(imgs), batch_size = len(imgs), no_save_pred = True, out_dir = '')['predictions']
+        results = []
+        for img, prediction in zip(imgs, predictions):
+            labels = [int(x) for x in prediction['labels']]
+            results.append({
+                'labels': labels,
+                'scores': [float(x) for x in prediction['scores']],
+                'names': [self.cls_to_name_map(x) for x in labels],
+                'masks': prediction['masks'],
+                'shape': tuple(img.shape[:2]),
+            })
+        return results
+
+def frame_key(img):
+    return hashlib.blake2b(np.ascontiguousarray(img).data, digest_size = 16).digest()
+
+class DetectionService:
+    r'''
+    Batches the frames of the agents of a process: a frame submitted while the model is busy waits for the next batch, up to max_batch_size frames.
+    Submitting a frame that is already pending or was just detected returns the same result, so the challenge can submit the frames of all agents
+    before the agents act (they submit them again in detect) and the agents of one step share one forward pass.
+    '''
+    def __init__(self, detector, max_batch_size = 8, max_wait = 0.005):
+        self.detector = detector
+        self.max_batch_size = max_batch_size
+        # time to wait for more frames after the first one of a batch, in seconds
+        self.max_wait = max_wait
+        self.lock = threading.Lock()
+        self.pending = queue.Queue()
+        # frame key -> Future, of the frames pending or in the last batches
+        self.futures = {}
+        self.recent = []
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+    def cls_to_name_map(self, cls_id):
+        return self.detector.cls_to_name_map(cls_id)
+
+    def submit(self, img):
+        key = frame_key(img)
+        with self.lock:
+            if key in self.futures:
+                return self.futures[key]
+            future = Future()
+            self.futures[key] = future
+        self.pending.put((key, img, future))
+        return future
+
+    def detect(self, img):
+        return self.submit(img).result()
+
+    def _run(self):
+        while True:
+            batch = [self.pending.get()]
+            deadline = time.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self.pending.get(timeout = max(deadline - time.time(), 0)))
+                except queue.Empty:
+                    break
+            try:
+                results = self.detector.detect_batch([img for _, img, _ in batch])
+                for (_, _, future), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+            with self.lock:
+                # keep the futures of the last batches for the agents that have not asked yet
+                self.recent.extend(key for key, _, _ in batch)
+                while len(self.recent) > 4 * self.max_batch_size:
+                    self.futures.pop(self.recent.pop(0), None)
+
+def detection_server(request_queue, response_queues, max_batch_size = 16, max_wait = 0.01, device = None, quantize = False):
+    r'''
+    The process of a detection model shared by the workers of challenge_parallel. Requests are (worker_id, request_id, frame), the result of a request is put
+    in response_queues[worker_id] as (request_id, result), request_id is only passed back. Frames from all workers are batched, a None request stops the server.
+    '''
+    service = DetectionService(tdw_detection(device = device, quantize = quantize), max_batch_size = max_batch_size, max_wait = max_wait)
+    while True:
+        request = request_queue.get()
+        if request is None:
+            break
+        worker_id, request_id, img = request
+        service.submit(img).add_done_callback(lambda future, worker_id = worker_id, request_id = request_id:
+            response_queues[worker_id].put((request_id, future.result() if future.exception() is None else future.exception())))
+
+class DetectionClient:
+    r'''
+    The DetectionService interface of a worker process, backed by detection_server.
+    A respawned worker gets the response queue of the dead one, so the request ids carry a nonce of the client and the responses to the requests
+    of a former client are dropped. detect raises a TimeoutError after timeout seconds without a response (e.g. the server died), which fails the episode.
+    '''
+    def __init__(self, worker_id, request_queue, response_queue, timeout = 600):
+        self.worker_id = worker_id
+        self.timeout = timeout
+        self.request_queue = request_queue
+        self.response_queue = response_queue
+        self.lock = threading.Lock()
+        # frame key -> Future of the last frames, request id -> Future of the requests without a response
+        self.futures = {}
+        self.waiting = {}
+        self.nonce = os.urandom(8).hex()
+        self.next_id = 0
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+    def cls_to_name_map(self, cls_id):
+        return NAME_MAP[cls_id]
+
+    def submit(self, img):
+        key = frame_key(img)
+        with self.lock:
+            if key in self.futures:
+                return self.futures[key]
+            request_id = (self.nonce, self.next_id)
+            self.next_id += 1
+            future = Future()
+            self.futures[key] = future
+            self.waiting[request_id] = future
+            # only the frames of the current step are asked again
+            for old_key in list(self.futures.keys())[:-16]:
+                del self.futures[old_key]
+        self.request_queue.put((self.worker_id, request_id, img))
+        return future
+
+    def detect(self, img):
+        future = self.submit(img)
+        try:
+            return future.result(timeout = self.timeout)
+        except FutureTimeoutError:
+            # the frame is asked again next time
+            with self.lock:
+                self.futures = {key: x for key, x in self.futures.items() if x is not future}
+            raise TimeoutError(f'no detection result from the detection server in {self.timeout} seconds')
+
+    def _run(self):
+        while True:
+            request_id, result = self.response_queue.get()
+            with self.lock:
+                future = self.waiting.pop(request_id, None)
+            if future is None:
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+def set_detection_client(client):
+    r'''
+    Use a detection_server (through a DetectionClient) instead of a model of this process
+    '''
+    global detector
+    detector = client
+
+def init_detection(device = None, quantize = False):
+    r'''
+    The detection service of this process, created by the first call
+    '''
     global detector
     if detector == None:
-        detector = tdw_detection()
+        detector = DetectionService(tdw_detection(device = device, quantize = quantize))
     return detector
 
 from PIL import Image
@@ -69,6 +260,6 @@ def main():
     result = tdw(img, decode = True)
     print(result)
     print(result['predictions'][0]['masks'].shape)
-    
+
 if __name__ == '__main__':
     main()
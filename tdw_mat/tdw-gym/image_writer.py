@@ -0,0 +1,134 @@
+"""
+Debug images written in the background, so saving them does not hold up the episode.
+The images of the env (agent views, top down captures) and the maps of the agents go through the image writer of the process: encoding and
+writing happen in a thread fed by a bounded queue, and each stream of images can be decimated to one image every frame_interval frames.
+"""
+
+import atexit
+import os
+import queue
+import threading
+import traceback
+import cv2
+import numpy as np
+
+# colors of the object map values in render_map, BGR as written by cv2: 1 target, 2 container, 3 goal
+MAP_OBJECT_COLORS = np.array([[0, 0, 0], [255, 0, 0], [0, 255, 0], [0, 0, 255]], dtype = np.uint8)
+
+def render_map(occupancy_map, known_map, wall_map, object_map, marks = ()):
+    r'''
+    Render the map of an agent as a BGR image: occupied cells are gray 100, unknown cells 50, walls 150, objects with MAP_OBJECT_COLORS,
+    marks are ((x, z), color) cells drawn last. The image is rotated 90 degrees anti-clockwise.
+    '''
+    gray = np.zeros(occupancy_map.shape, dtype = np.uint8)
+    gray[occupancy_map > 0] = 100
+    gray[known_map == 0] = 50
+    gray[wall_map > 0] = 150
+    draw_map = np.repeat(gray[..., None], 3, axis = 2)
+    objects = (object_map >= 1) & (object_map < len(MAP_OBJECT_COLORS))
+    draw_map[objects] = MAP_OBJECT_COLORS[object_map[objects].astype(np.int64)]
+    for cell, color in marks:
+        draw_map[cell] = color
+    return np.ascontiguousarray(np.rot90(draw_map, 1))
+
+class ImageWriter:
+    def __init__(self, max_queue_size = 64, frame_interval = 1, drop_when_full = False):
+        r'''
+        max_queue_size: images waiting to be written, when the queue is full save blocks, or drops the image if drop_when_full
+        frame_interval: keep returns True for one frame every frame_interval frames of a stream
+        '''
+        self.frame_interval = max(int(frame_interval), 1)
+        self.drop_when_full = drop_when_full
+        self.queue = queue.Queue(maxsize = max_queue_size)
+        # stream -> frames seen, for the decimation
+        self.frames = {}
+        self.num_dropped = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    break
+                fn, args, kwargs = job
+                fn(*args, **kwargs)
+            except Exception:
+                # a debug image is not worth the episode
+                traceback.print_exc()
+            finally:
+                self.queue.task_done()
+
+    def keep(self, stream):
+        r'''
+        Whether to save the current frame of a stream (e.g. the map of an agent), call it once per frame
+        '''
+        with self.lock:
+            frame = self.frames.get(stream, 0)
+            self.frames[stream] = frame + 1
+        return frame % self.frame_interval == 0
+
+    def submit(self, fn, *args, **kwargs):
+        r'''
+        Run fn(*args, **kwargs) in the writer thread, the arguments must not be modified afterwards
+        '''
+        if self.drop_when_full:
+            try:
+                self.queue.put_nowait((fn, args, kwargs))
+            except queue.Full:
+                self.num_dropped += 1
+        else:
+            self.queue.put((fn, args, kwargs))
+
+    def save(self, path, image):
+        r'''
+        Write a BGR array with cv2 or a PIL image, the directory is created if needed
+        '''
+        self.submit(_save_image, path, image)
+
+    def flush(self):
+        r'''
+        Wait until the submitted images are written
+        '''
+        self.queue.join()
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+
+def _save_image(path, image):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok = True)
+    if isinstance(image, np.ndarray):
+        cv2.imwrite(path, image)
+    else:
+        image.save(path)
+
+writer = None
+
+def init_image_writer(max_queue_size = 64, frame_interval = 1, drop_when_full = False):
+    r'''
+    Configure the image writer of this process, the images already submitted to the previous one are written first
+    '''
+    global writer
+    if writer is not None:
+        writer.close()
+    writer = ImageWriter(max_queue_size = max_queue_size, frame_interval = frame_interval, drop_when_full = drop_when_full)
+    return writer
+
+def get_image_writer():
+    r'''
+    The image writer of this process, created with the default settings by the first call if init_image_writer was not called
+    '''
+    global writer
+    if writer is None:
+        writer = ImageWriter()
+    return writer
+
+@atexit.register
+def _flush_at_exit():
+    # the writer thread is a daemon, write what is left before the interpreter stops
+    if writer is not None:
+        writer.flush()
@@ -8,6 +8,7 @@ import time
 import math
 import copy
 from PIL import Image
+from image_writer import get_image_writer, render_map
 
 from LLM.LLM import LLM
 
@@ -446,6 +447,8 @@ class lm_agent:
         # print(self.rooms_name)
         self.LLM.reset(self.rooms_name, self.goal_objects)
         self.save_img = save_img
+        # the LLM calls of the episode, added to the results store by the challenge
+        self.llm_calls = []
 
     def move(self, target_pos):
         self.local_step += 1
@@ -469,25 +472,16 @@ class lm_agent:
         return action
 
     def draw_map(self, previous_name):
-        draw_map = np.zeros((self.map_size[0], self.map_size[1], 3))
-        for i in range(self.map_size[0]):
-            for j in range(self.map_size[1]):
-                if self.occupancy_map[i, j] > 0:
-                    draw_map[i, j] = 100
-                if self.known_map[i, j] == 0:
-                #    assert self.occupancy_map[i, j] == 0
-                    draw_map[i, j] = 50
-                if self.wall_map[i, j] > 0:
-                    draw_map[i, j] = 150
-        draw_map[np.where(self.object_map == 1)] = [255, 0, 0]
-        draw_map[np.where(self.object_map == 2)] = [0, 255, 0]
-        draw_map[np.where(self.object_map == 3)] = [0, 0, 255]
+        image_writer = get_image_writer()
+        if not image_writer.keep(f'map_{self.agent_id}'):
+            return
+        marks = []
         if self.oppo_pos is not None:
-            draw_map[self.pos2map(self.oppo_pos[0], self.oppo_pos[2])] = [0, 255, 255]
-        draw_map[self.pos2map(self.obs["agent"][0], self.obs["agent"][2])] = [255, 255, 0]
+            marks.append((self.pos2map(self.oppo_pos[0], self.oppo_pos[2]), [0, 255, 255]))
+        marks.append((self.pos2map(self.obs["agent"][0], self.obs["agent"][2]), [255, 255, 0]))
         #rotate the map 90 degrees anti-clockwise
-        draw_map = np.rot90(draw_map, 1)
-        cv2.imwrite(previous_name + '_map.png', draw_map)
+        draw_map = render_map(self.occupancy_map, self.known_map, self.wall_map, self.object_map, marks)
+        image_writer.save(previous_name + '_map.png', draw_map)
         #cv2.imwrite(previous_name + '_seg_map.png', self.obs['seg_mask'])
 
     def gotoroom(self):
@@ -580,15 +574,18 @@ class lm_agent:
         return action
     
     def detect(self):
-        detect_result = self.detection_model(self.obs['rgb'][..., [2, 1, 0]])['predictions'][0]
+        from detection import decode_masks
+        # batched with the frames of the other agents by the detection service
+        detect_result = self.detection_model.detect(self.obs['rgb'][..., [2, 1, 0]])
         obj_infos = []
         curr_seg_mask = np.zeros((self.obs['rgb'].shape[0], self.obs['rgb'].shape[1], 3)).astype(np.int32)
         curr_seg_mask.fill(-1)
-        for i in range(len(detect_result['labels'])):
-            if detect_result['scores'][i] < 0.3: continue
-            mask = detect_result['masks'][:,:,i]
-            label = detect_result['labels'][i]
-            curr_info = self.env_api['get_id_from_mask'](mask = mask, name = self.detection_model.cls_to_name_map(label)).copy()
+        kept = [i for i in range(len(detect_result['labels'])) if detect_result['scores'][i] >= 0.3]
+        masks = decode_masks(detect_result, kept)
+        infos = self.env_api['get_ids_from_masks'](masks = masks)
+        for i in range(len(kept)):
+            mask = masks[:, :, i]
+            curr_info = infos[i].copy()
             if curr_info['id'] is not None:
                 obj_infos.append(curr_info)
                 curr_seg_mask[np.where(mask)] = curr_info['seg_color']
@@ -722,6 +719,7 @@ class lm_agent:
                 self.action_history.append(f"{'send a message' if plan.startswith('send a message:') else plan} at step {self.num_frames}")
                 a_info.update({"Frames": self.num_frames})
                 info.update({"LLM": a_info})
+                self.llm_calls.append(a_info)
                 lm_times += 1
             if self.plan.startswith('go to'):
                 action = self.gotoroom()
@@ -12,6 +12,7 @@ from tdw.replicant.arm import Arm
 from tdw.tdw_utils import TDWUtils
 
 from transport_challenge_multi_agent.transport_challenge import TransportChallenge
+from transport_challenge_multi_agent.scene_metadata import load_shared_json
 from collections import Counter
 from tdw.replicant.action_status import ActionStatus
 from tdw.replicant.image_frequency import ImageFrequency
@@ -26,7 +27,10 @@ import json
 import pickle
 from functools import partial
 import signal
+import traceback
 from tenacity import retry, wait_fixed, retry_if_exception_type
+from action_trace import ActionTraceWriter
+from image_writer import get_image_writer
 
 class TimeoutException(Exception):
     pass
@@ -34,6 +38,26 @@ class TimeoutException(Exception):
 def timeout_handler(signum, frame):
     raise TimeoutException("Function execution exceeded the timeout limit")
 
+def pack_colors(colors):
+    r'''
+    Pack RGB colors (an array whose last axis has size 3) into single integers, so that a segmentation image can be handled as a 2D integer array
+    '''
+    colors = np.asarray(colors).astype(np.int32)
+    return (colors[..., 0] << 16) | (colors[..., 1] << 8) | colors[..., 2]
+
+def save_replicant_images(dynamic, save_path, screen_size):
+    r'''
+    Save the rgb, segmentation and depth images of a replicant frame as {save_path}.png, {save_path}_seg.png and {save_path}_depth.png
+    '''
+    os.makedirs(os.path.dirname(save_path), exist_ok=True)
+    img = dynamic.get_pil_image('img')
+    depth = np.flip(np.array(TDWUtils.get_depth_values(dynamic.get_pil_image('depth'), width = screen_size, height = screen_size), dtype = np.float32), 0)
+    depth_img = Image.fromarray(100 / depth).convert('RGB')
+    seg = dynamic.get_pil_image('id')
+    img.save(f'{save_path}.png')
+    seg.save(f'{save_path}_seg.png')
+    depth_img.save(f'{save_path}_depth.png')
+
 @retry(wait=wait_fixed(5), retry=retry_if_exception_type(TimeoutException))  # wait 5 seconds between retries
 def might_fail_launch(launch, port = None):
     if port is not None:
@@ -49,7 +73,8 @@ def might_fail_launch(launch, port = None):
 
 class TDW(Env):
     def __init__(self, port = 1071, number_of_agents = 1, demo=False, rank=0, num_scenes = 0, train=False, \
-                        screen_size = 512, exp = False, launch_build=True, gt_occupancy = False, gt_mask = True, enable_collision_detection = False, save_dir = 'results', max_frames = 3000, data_prefix = 'dataset/nips_dataset/'):
+                        screen_size = 512, exp = False, launch_build=True, gt_occupancy = False, gt_mask = True, enable_collision_detection = False, save_dir = 'results', max_frames = 3000, data_prefix = 'dataset/nips_dataset/', \
+                        fast_forward = False, image_capture_interval = 1, warm_reset = False):
         self.messages = None
         self.data_prefix = data_prefix
         self.replicant_colors = None
@@ -83,6 +108,16 @@ class TDW(Env):
         self.enable_collision_detection = enable_collision_detection
         self.controller = None
         self.message_per_frame = 500
+        # In fast forward mode, the agents' cameras are not rendered while all agents are in the middle of a navigation action
+        self.fast_forward = fast_forward
+        # Save a top down image every image_capture_interval frames
+        self.image_capture_interval = image_capture_interval
+        # In warm reset mode, the build is kept alive between episodes instead of being relaunched by every reset
+        self.warm_reset = warm_reset
+        # (data_prefix, scene, layout) -> segmentation colors, object names and scene bounds of a scene loaded by the current build
+        self.scene_setups = {}
+        self.current_action_type = None
+        self.episode_start_time = None
         rgb_space = gym.spaces.Box(0, 256,
                                  (3,
                                   self.screen_size,
@@ -140,10 +175,16 @@ class TDW(Env):
             str(i): self.observation_space_single for i in range(self.number_of_agents)
         })
         self.max_frame = max_frames
-        self.f = open(f'action{port}.log', 'w')
+        # binary action trace, use action_trace.py to convert it to the text action log
+        self.trace = ActionTraceWriter(f'action{port}.trace')
         self.action_list = []
                     
         self.segmentation_colors = {}
+        # packed segmentation color -> (order, visible object entry), built once per scene in reset
+        self.color_index = {}
+        # per agent, of the last observation: the packed segmentation image, and packed color -> visible object entry
+        self.packed_seg_masks = {}
+        self.visible_by_color = {}
         self.object_names = {}
         self.object_ids = {}
         self.object_categories = {}
@@ -201,13 +242,10 @@ class TDW(Env):
         input:
             data_id: reset based on the data_id
         """
-        # Changes it to always, since in each step, we need to get the image
-        if self.controller is not None:
-            self.controller.communicate({"$type": "terminate"})
-            self.controller.socket.close()
-        # download_asset_bundles()
-        self.controller = might_fail_launch(partial(TransportChallenge, port=self.port, check_version=True, launch_build=self.launch_build, screen_width=self.screen_size,screen_height=self.screen_size, image_frequency= ImageFrequency.always, png=True, image_passes=None, enable_collision_detection = self.enable_collision_detection, logger_dir = output_dir), port = self.port)
-        print("Controller connected")
+        if self.controller is None or not self.warm_reset:
+            self.launch_controller(output_dir)
+        else:
+            self.controller.set_logger_dir(output_dir)
         self.success = False
         self.messages = [None for _ in range(self.number_of_agents)]
         self.reward = 0
@@ -228,8 +266,19 @@ class TDW(Env):
         self.scene_info = scene_info
         
         # Now the scene is fixed, so num_containers and num_target_objects are not used anymore in new settings
-        self.controller.start_floorplan_trial(scene=scene, layout=layout, replicants=self.number_of_agents, num_containers=4, num_target_objects=10,
-                                   random_seed=seed, task = task, data_prefix = self.data_prefix)
+        try:
+            self.controller.start_floorplan_trial(scene=scene, layout=layout, replicants=self.number_of_agents, num_containers=4, num_target_objects=10,
+                                       random_seed=seed, task = task, data_prefix = self.data_prefix)
+        except Exception:
+            if not self.warm_reset:
+                raise
+            # the build that was kept alive is in a bad state, start the trial on a new one
+            traceback.print_exc()
+            print("Warm reset failed, relaunching the build")
+            self.launch_controller(output_dir)
+            self.controller.start_floorplan_trial(scene=scene, layout=layout, replicants=self.number_of_agents, num_containers=4, num_target_objects=10,
+                                       random_seed=seed, task = task, data_prefix = self.data_prefix)
+        scene_key = (self.data_prefix, scene, str(layout))
 
         # Add a gt occupancy map. In the standard setting, we don't need this
         if self.gt_occupancy:
@@ -252,9 +301,13 @@ class TDW(Env):
         self.object_manager = ObjectManager()
         self.controller.add_ons.append(self.object_manager)
 
-        data = self.controller.communicate({"$type": "send_segmentation_colors",
-                          "show": False,
-                          "frequency": "once"})
+        # The objects and their segmentation colors come from the scene file, they are only requested the first time the build loads the scene
+        if scene_key in self.scene_setups:
+            data = self.controller.communicate([])
+        else:
+            data = self.controller.communicate({"$type": "send_segmentation_colors",
+                              "show": False,
+                              "frequency": "once"})
         
         # Show the occupancy map. In the standard setting, we don't need this
         if self.gt_occupancy:            
@@ -265,7 +318,7 @@ class TDW(Env):
 
         # Make name easier to read
         names_mapping_path = f'./dataset/name_map.json'
-        with open(names_mapping_path, 'r') as f: self.names_mapping = json.load(f)
+        self.names_mapping = load_shared_json(names_mapping_path)
 
         self.segmentation_colors = {}
         self.object_names = {}
@@ -274,7 +327,13 @@ class TDW(Env):
         self.target_object_ids = self.controller.state.target_object_ids
         self.container_ids = self.controller.state.container_ids
         self.replicant_ids = [self.controller.replicants[i].static.replicant_id for i in range(self.number_of_agents)]
-        
+        if scene_key in self.scene_setups:
+            scene_setup = self.scene_setups[scene_key]
+            self.segmentation_colors = dict(scene_setup['segmentation_colors'])
+            self.object_names = dict(scene_setup['object_names'])
+            self.object_categories = dict(scene_setup['object_categories'])
+            self.goal_position_id = scene_setup['goal_position_id']
+
         for i in range(len(data) - 1):
             r_id = OutputData.get_data_type_id(data[i])
             if r_id == "segm":
@@ -292,11 +351,12 @@ class TDW(Env):
         self.replicant_colors ={i: self.controller.replicants[i].static.segmentation_color for i in range(self.number_of_agents)}
 
         self.containment_all = {}
+        # the containment_version of ChallengeState read by get_obs and by the trace
+        self.containment_version = 0
+        self.trace_containment_version = 0
         
-        # check colors are different:
-        for x in self.segmentation_colors.keys():
-            for y in self.segmentation_colors.keys():
-                if x != y: assert (self.segmentation_colors[x] != self.segmentation_colors[y]).any()
+        self.build_color_index()
+        self.trace.write_episode(scene_info, self.object_names, self.target_object_ids, self.container_ids)
 
         self.num_step = 0
         self.num_frames = 0
@@ -308,7 +368,7 @@ class TDW(Env):
                 self.goal_description[self.object_names[i]] = 1
 
         room_type_path = f'./dataset/room_types.json'
-        with open(room_type_path, 'r') as f: room_types = json.load(f)
+        room_types = load_shared_json(room_type_path)
         
         self.rooms_name = {}
         #now return <room_type> (id) for each room.        
@@ -323,9 +383,21 @@ class TDW(Env):
 
         self.done = False
         self.action_buffer = [[] for _ in range(self.number_of_agents)]
+        self.current_action_type = [None for _ in range(self.number_of_agents)]
+        self.episode_start_time = time.time()
 
-        resp = self.controller.communicate([{"$type": "send_scene_regions"}])
-        self.scene_bounds = SceneBounds(resp=resp)
+        if scene_key in self.scene_setups:
+            self.scene_bounds = self.scene_setups[scene_key]['scene_bounds']
+        else:
+            resp = self.controller.communicate([{"$type": "send_scene_regions"}])
+            self.scene_bounds = SceneBounds(resp=resp)
+            self.scene_setups[scene_key] = {
+                'segmentation_colors': dict(self.segmentation_colors),
+                'object_names': dict(self.object_names),
+                'object_categories': dict(self.object_categories),
+                'goal_position_id': self.goal_position_id,
+                'scene_bounds': self.scene_bounds,
+            }
         self.all_rooms = [self.rooms_name[i] for i in range(len(self.rooms_name)) if self.rooms_name[i] is not None]
         info = {
             'goal_description': self.goal_description,
@@ -338,11 +410,25 @@ class TDW(Env):
             'check_pos_in_room': self.check_pos_in_room,
             'get_room_distance': self.get_room_distance,
             'get_id_from_mask': partial(self.get_id_from_mask, agent_id=i),
+            'get_ids_from_masks': partial(self.get_ids_from_masks, agent_id=i),
             'get_with_character_mask': partial(self.get_with_character_mask, agent_id=i),
         } for i in range(self.number_of_agents)]
         self.obs = self.get_obs()
         return self.obs_filter(self.obs), info, env_api
 
+    def launch_controller(self, output_dir = None):
+        r'''
+        Terminate the current build if any and launch a new one, the scenes cached for the previous build are forgotten
+        '''
+        if self.controller is not None:
+            self.controller.communicate({"$type": "terminate"})
+            self.controller.socket.close()
+        # download_asset_bundles()
+        # Changes it to always, since in each step, we need to get the image
+        self.controller = might_fail_launch(partial(TransportChallenge, port=self.port, check_version=True, launch_build=self.launch_build, screen_width=self.screen_size,screen_height=self.screen_size, image_frequency= ImageFrequency.always, png=True, image_passes=None, enable_collision_detection = self.enable_collision_detection, logger_dir = output_dir), port = self.port)
+        self.scene_setups = {}
+        print("Controller connected")
+
     def pos_to_2d_box_distance(self, px, py, rx1, ry1, rx2, ry2):
         if px < rx1:
             if py < ry1:
@@ -404,6 +490,20 @@ class TDW(Env):
                     return True
         return False
 
+    def is_fast_forwarding(self, delay_frame_count):
+        r'''
+        Whether no agent needs to be polled soon, i.e. all agents are in the middle of a long navigation action
+        '''
+        for replicant_id in self.controller.replicants:
+            replicant = self.controller.replicants[replicant_id]
+            if delay_frame_count[replicant_id] > 0 or replicant.action.status != ActionStatus.ongoing or not replicant.action.initialized \
+                    or self.current_action_type[replicant_id] not in ['move_forward', 'reach_for']:
+                return False
+        return True
+
+    def enable_image_sensors(self, enable):
+        return [{"$type": "enable_image_sensor", "enable": enable, "avatar_id": self.controller.replicants[replicant_id].static.avatar_id} for replicant_id in self.controller.replicants]
+
     def map_status(self, status, buffer_len = 0):
         if status == ActionStatus.ongoing or buffer_len > 0:
             return 0
@@ -428,20 +528,48 @@ class TDW(Env):
                 self.satisfied[object_id] = True
         return count, len(self.target_object_ids), count == len(self.target_object_ids)
 
+    def build_color_index(self):
+        r'''
+        Build the packed color -> visible object entry map of the current scene, it is used to find visible objects without scanning all objects
+        '''
+        self.color_index = {}
+        for object_id in self.segmentation_colors:
+            self.color_index[int(pack_colors(self.segmentation_colors[object_id]))] = (len(self.color_index), {
+                'id': object_id,
+                'type': self.get_object_type(object_id),
+                'seg_color': tuple(self.segmentation_colors[object_id]),
+                'name': self.object_names[object_id],
+            })
+        # check colors are different:
+        assert len(self.color_index) == len(self.segmentation_colors)
+        for agent_id in self.replicant_colors:
+            self.color_index[int(pack_colors(self.replicant_colors[agent_id]))] = (len(self.color_index), {
+                'id': agent_id,
+                'type': 3,
+                'seg_color': tuple(self.replicant_colors[agent_id]),
+                'name': 'agent',
+            })
+
+    def get_visible_objects(self, seg_mask, packed_seg_mask = None):
+        r'''
+        Get the visible objects in a segmentation image, in the order of the scene objects followed by the agents
+        '''
+        if packed_seg_mask is None:
+            packed_seg_mask = pack_colors(seg_mask)
+        visible = [self.color_index[color] for color in np.unique(packed_seg_mask).tolist() if color in self.color_index]
+        visible.sort(key = lambda x: x[0])
+        return [dict(x[1]) for x in visible]
+
     def get_id_from_mask(self, agent_id, mask, name = None):
         r'''
         Get the object id from the mask
         '''
-        seg_with_mask = (self.obs[str(agent_id)]['seg_mask'] * np.expand_dims(mask, axis = -1)).reshape(-1, 3)
-        seg_with_mask = [tuple(x) for x in seg_with_mask]
-        seg_counter = Counter(seg_with_mask)
-        
-        for seg in seg_counter:
-            if seg == (0, 0, 0): continue
-            if seg_counter[seg] / np.sum(mask) > 0.5:
-                for i in range(len(self.obs[str(agent_id)]['visible_objects'])):
-                    if self.obs[str(agent_id)]['visible_objects'][i]['seg_color'] == seg:
-                        return self.obs[str(agent_id)]['visible_objects'][i]
+        mask = np.asarray(mask).astype(bool)
+        colors, counts = np.unique(self.packed_seg_masks[str(agent_id)][mask], return_counts = True)
+        for color, count in zip(colors.tolist(), counts.tolist()):
+            if color == 0: continue
+            if count / np.sum(mask) > 0.5 and color in self.visible_by_color[str(agent_id)]:
+                return self.visible_by_color[str(agent_id)][color]
         return {
                     'id': None,
                     'type': None,
@@ -449,42 +577,53 @@ class TDW(Env):
                     'name': None,
                 }
 
+    def get_ids_from_masks(self, agent_id, masks):
+        r'''
+        get_id_from_mask for all the (H, W, N) masks of the detections of a frame at once, masks can overlap
+        return: the visible object of each detection, or an entry with None values
+        '''
+        masks = np.asarray(masks)
+        num_detections = masks.shape[-1]
+        if num_detections == 0:
+            return []
+        pixels, detections = np.nonzero(masks.reshape(-1, num_detections))
+        packed = self.packed_seg_masks[str(agent_id)].reshape(-1).astype(np.int64)
+        totals = np.bincount(detections, minlength = num_detections)
+        # one key per (detection, color) pair, colors are 24 bits
+        keys, counts = np.unique((detections.astype(np.int64) << 24) | packed[pixels], return_counts = True)
+        results = [None] * num_detections
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            detection, color = key >> 24, key & 0xffffff
+            if color == 0: continue
+            if count / totals[detection] > 0.5 and color in self.visible_by_color[str(agent_id)]:
+                results[detection] = self.visible_by_color[str(agent_id)][color]
+        return [x if x is not None else {'id': None, 'type': None, 'seg_color': None, 'name': None} for x in results]
+
     def get_obs(self):
-        for x in self.controller.state.containment.keys():
+        # only the containers whose containment changed since the last observation
+        for x in self.controller.state.get_changed_containers(self.containment_version):
+            if x not in self.controller.state.containment:
+                continue
             if x not in self.containment_all.keys():
                 self.containment_all[x] = []
-            for y in self.controller.state.containment[x]:
-                if y not in self.containment_all[x]:
-                    self.containment_all[x].append(y)
+            for y in sorted(self.controller.state.containment[x] - set(self.containment_all[x])):
+                self.containment_all[x].append(y)
+        self.containment_version = self.controller.state.containment_version
         obs = {str(i): {} for i in range(self.number_of_agents)}
         containment_info_get = {str(i): [str(i)] for i in range(self.number_of_agents)}
         for replicant_id in self.controller.replicants:
             id = str(replicant_id)
             obs[id]['visible_objects'] = []
+            self.visible_by_color[id] = {}
             if 'img' in self.controller.replicants[replicant_id].dynamic.images.keys():
                 obs[id]['rgb'] = np.array(self.controller.replicants[replicant_id].dynamic.get_pil_image('img')).transpose(2, 0, 1)
                 obs[id]['seg_mask'] = np.array(self.controller.replicants[replicant_id].dynamic.get_pil_image('id'))
-                colors = Counter(self.controller.replicants[replicant_id].dynamic.get_pil_image('id').getdata())
-                for object_id in self.segmentation_colors:
-                    segmentation_color = tuple(self.segmentation_colors[object_id])
-                    object_name = self.object_names[object_id]
-                    if segmentation_color in colors:
-                        obs[id]['visible_objects'].append({
-                            'id': object_id,
-                            'type': self.get_object_type(object_id),
-                            'seg_color': segmentation_color,
-                            'name': object_name,
-                        })
-                for agent_id in self.replicant_colors:
-                    segmentation_color = tuple(self.replicant_colors[agent_id])
-                    if segmentation_color in colors:
-                        obs[id]['visible_objects'].append({
-                            'id': agent_id,
-                            'type': 3,
-                            'seg_color': segmentation_color,
-                            'name': 'agent',
-                        })
-                        if str(agent_id) not in containment_info_get[id]: containment_info_get[id].append(str(agent_id))
+                self.packed_seg_masks[id] = pack_colors(obs[id]['seg_mask'])
+                obs[id]['visible_objects'] = self.get_visible_objects(obs[id]['seg_mask'], self.packed_seg_masks[id])
+                self.visible_by_color[id] = {int(pack_colors(x['seg_color'])): x for x in obs[id]['visible_objects']}
+                for visible_object in obs[id]['visible_objects']:
+                    if visible_object['type'] == 3 and str(visible_object['id']) not in containment_info_get[id]:
+                        containment_info_get[id].append(str(visible_object['id']))
                         
                 obs[id]['depth'] = np.flip(np.array(TDWUtils.get_depth_values(self.controller.replicants[replicant_id].dynamic.get_pil_image('depth'),
                         width = self.screen_size,
@@ -645,6 +784,7 @@ class TDW(Env):
         valid = [True for _ in range(self.number_of_agents)]
         delay_frame_count = [0 for _ in range(self.number_of_agents)]
         finish = False
+        images_off = False
         num_frames = 0
         while not finish: # continue until any agent's action finishes
             for replicant_id in self.controller.replicants:
@@ -655,6 +795,7 @@ class TDW(Env):
                     finish = True
                 elif self.controller.replicants[replicant_id].action.status != ActionStatus.ongoing:
                     curr_action = self.action_buffer[replicant_id].pop(0)
+                    self.current_action_type[replicant_id] = curr_action['type']
                     if curr_action['type'] == 'move_forward':       # move forward 0.5m
                         self.controller.replicants[replicant_id].move_forward()
                     elif curr_action['type'] == 'turn_left':     # turn left by 15 degree
@@ -694,32 +835,33 @@ class TDW(Env):
                         self.messages[replicant_id] = copy.deepcopy(curr_action['message'])
                         delay_frame_count[replicant_id] = max((len(self.messages[replicant_id]) - 1) // self.message_per_frame, 0)
             if finish: break
-            data = self.controller.communicate([])
-            for i in range(len(data) - 1):
-                r_id = OutputData.get_data_type_id(data[i])
-                if r_id == 'imag':
-                    images = Images(data[i])
-                    if images.get_avatar_id() == "a" and (self.num_frames + num_frames) % 1 == 0:
-                        TDWUtils.save_images(images=images, filename= f"{self.num_frames + num_frames:05d}", output_directory = os.path.join(self.save_dir, 'top_down_image'))
+            commands = []
+            if self.fast_forward:
+                fast_forwarding = self.is_fast_forwarding(delay_frame_count)
+                if fast_forwarding or images_off:
+                    commands = self.enable_image_sensors(not fast_forwarding)
+                images_off = fast_forwarding
+            data = self.controller.communicate(commands)
+            self.save_top_down_images(data, self.num_frames + num_frames)
+            num_frames += 1
+        if images_off:
+            # the last frame has no images of the agents, capture them with one more frame
+            data = self.controller.communicate(self.enable_image_sensors(True))
+            self.save_top_down_images(data, self.num_frames + num_frames)
             num_frames += 1
 
         self.num_frames += num_frames
         self.action_list.append(actions)
         goal_put, goal_total, self.success = self.check_goal()
         reward = 0
+        self.trace.write_containment(self.num_step, self.controller.state.containment, self.controller.state.get_changed_containers(self.trace_containment_version))
+        self.trace_containment_version = self.controller.state.containment_version
         for replicant_id in self.controller.replicants:
             action = actions[str(replicant_id)]
             task_status = self.controller.replicants[replicant_id].action.status
-            self.f.write('step: {}, action: {}, time: {}, status: {}\n'
-                    .format(self.num_step, action["type"],
-                    time.time() - start,
-                    task_status))
-            container_info = self.add_name_and_empty(copy.deepcopy(self.controller.state.containment))
-            self.f.write('position: {}, forward: {}, containment: {}, goal: {}, container: {}\n'.format(
+            self.trace.write_step(self.num_step, replicant_id, action["type"], time.time() - start, task_status,
                     self.controller.replicants[replicant_id].dynamic.transform.position,
-                    self.controller.replicants[replicant_id].dynamic.transform.forward,
-                    container_info, self.add_name(self.target_object_ids), self.add_name(self.container_ids)))
-            self.f.flush()
+                    self.controller.replicants[replicant_id].dynamic.transform.forward)
             if task_status != ActionStatus.success and task_status != ActionStatus.ongoing:
                 reward -= 0.1
         
@@ -747,10 +889,22 @@ class TDW(Env):
         info['num_step'] = self.num_step
         if done:
             info['reward'] = self.reward
+            info['fps'] = self.num_frames / (time.time() - self.episode_start_time)
 
         self.obs = obs
         return self.obs_filter(self.obs), reward, done, info
      
+    def save_top_down_images(self, data, frame):
+        if frame % self.image_capture_interval != 0:
+            return
+        for i in range(len(data) - 1):
+            r_id = OutputData.get_data_type_id(data[i])
+            if r_id == 'imag':
+                images = Images(data[i])
+                if images.get_avatar_id() == "a":
+                    # the output data of the frame is not reused, so the writer thread can read the images from it
+                    get_image_writer().submit(TDWUtils.save_images, images=images, filename= f"{frame:05d}", output_directory = os.path.join(self.save_dir, 'top_down_image'))
+
     def render(self):
         return None
         
@@ -758,20 +912,18 @@ class TDW(Env):
         '''
         save images of current step, including rgb, depth and segmentation image
         '''
-        os.makedirs(save_dir, exist_ok=True)
+        image_writer = get_image_writer()
+        if not image_writer.keep('env_images'):
+            return
         for replicant_id in self.controller.replicants:
-            save_path = os.path.join(save_dir, str(replicant_id))
-            os.makedirs(save_path, exist_ok=True)
-            img = self.controller.replicants[replicant_id].dynamic.get_pil_image('img')
-            depth = np.flip(np.array(TDWUtils.get_depth_values(self.controller.replicants[replicant_id].dynamic.get_pil_image('depth'), width = self.screen_size, height = self.screen_size), dtype = np.float32), 0)
-            depth_img = Image.fromarray(100 / depth).convert('RGB')
-            seg = self.controller.replicants[replicant_id].dynamic.get_pil_image('id')
-            img.save(os.path.join(save_path, f'{self.num_step:04}_{self.num_frames:04}.png'))
-            seg.save(os.path.join(save_path, f'{self.num_step:04}_{self.num_frames:04}_seg.png'))
-            depth_img.save(os.path.join(save_path, f'{self.num_step:04}_{self.num_frames:04}_depth.png'))
+            save_path = os.path.join(save_dir, str(replicant_id), f'{self.num_step:04}_{self.num_frames:04}')
+            # the dynamic data of this frame is replaced on the next communicate, the images are decoded and written in the writer thread
+            image_writer.submit(save_replicant_images, self.controller.replicants[replicant_id].dynamic, save_path, self.screen_size)
 
     def close(self):
         print('close')
+        self.trace.close()
+        get_image_writer().flush()
         with open(f'action.pkl', 'wb') as f:
             d = {'scene_info': self.scene_info, \
                 'actions': self.action_list}
@@ -1,4 +1,4 @@
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Set
 from tdw.replicant.arm import Arm
 from tdw.output_data import OutputData, Replicants, Containment
 from tdw.add_ons.add_on import AddOn
@@ -7,6 +7,8 @@ from tdw.add_ons.add_on import AddOn
 class ChallengeState(AddOn):
     """
     An add-on that tracks scene-state data that all Replicants need to reference to complete the challenge.
+
+    `send_containment` applies to the whole build, so the containment requests of this add-on override the `"frequency": "always"` subscription of the `Replicant` add-on: the `cont` output data only contains the containers requested by this add-on (see `containment`).
     """
 
     def __init__(self):
@@ -28,9 +30,27 @@ class ChallengeState(AddOn):
         """
         self.target_object_ids: List[int] = list()
         """:field
-        A dictionary describing the current containment status of each container in the scene. Key = The object ID of a container. Value = A list of IDs of objects inside the container.
+        A dictionary describing the current containment status of each container in the scene. Key = The object ID of a container. Value = A set of IDs of objects inside the container. Containment is requested for every container at the start of a trial and for `settle_frames` frames after a Replicant lets go of an object, and otherwise only for the containers held by a Replicant (and on the frame after they are let go) and the containers in `grasp_targets`, the other containers keep their last value.
+        """
+        self.containment: Dict[int, Set[int]] = dict()
+        """:field
+        Incremented on every frame in which `self.containment` changed. See `get_changed_containers()`.
         """
-        self.containment: Dict[int, List[int]] = dict()
+        self.containment_version: int = 0
+        """:field
+        The number of frames after a Replicant lets go of an object during which containment is requested for every container, while the object (or the contents of a dropped container) might still be falling. This is the default `max_num_frames` of `drop()`, after which the drop action ends even if the object is still moving.
+        """
+        self.settle_frames: int = 100
+        """:field
+        The objects that a Replicant is about to grasp. The `Grasp` action parents the objects in a container to it from the `cont` output data of the frame on which it starts, so containment is requested for the containers in this set until they are grasped. See [`PickUp`](pick_up.md).
+        """
+        self.grasp_targets: Set[int] = set()
+        # Key = The object ID of a container. Value = The `containment_version` of its last change.
+        self._containment_versions: Dict[int, int] = dict()
+        # The containers whose containment was requested for the next frame. None = all of them.
+        self._requested_containers: Optional[Set[int]] = None
+        # The number of frames left in which containment is requested for every container.
+        self._settling_frames: int = 0
         self.__initialized: bool = False
 
     def is_holding_container(self, replicant_id: int) -> bool:
@@ -70,11 +90,27 @@ class ChallengeState(AddOn):
         :return: A list of commands that will initialize this add-on.
         """
 
+        self._requested_containers = None
+        self._settling_frames = 0
         return [{"$type": "send_containment",
-                 "frequency": "always"},
+                 "frequency": "once"},
                 {"$type": "send_replicants",
                  "frequency": "always"}]
 
+    def get_changed_containers(self, version: int) -> List[int]:
+        """
+        The change feed of `self.containment`: a reader remembers `containment_version` after reading, and gets the containers that changed since then the next time.
+
+        :param version: A previous value of `self.containment_version`.
+
+        :return: The IDs of the containers whose containment changed (or stopped being reported) after `version`.
+        """
+
+        return [container_id for container_id, container_version in self._containment_versions.items() if container_version > version]
+
+    def _get_held_objects(self) -> Set[int]:
+        return {object_id for arms in self.replicants.values() for object_id in arms.values() if object_id is not None}
+
     def on_send(self, resp: List[bytes]) -> None:
         """
         This is called within `Controller.communicate(commands)` after commands are sent to the build and a response is received.
@@ -94,8 +130,8 @@ class ChallengeState(AddOn):
                     replicants = Replicants(resp[i])
                     for j in range(replicants.get_num()):
                         self.replicants[replicants.get_id(j)] = {Arm.left: None, Arm.right: None}
-        # Clear containment.
-        self.containment.clear()
+        held_before = self._get_held_objects()
+        containment: Dict[int, Set[int]] = dict()
         # Read per-frame data.
         for i in range(len(resp) - 1):
             r_id = OutputData.get_data_type_id(resp[i])
@@ -115,8 +151,40 @@ class ChallengeState(AddOn):
                         self.replicants[replicant_id][Arm.right] = None
             # Get containment.
             elif r_id == "cont":
-                containment = Containment(resp[i])
-                self.containment[containment.get_object_id()] = [int(o) for o in containment.get_overlap_ids() if o not in self.replicants]
+                c = Containment(resp[i])
+                containment[c.get_object_id()] = {int(o) for o in c.get_overlap_ids() if o not in self.replicants}
+        # Update the containers that were requested. A requested container without output data contains nothing.
+        if self._requested_containers is None:
+            containers = set(containment.keys()) | set(self.containment.keys())
+        else:
+            containers = self._requested_containers
+        changed = [container_id for container_id in containers if containment.get(container_id) != self.containment.get(container_id)]
+        if len(changed) > 0:
+            self.containment_version += 1
+            for container_id in changed:
+                if container_id in containment:
+                    self.containment[container_id] = containment[container_id]
+                else:
+                    del self.containment[container_id]
+                self._containment_versions[container_id] = self.containment_version
+        # Request containment for the next frame.
+        held = self._get_held_objects()
+        if len(held_before - held) > 0:
+            self._settling_frames = self.settle_frames
+        if self._settling_frames > 0:
+            # A dropped object might fall into, or out of, any container until it stops moving.
+            self._settling_frames -= 1
+            self._requested_containers = None
+            self.commands.append({"$type": "send_containment",
+                                  "frequency": "once"})
+        else:
+            container_ids = set(self.container_ids)
+            # The containers that are held, the ones that were held until this frame, and the ones about to be grasped.
+            self._requested_containers = {object_id for object_id in held | held_before | self.grasp_targets if object_id in container_ids}
+            if len(self._requested_containers) > 0:
+                self.commands.append({"$type": "send_containment",
+                                      "frequency": "once",
+                                      "ids": sorted(self._requested_containers)})
 
     def reset(self) -> None:
         """
@@ -127,5 +195,10 @@ class ChallengeState(AddOn):
         self.initialized = False
         self.replicants.clear()
         self.containment.clear()
+        self._containment_versions.clear()
+        self.containment_version = 0
+        self._requested_containers = None
+        self._settling_frames = 0
+        self.grasp_targets.clear()
         self.container_ids.clear()
         self.target_object_ids.clear()
@@ -62,6 +62,8 @@ class PickUp(MultiAction):
         # Turn to face the object.
         else:
             self._image_frequency = image_frequency
+            # Request the containment of the object until it is grasped.
+            self._state.grasp_targets.add(self._target)
             self._sub_action = TurnTo(target=self._target)
             return self._sub_action.get_initialization_commands(resp=resp, static=static, dynamic=dynamic,
                                                                 image_frequency=image_frequency)
@@ -169,8 +171,10 @@ class PickUp(MultiAction):
                                  offset=0,
                                  relative_to_hand=True)
         self._pick_up_state = _PickUpState.grasping
-        return self._sub_action.get_initialization_commands(resp=resp, static=static, dynamic=dynamic,
-                                                            image_frequency=self._image_frequency)
+        commands = self._sub_action.get_initialization_commands(resp=resp, static=static, dynamic=dynamic,
+                                                                image_frequency=self._image_frequency)
+        self._state.grasp_targets.discard(self._target)
+        return commands
 
     def _reset(self, resp: List[bytes], static: ReplicantStatic, dynamic: ReplicantDynamic) -> List[dict]:
         """
@@ -183,6 +187,7 @@ class PickUp(MultiAction):
         :return: A list of commands.
         """
 
+        self._state.grasp_targets.discard(self._target)
         self._sub_action = ResetArms(state=self._state)
         self._pick_up_state = _PickUpState.resetting
         return self._sub_action.get_initialization_commands(resp=resp, static=static, dynamic=dynamic,
@@ -0,0 +1,219 @@
+import os
+import json
+import mmap
+import pickle
+import struct
+from typing import Dict, List, Optional
+
+
+class SceneMetadata:
+    """
+    The files read at the start of every trial of a dataset directory: the scene commands (`{scene}_{layout}.json`), the Replicant positions (`{scene}_{layout}_metadata.json` or `{scene}_{layout}_count.json`) and the target objects and containers of each task (`list.json`).
+
+    They are compiled once into `scene_metadata.pik` in the dataset directory: a small index (the Replicant positions, `list.json` and the offset of each scene) followed by one pickle per scene. A process reads the index the first time it needs it and memory-maps the file, and the commands of a scene are unpickled from the mapping the first time the scene is used, then kept for all the trials of the process. The processes only read the scenes they use, and the pages of the file are shared through the page cache. The bundle is compiled again if a scene file or `list.json` is newer than it.
+
+    The Replicant position files are written by trials, and positions are only ever added to them, so the compiled positions are kept as they are and the file is only read again when a position is missing.
+    """
+
+    """:class_var
+    The name of the compiled bundle in the dataset directory.
+    """
+    FILE_NAME: str = "scene_metadata.pik"
+    """:class_var
+    The version of the bundle format. A bundle with another version is compiled again.
+    """
+    VERSION: int = 2
+    # The length of the index at the start of the bundle.
+    _INDEX_LENGTH: struct.Struct = struct.Struct("<Q")
+    # Key = The absolute path of a dataset directory. Value = Its `SceneMetadata`.
+    _INSTANCES: Dict[str, "SceneMetadata"] = dict()
+
+    def __init__(self, data_prefix: str):
+        """
+        :param data_prefix: The dataset directory.
+        """
+
+        """:field
+        The dataset directory.
+        """
+        self.data_prefix: str = data_prefix
+        self._bundle: Optional[dict] = None
+        # The mapping of the bundle file, and the offset of the scene pickles in it.
+        self._mmap: Optional[mmap.mmap] = None
+        self._scenes_offset: int = 0
+        # Key = `{scene}_{layout}`. Value = The scene commands, unpickled from the bundle.
+        self._scenes: Dict[str, List[dict]] = dict()
+
+    @staticmethod
+    def get(data_prefix: str) -> "SceneMetadata":
+        """
+        :param data_prefix: The dataset directory.
+
+        :return: The `SceneMetadata` of the dataset directory shared by this process.
+        """
+
+        key = os.path.abspath(data_prefix)
+        if key not in SceneMetadata._INSTANCES:
+            SceneMetadata._INSTANCES[key] = SceneMetadata(data_prefix=data_prefix)
+        return SceneMetadata._INSTANCES[key]
+
+    def get_scene_commands(self, scene: str, layout) -> List[dict]:
+        """
+        :param scene: The scene.
+        :param layout: The layout, e.g. `0` or `"0_1"`.
+
+        :return: The commands that add the objects of the scene. The list and the commands with a URL are copies, because `communicate()` modifies them.
+        """
+
+        name = f"{scene}_{layout}"
+        # A bundle compiled by this process has all the scenes already.
+        bundle = self._get_bundle()
+        if name not in self._scenes:
+            offset, length = bundle["scenes"][name]
+            start = self._scenes_offset + offset
+            self._scenes[name] = pickle.loads(self._mmap[start: start + length])
+        commands = self._scenes[name]
+        return [dict(command) if "url" in command else command for command in commands]
+
+    def get_common_sense(self) -> dict:
+        """
+        :return: The content of `list.json`. Key = The task. Value = A dictionary with the names of the `"target"` objects and of the `"container"`s.
+        """
+
+        return self._get_bundle()["common_sense"]
+
+    def get_count_and_position(self, scene: str, layout, replicant_ids: List[str]) -> dict:
+        """
+        :param scene: The scene.
+        :param layout: The layout.
+        :param replicant_ids: The keys of the Replicant positions needed by the trial.
+
+        :return: The content of the Replicant position file. The file is read again if one of `replicant_ids` is not in the compiled content.
+        """
+
+        file_name, data = self._get_bundle()["counts"][f"{scene}_{layout}"]
+        if any(replicant_id not in data for replicant_id in replicant_ids):
+            # another trial (maybe in another process) might have added it since the bundle was compiled
+            with open(os.path.join(self.data_prefix, file_name), "r") as f:
+                data = json.load(f)
+            self._bundle["counts"][f"{scene}_{layout}"] = (file_name, data)
+        return dict(data)
+
+    def save_count_and_position(self, scene: str, layout, count_and_position: dict) -> None:
+        """
+        Write the Replicant position file of a scene if the trial added positions to it.
+
+        :param scene: The scene.
+        :param layout: The layout.
+        :param count_and_position: The content of the file after the trial.
+        """
+
+        file_name, data = self._get_bundle()["counts"][f"{scene}_{layout}"]
+        if count_and_position == data:
+            return
+        path = os.path.join(self.data_prefix, file_name)
+        with open(path, "w") as f:
+            json.dump(count_and_position, f, indent=4)
+        self._bundle["counts"][f"{scene}_{layout}"] = (file_name, dict(count_and_position))
+        print(path, 'saved')
+
+    def _get_bundle(self) -> dict:
+        if self._bundle is None:
+            path = os.path.join(self.data_prefix, SceneMetadata.FILE_NAME)
+            if os.path.exists(path):
+                try:
+                    with open(path, "rb") as f:
+                        index_length = SceneMetadata._INDEX_LENGTH.unpack(f.read(SceneMetadata._INDEX_LENGTH.size))[0]
+                        bundle = pickle.loads(f.read(index_length))
+                        if bundle["version"] == SceneMetadata.VERSION and bundle["sources"] == self._get_sources():
+                            # The mapping stays valid if another process compiles the bundle again, it replaces the file.
+                            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                            self._scenes_offset = SceneMetadata._INDEX_LENGTH.size + index_length
+                            self._bundle = bundle
+                except (OSError, ValueError, EOFError, KeyError, struct.error, pickle.UnpicklingError):
+                    print(f"Warning! Can't read {path}, compiling it again.")
+            if self._bundle is None:
+                self._bundle = self.compile()
+        return self._bundle
+
+    def _get_sources(self) -> Dict[str, float]:
+        # The files compiled into the bundle, and their modification times. The Replicant position files are left out: trials write them.
+        sources = dict()
+        for file_name in sorted(os.listdir(self.data_prefix)):
+            if not file_name.endswith(".json") or file_name.endswith("_metadata.json") or file_name.endswith("_count.json"):
+                continue
+            sources[file_name] = os.path.getmtime(os.path.join(self.data_prefix, file_name))
+        return sources
+
+    def compile(self) -> dict:
+        """
+        Read the files of the dataset directory and write them to `scene_metadata.pik`. If the directory is read-only, the bundle is only kept in memory.
+
+        :return: The bundle.
+        """
+
+        sources = self._get_sources()
+        with open(os.path.join(self.data_prefix, "list.json"), "r") as f:
+            common_sense = json.load(f)
+        scenes = dict()
+        counts = dict()
+        for file_name in sources:
+            name = file_name[:-len(".json")]
+            if not os.path.exists(os.path.join(self.data_prefix, f"{name}_metadata.json")) and \
+                    not os.path.exists(os.path.join(self.data_prefix, f"{name}_count.json")):
+                continue
+            with open(os.path.join(self.data_prefix, file_name), "r") as f:
+                scenes[name] = json.load(f)
+            # The metadata file if there is one, else the count file.
+            if os.path.exists(os.path.join(self.data_prefix, f"{name}_metadata.json")):
+                count_file_name = f"{name}_metadata.json"
+            else:
+                count_file_name = f"{name}_count.json"
+            with open(os.path.join(self.data_prefix, count_file_name), "r") as f:
+                counts[name] = (count_file_name, json.load(f))
+        # One pickle per scene, after the index.
+        scene_data = list()
+        scene_offsets = dict()
+        offset = 0
+        for name, commands in scenes.items():
+            scene_data.append(pickle.dumps(commands, protocol=pickle.HIGHEST_PROTOCOL))
+            scene_offsets[name] = (offset, len(scene_data[-1]))
+            offset += len(scene_data[-1])
+        bundle = {"version": SceneMetadata.VERSION,
+                  "sources": sources,
+                  "scenes": scene_offsets,
+                  "counts": counts,
+                  "common_sense": common_sense}
+        self._scenes = scenes
+        index = pickle.dumps(bundle, protocol=pickle.HIGHEST_PROTOCOL)
+        path = os.path.join(self.data_prefix, SceneMetadata.FILE_NAME)
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(SceneMetadata._INDEX_LENGTH.pack(len(index)))
+                f.write(index)
+                for data in scene_data:
+                    f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            print(f"Warning! Can't write {path}, the scene metadata is not cached on disk.")
+        return bundle
+
+
+# Key = The absolute path of a JSON file. Value = Tuple: The modification time of the file, its content.
+_JSON_FILES: Dict[str, tuple] = dict()
+
+
+def load_shared_json(path: str):
+    """
+    :param path: The path of a JSON file that doesn't change during a run, e.g. `name_map.json` or `room_types.json`.
+
+    :return: The content of the file, read once per process. Don't modify it.
+    """
+
+    key = os.path.abspath(path)
+    mtime = os.path.getmtime(key)
+    if key not in _JSON_FILES or _JSON_FILES[key][0] != mtime:
+        with open(key, "r") as f:
+            _JSON_FILES[key] = (mtime, json.load(f))
+    return _JSON_FILES[key][1]
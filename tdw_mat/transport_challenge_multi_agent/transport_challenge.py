@@ -22,6 +22,7 @@ from transport_challenge_multi_agent.replicant_transport_challenge import Replic
 from transport_challenge_multi_agent.paths import CONTAINERS_PATH, TARGET_OBJECTS_PATH, TARGET_OBJECT_MATERIALS_PATH
 from transport_challenge_multi_agent.globals import Globals
 from transport_challenge_multi_agent.asset_cached_controller import AssetCachedController
+from transport_challenge_multi_agent.scene_metadata import SceneMetadata
 from tdw.add_ons.logger import Logger
 import os
 import json
@@ -117,6 +118,10 @@ class TransportChallenge(AssetCachedController):
         # Get all possible container names.
         self._container_names: List[str] = CONTAINERS_PATH.read_text().split("\n")
         self._scene_bounds: Optional[SceneBounds] = None
+        # The index of the room of each occupancy map cell, -1 outside of every room. Computed with the scene bounds.
+        self._room_labels: Optional[np.ndarray] = None
+        # The static setup of the scenes loaded by this build, reused by the next trials in the same scene and layout. Key = (data prefix, scene, layout).
+        self._scene_setups: Dict[Tuple[str, str, str], dict] = dict()
         if image_passes is None:
             self._image_passes: List[str] = ["_img", "_id", "_depth"]
         else:
@@ -155,6 +160,10 @@ class TransportChallenge(AssetCachedController):
         :param random_seed: The random see used to add containers, target objects, and Replicants, as well as to set the lighting and target object materials. If None, the seed is random.
         """
 
+        # The add-ons of a previous trial belong to the scene that is about to be replaced.
+        self.add_ons.clear()
+        if self.logger is not None:
+            self.add_ons.append(self.logger)
         floorplan = Floorplan()
         if type(layout) == int:
             floorplan.init_scene(scene=scene, layout=layout) # 0 / 1 / 2
@@ -190,6 +199,21 @@ class TransportChallenge(AssetCachedController):
     #                       container_room_index=0, target_objects_room_index=0, goal_room_index=0,
     #                       replicants=replicants, random_seed=random_seed)
 
+    def set_logger_dir(self, logger_dir) -> None:
+        """
+        Log the commands of the next trials in another directory, e.g. when a build is kept alive for several episodes.
+
+        :param logger_dir: The directory of `action_log.log`. If None, the commands are not logged.
+        """
+
+        if self.logger is not None and self.logger in self.add_ons:
+            self.add_ons.remove(self.logger)
+        if logger_dir is not None:
+            self.logger = Logger(path=os.path.join(logger_dir, "action_log.log"))
+            self.add_ons.append(self.logger)
+        else:
+            self.logger = None
+
     def communicate(self, commands: Union[dict, List[dict]]) -> list:
         """
         Send commands and receive output data in response.
@@ -207,16 +231,10 @@ class TransportChallenge(AssetCachedController):
         food or stuff
         """
         self.communicate({"$type": "set_floorplan_roof", "show": False})
-        load_path = os.path.join(self.data_prefix, f"{self.scene}_{self.layout}.json")
-        with open(load_path, "r") as f: scene = json.load(f)
-        if os.path.exists(os.path.join(self.data_prefix, f"{self.scene}_{self.layout}_metadata.json")):
-            load_count_and_position_path = os.path.join(self.data_prefix, f"{self.scene}_{self.layout}_metadata.json")
-        else:
-            load_count_and_position_path = os.path.join(self.data_prefix, f"{self.scene}_{self.layout}_count.json")
-        with open(load_count_and_position_path, "r") as f: count_and_position = json.load(f)
-        common_sense_path = os.path.join(self.data_prefix, "list.json")
-        with open(common_sense_path, "r") as f:
-            common_sense = json.load(f)
+        # The scene files of the dataset directory are compiled once and shared by the trials of this process.
+        scene_metadata = SceneMetadata.get(self.data_prefix)
+        scene = scene_metadata.get_scene_commands(self.scene, self.layout)
+        common_sense = scene_metadata.get_common_sense()
         self.communicate(scene)
         self.state = ChallengeState()
         self.add_ons.clear() # Clear the add-ons.
@@ -225,8 +243,22 @@ class TransportChallenge(AssetCachedController):
         self.replicants.clear()
         # Add an occupancy map.
         self.add_ons.append(self.occupancy_map)
-        # Get the rooms.
-        rooms: Dict[int, List[Dict[str, float]]] = self._get_rooms_map(communicate=True)
+        # Get the rooms. The occupancy map and the scene regions only depend on the scene and the layout, so they are generated once per build.
+        scene_setup = self._scene_setups.get((self.data_prefix, self.scene, str(self.layout)))
+        if scene_setup is None:
+            rooms: Dict[int, List[Dict[str, float]]] = self._get_rooms_map(communicate=True)
+            scene_setup = {"occupancy_map": self.occupancy_map.occupancy_map.copy(),
+                           "positions": self.occupancy_map.positions,
+                           "scene_bounds": self._scene_bounds,
+                           "room_labels": self._room_labels,
+                           "object_ids": dict()}
+            self._scene_setups[(self.data_prefix, self.scene, str(self.layout))] = scene_setup
+        else:
+            self.occupancy_map.occupancy_map = scene_setup["occupancy_map"].copy()
+            self.occupancy_map.positions = scene_setup["positions"]
+            self._scene_bounds = scene_setup["scene_bounds"]
+            self._room_labels = scene_setup["room_labels"]
+            rooms: Dict[int, List[Dict[str, float]]] = self._get_rooms_map(communicate=False)
         replicant_positions: List[Dict[str, float]] = list()
         # Spawn a certain number of Replicants in random rooms.
         if isinstance(replicants, int):
@@ -263,6 +295,7 @@ class TransportChallenge(AssetCachedController):
                 rooms = self._occupy_position(position=position)
                 
         # Add the Replicants. If the position is fixed, the position is the same as the last time.
+        count_and_position = scene_metadata.get_count_and_position(self.scene, self.layout, [str(i) for i in range(len(replicant_positions))])
         for i in range(len(replicant_positions)):
             if str(i) in count_and_position.keys():
                 replicant_positions[i] = count_and_position[str(i)]
@@ -285,11 +318,17 @@ class TransportChallenge(AssetCachedController):
         self.add_ons.extend([self.state, self.object_manager])
         self.communicate([])
         commands = []
-        for object_id in self.object_manager.objects_static.keys():
-            if self.object_manager.objects_static[object_id].name in common_sense[task_type]['target']:
-                self.state.target_object_ids.append(object_id)
-            if self.object_manager.objects_static[object_id].name in common_sense[task_type]['container']:
-                self.state.container_ids.append(object_id)
+        # The objects come from the scene file, so the target objects and containers of a task are the same in every trial of the scene.
+        if task_type not in scene_setup["object_ids"]:
+            target_object_ids, container_ids = [], []
+            for object_id in self.object_manager.objects_static.keys():
+                if self.object_manager.objects_static[object_id].name in common_sense[task_type]['target']:
+                    target_object_ids.append(object_id)
+                if self.object_manager.objects_static[object_id].name in common_sense[task_type]['container']:
+                    container_ids.append(object_id)
+            scene_setup["object_ids"][task_type] = (target_object_ids, container_ids)
+        self.state.target_object_ids.extend(scene_setup["object_ids"][task_type][0])
+        self.state.container_ids.extend(scene_setup["object_ids"][task_type][1])
         for replicant_id in self.replicants:
             # Set pass masks.
             commands.append({"$type": "set_pass_masks",
@@ -326,10 +365,8 @@ class TransportChallenge(AssetCachedController):
                 goal_description[object_names[i]] = 1
         '''
 
-        # Save the position of agents.
-        with open(load_count_and_position_path, "w") as f:
-            json.dump(count_and_position, f, indent=4)
-        print(load_count_and_position_path, 'saved')
+        # Save the position of agents, if they are new.
+        scene_metadata.save_count_and_position(self.scene, self.layout, count_and_position)
 
 
     # def _start_trial(self, num_containers: int, num_target_objects: int, container_room_index: int = None,
@@ -548,39 +585,58 @@ class TransportChallenge(AssetCachedController):
     #                 break
 
     def _get_rooms_map(self, communicate: bool) -> Dict[int, List[Dict[str, float]]]:
+        """
+        :param communicate: If True, generate a new occupancy map and request the scene regions.
+
+        :return: The free occupancy map positions of each room. Key = The index of the room in the scene bounds. Value = A list of positions, in the order of the occupancy map cells.
+        """
+
         # Generate a new occupancy map and request scene regions data.
         if communicate:
             self.occupancy_map.generate()
             resp = self.communicate([{"$type": "send_scene_regions"}])
             self._scene_bounds = SceneBounds(resp=resp)
+            self._room_labels = None
+        if self._room_labels is None or self._room_labels.shape != self.occupancy_map.occupancy_map.shape:
+            self._room_labels = self._get_room_labels()
+        labels = np.where(self.occupancy_map.occupancy_map == 0, self._room_labels, -1).reshape(-1)
+        positions = self.occupancy_map.positions.reshape(-1, 2)
+        cells = np.flatnonzero(labels >= 0)
+        # Group the free cells by room, keeping the cell order within each room and the order in which the rooms are first met.
+        order = np.argsort(labels[cells], kind="stable")
+        cells = cells[order]
+        room_indices, starts = np.unique(labels[cells], return_index=True)
+        groups = np.split(cells, starts[1:])
         rooms: Dict[int, List[Dict[str, float]]] = dict()
-        for ix in range(self.occupancy_map.occupancy_map.shape[0]):
-            for iz in range(self.occupancy_map.occupancy_map.shape[1]):
-                # Ignore non-free positions.
-                if self.occupancy_map.occupancy_map[ix][iz] != 0:
-                    continue
-                # Find the room that this position is in.
-                p = self.occupancy_map.positions[ix][iz]
-                for i, region in enumerate(self._scene_bounds.regions):
-                    if region.is_inside(p[0], p[1]):
-                        if i not in rooms:
-                            rooms[i] = list()
-                        rooms[i].append({"x": float(p[0]),
-                                         "y": 0,
-                                         "z": float(p[1])})
-                        break
+        for room_index, group in sorted(zip(room_indices.tolist(), groups), key=lambda x: x[1][0]):
+            rooms[room_index] = [{"x": x, "y": 0, "z": z} for x, z in positions[group].tolist()]
         return rooms
 
+    def _get_room_labels(self) -> np.ndarray:
+        """
+        :return: The index of the first scene region that contains each occupancy map position, or -1.
+        """
+
+        positions = self.occupancy_map.positions
+        labels = np.full(positions.shape[:2], -1, dtype=int)
+        for i, region in enumerate(self._scene_bounds.regions):
+            inside = (positions[..., 0] >= region.x_min) & (positions[..., 0] <= region.x_max) & \
+                     (positions[..., 1] >= region.z_min) & (positions[..., 1] <= region.z_max)
+            labels[inside & (labels == -1)] = i
+        return labels
+
     def _occupy_position(self, position: Dict[str, float]) -> Dict[int, List[Dict[str, float]]]:
+        """
+        Mark the free occupancy map cells within 0.5 meters of a position as occupied.
+
+        :param position: The position.
+
+        :return: The free positions of each room, see `_get_rooms_map()`.
+        """
+
         origin = TDWUtils.vector3_to_array(position)
-        for ix in range(self.occupancy_map.occupancy_map.shape[0]):
-            for iz in range(self.occupancy_map.occupancy_map.shape[1]):
-                # Ignore non-free positions.
-                if self.occupancy_map.occupancy_map[ix][iz] != 0:
-                    continue
-                # Find the room that this position is in.
-                p2 = self.occupancy_map.positions[ix][iz]
-                p3 = np.array([p2[0], 0, p2[1]])
-                if np.linalg.norm(origin - p3) <= 0.5:
-                    self.occupancy_map.occupancy_map[ix][iz] = 1
+        positions = self.occupancy_map.positions
+        # The cells are on the floor (y = 0).
+        distances = np.sqrt((positions[..., 0] - origin[0]) ** 2 + origin[1] ** 2 + (positions[..., 1] - origin[2]) ** 2)
+        self.occupancy_map.occupancy_map[(self.occupancy_map.occupancy_map == 0) & (distances <= 0.5)] = 1
         return self._get_rooms_map(communicate=False)
\ No newline at end of file
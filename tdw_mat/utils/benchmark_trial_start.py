@@ -0,0 +1,134 @@
+"""
+Latency of the room map construction done at every trial start (TransportChallenge._get_rooms_map and _occupy_position).
+
+Without a build, the array implementation is compared with the former per-cell loops on a synthetic occupancy map:
+    python utils/benchmark_trial_start.py
+With a build, whole trials are started and the time spent in the room map is reported:
+    python utils/benchmark_trial_start.py --build --scene 2a --layout 0 --task food --data_prefix dataset/dataset_test/2a_0
+"""
+
+import os
+import sys
+import time
+import argparse
+from types import SimpleNamespace
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from transport_challenge_multi_agent.transport_challenge import TransportChallenge
+
+
+def rooms_map_loop(occupancy_map, positions, regions):
+    # The former implementation of TransportChallenge._get_rooms_map.
+    rooms = dict()
+    for ix in range(occupancy_map.shape[0]):
+        for iz in range(occupancy_map.shape[1]):
+            if occupancy_map[ix][iz] != 0:
+                continue
+            p = positions[ix][iz]
+            for i, region in enumerate(regions):
+                if region.x_min <= p[0] <= region.x_max and region.z_min <= p[1] <= region.z_max:
+                    if i not in rooms:
+                        rooms[i] = list()
+                    rooms[i].append({"x": float(p[0]), "y": 0, "z": float(p[1])})
+                    break
+    return rooms
+
+def occupy_position_loop(occupancy_map, positions, regions, position):
+    # The former implementation of TransportChallenge._occupy_position.
+    origin = np.array([position["x"], position["y"], position["z"]])
+    for ix in range(occupancy_map.shape[0]):
+        for iz in range(occupancy_map.shape[1]):
+            if occupancy_map[ix][iz] != 0:
+                continue
+            p2 = positions[ix][iz]
+            p3 = np.array([p2[0], 0, p2[1]])
+            if np.linalg.norm(origin - p3) <= 0.5:
+                occupancy_map[ix][iz] = 1
+    return rooms_map_loop(occupancy_map, positions, regions)
+
+class SyntheticChallenge:
+    # Only what the room map methods of TransportChallenge use.
+    _get_rooms_map = TransportChallenge._get_rooms_map
+    _get_room_labels = TransportChallenge._get_room_labels
+    _occupy_position = TransportChallenge._occupy_position
+
+    def __init__(self, occupancy_map, positions, regions):
+        self.occupancy_map = SimpleNamespace(occupancy_map=occupancy_map, positions=positions)
+        self._scene_bounds = SimpleNamespace(regions=regions)
+        self._room_labels = None
+
+def synthetic_scene(rng, size=(120, 80), cell_size=0.25, num_rooms=6):
+    xs = (np.arange(size[0]) - size[0] / 2) * cell_size
+    zs = (np.arange(size[1]) - size[1] / 2) * cell_size
+    positions = np.stack(np.meshgrid(xs, zs, indexing="ij"), axis=-1)
+    occupancy_map = (rng.random_sample(size) < 0.3).astype(int)
+    # Rooms are vertical strips that overlap a little, the first one wins.
+    edges = np.linspace(xs[0], xs[-1], num_rooms + 1)
+    regions = [SimpleNamespace(x_min=edges[i] - 0.3, x_max=edges[i + 1] + 0.3, z_min=zs[0], z_max=zs[-1] - 1) for i in range(num_rooms)]
+    return occupancy_map, positions, regions
+
+def benchmark_synthetic(num_trials, num_replicants):
+    rng = np.random.RandomState(0)
+    times = {"loop": [], "array": []}
+    for trial in range(num_trials):
+        occupancy_map, positions, regions = synthetic_scene(rng)
+        spawns = [{"x": float(rng.uniform(-10, 10)), "y": 0., "z": float(rng.uniform(-6, 6))} for _ in range(num_replicants)]
+
+        start = time.perf_counter()
+        loop_map = occupancy_map.copy()
+        rooms_loop = rooms_map_loop(loop_map, positions, regions)
+        for position in spawns:
+            rooms_loop = occupy_position_loop(loop_map, positions, regions, position)
+        times["loop"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        challenge = SyntheticChallenge(occupancy_map.copy(), positions, regions)
+        rooms_array = challenge._get_rooms_map(communicate=False)
+        for position in spawns:
+            rooms_array = challenge._occupy_position(position)
+        times["array"].append(time.perf_counter() - start)
+
+        assert list(rooms_loop.keys()) == list(rooms_array.keys()) and rooms_loop == rooms_array, f"different rooms in trial {trial}"
+        assert (loop_map == challenge.occupancy_map.occupancy_map).all(), f"different occupancy map in trial {trial}"
+    for name, t in times.items():
+        print(f"{name:>6}: {np.mean(t) * 1000:8.2f} ms per trial start (room map and {num_replicants} replicant placements)")
+    print(f"speedup: {np.mean(times['loop']) / np.mean(times['array']):.1f}x, same rooms and occupancy in {num_trials} trials")
+
+def benchmark_build(args):
+    timers = {"_get_rooms_map": [], "_occupy_position": []}
+    for name in timers:
+        method = getattr(TransportChallenge, name)
+        def timed(self, *a, __method=method, __name=name, **kw):
+            start = time.perf_counter()
+            result = __method(self, *a, **kw)
+            timers[__name].append(time.perf_counter() - start)
+            return result
+        setattr(TransportChallenge, name, timed)
+    controller = TransportChallenge(port=args.port, check_version=False, screen_width=256, screen_height=256)
+    trial_times = []
+    for trial in range(args.num_trials):
+        start = time.perf_counter()
+        controller.start_floorplan_trial(scene=args.scene, layout=args.layout, num_containers=4, num_target_objects=10,
+                                         task=args.task, replicants=2, random_seed=trial, data_prefix=args.data_prefix)
+        trial_times.append(time.perf_counter() - start)
+    controller.communicate({"$type": "terminate"})
+    print(f"trial start: {np.mean(trial_times):.2f}s on average over {args.num_trials} trials")
+    for name, t in timers.items():
+        print(f"{name}: {np.sum(t) / args.num_trials * 1000:.2f} ms per trial ({len(t)} calls)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_trials", type=int, default=20)
+    parser.add_argument("--num_replicants", type=int, default=2)
+    parser.add_argument("--build", action="store_true", help="start real trials, needs a TDW build")
+    parser.add_argument("--port", type=int, default=1071)
+    parser.add_argument("--scene", type=str, default="2a")
+    parser.add_argument("--layout", type=str, default="0")
+    parser.add_argument("--task", type=str, default="food")
+    parser.add_argument("--data_prefix", type=str, default="dataset/dataset_test/2a_0")
+    args = parser.parse_args()
+    if args.build:
+        benchmark_build(args)
+    else:
+        benchmark_synthetic(args.num_trials, args.num_replicants)
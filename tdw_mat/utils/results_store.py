@@ -0,0 +1,186 @@
+"""
+The results of the runs of an experiment (results/{experiment_name}), kept as tables that the evaluation appends to while it runs:
+    episodes   one row per episode of a run: run, episode, finish, total, transport_rate, frames, seconds
+    llm_calls  one row per LLM call of an agent: run, episode, agent, frame and the prompts and outputs of LLM_filter
+A table is an append-only JSON lines file in {experiment dir}/results_store, each batch of rows is written with a single O_APPEND write so the
+workers of challenge_parallel and parallel runs can share it, a row cut by a killed writer is skipped when read. Reading a table returns a DataFrame, its columns are cached next to the file
+with the offset they were read up to, so only the rows appended since the last read are parsed.
+
+Runs written before the store existed are ingested once from their result_episode.json files and output.log.
+"""
+
+import os
+import re
+import json
+import pickle
+# the LLM infos logged by the agents contain numpy arrays, parse_llm_log evaluates them
+from numpy import array
+import pandas as pd
+
+def normalize_llm_call(llm_output, type = 'new', agent = None):
+    r'''
+    The llm_calls columns of the info of an LLM.run call, as logged by lm_agent ('new') or by the former agent ('nips')
+    '''
+    if type == 'nips':
+        prompt = llm_output['prompts']
+        row = {
+            'prompt_comm': llm_output.get('message_generator_prompt', ""),
+            'output_comm': llm_output['message_generator_outputs'][0] if 'message_generator_outputs' in llm_output else "",
+            'prompt_plan': prompt,
+            'output_plan_stage_1': llm_output['cot_outputs'][0],
+            'output_plan_stage_2': llm_output['outputs'][0],
+            'parse_exception': None,
+        }
+    else:
+        # no prompt when there was no available plan
+        prompt = llm_output.get('prompt_plan_stage_2', "")
+        stage_1 = re.search(r"Let's think step by step\.(.*?) Answer with only one best next action. So the answer is option", prompt, re.S)
+        row = {
+            'prompt_comm': llm_output.get('prompt_comm', ""),
+            'output_comm': llm_output['output_comm'][0] if 'output_comm' in llm_output else "",
+            'prompt_plan': prompt,
+            'output_plan_stage_1': stage_1.group(1) if stage_1 is not None else "",
+            'output_plan_stage_2': llm_output.get('output_plan_stage_2', ""),
+            'parse_exception': llm_output.get('parse_exception'),
+        }
+    row['agent'] = agent if agent is not None else prompt[4:prompt.find('. ')]
+    row['frame'] = llm_output.get('Frames')
+    row['output_parse_results'] = llm_output.get('plan')
+    return row
+
+class ResultsStore:
+    def __init__(self, root):
+        r'''
+        root: the directory of an experiment, with one directory per run
+        '''
+        self.root = root
+        self.store_dir = os.path.join(root, 'results_store')
+
+    def path(self, table):
+        return os.path.join(self.store_dir, f'{table}.jsonl')
+
+    def append(self, table, rows):
+        r'''
+        Append rows (dicts of JSON values) to a table in a single write
+        '''
+        if len(rows) == 0:
+            return
+        os.makedirs(self.store_dir, exist_ok = True)
+        data = ''.join(json.dumps(row, default = str) + '\n' for row in rows).encode()
+        # one write(2) on an O_APPEND file, so that the batches of concurrent writers do not interleave
+        fd = os.open(self.path(table), os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            size = os.fstat(fd).st_size
+            if size > 0 and os.pread(fd, 1, size - 1) != b'\n':
+                # a row cut by a writer that was killed, it is skipped when read, the new rows start on their own line
+                data = b'\n' + data
+            while len(data) > 0:
+                data = data[os.write(fd, data):]
+        finally:
+            os.close(fd)
+
+    def append_episode(self, run, episode, result, **metrics):
+        self.append('episodes', [dict(run = run, episode = int(episode), finish = result['finish'], total = result['total'],
+                                      transport_rate = result['finish'] / result['total'], **metrics)])
+
+    def append_llm_calls(self, run, episode, agent, llm_outputs):
+        self.append('llm_calls', [dict(run = run, episode = int(episode), **normalize_llm_call(x, agent = agent)) for x in llm_outputs])
+
+    def read(self, table):
+        r'''
+        The table as a DataFrame, rows appended again for the same (run, episode) of episodes replace the former ones
+        '''
+        path = self.path(table)
+        cache_path = os.path.join(self.store_dir, f'{table}.pik')
+        cache = {'offset': 0, 'columns': {}, 'num_rows': 0}
+        if os.path.exists(cache_path):
+            with open(cache_path, 'rb') as f:
+                cache = pickle.load(f)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if cache['offset'] > size:
+            # the table was replaced
+            cache = {'offset': 0, 'columns': {}, 'num_rows': 0}
+        if cache['offset'] < size:
+            with open(path, 'rb') as f:
+                f.seek(cache['offset'])
+                data = f.read(size - cache['offset'])
+            # a batch that is still being written is read next time
+            data = data[:data.rfind(b'\n') + 1]
+            columns = cache['columns']
+            num_rows = cache['num_rows']
+            for line in data.splitlines():
+                if len(line.strip()) == 0:
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    print(f'Warning! Skipping a row of {path} that can not be decoded: {line[:100]}')
+                    continue
+                for key in row:
+                    if key not in columns:
+                        columns[key] = [None] * num_rows
+                for key, values in columns.items():
+                    values.append(row.get(key))
+                num_rows += 1
+            if len(data) > 0:
+                cache = {'offset': cache['offset'] + len(data), 'columns': columns, 'num_rows': num_rows}
+                tmp_path = f'{cache_path}.tmp{os.getpid()}'
+                with open(tmp_path, 'wb') as f:
+                    pickle.dump(cache, f, protocol = pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, cache_path)
+        df = pd.DataFrame(cache['columns'])
+        if table == 'episodes' and len(df) > 0:
+            df = df.drop_duplicates(['run', 'episode'], keep = 'last').reset_index(drop = True)
+        return df
+
+    def episodes(self):
+        return self.read('episodes')
+
+    def llm_calls(self, run = None):
+        df = self.read('llm_calls')
+        if run is not None and len(df) > 0:
+            df = df[df['run'] == run]
+        return df
+
+    def ingest(self, type = 'new', log_name = 'output.log'):
+        r'''
+        Add the episodes of the experiment that are not in the store yet from their result_episode.json files,
+        and the LLM calls of the runs written before the store from their log
+        '''
+        episodes = self.episodes()
+        known = set(zip(episodes['run'], episodes['episode'])) if len(episodes) > 0 else set()
+        known_runs = set(run for run, _ in known)
+        for run in sorted(os.listdir(self.root)):
+            run_dir = os.path.join(self.root, run)
+            if run == 'results_store' or not os.path.isdir(run_dir):
+                continue
+            rows = []
+            for episode in sorted(os.listdir(run_dir)):
+                json_path = os.path.join(run_dir, episode, 'result_episode.json')
+                if episode.isdigit() and (run, int(episode)) not in known and os.path.exists(json_path):
+                    with open(json_path, 'r') as f:
+                        result = json.load(f)
+                    rows.append(dict(run = run, episode = int(episode), finish = result['finish'], total = result['total'],
+                                     transport_rate = result['finish'] / result['total']))
+            if len(rows) == 0:
+                continue
+            log_path = os.path.join(run_dir, log_name)
+            if run not in known_runs and os.path.exists(log_path):
+                self.append('llm_calls', [dict(run = run, episode = episode, **row) for episode, row in parse_llm_log(log_path, type)])
+            self.append('episodes', rows)
+
+def parse_llm_log(log_path, type = 'new'):
+    r'''
+    Yield (episode, llm_calls row) for the LLM calls of an output.log written with --debug
+    '''
+    episode = -1
+    with open(log_path, 'r') as f:
+        for l in f:
+            if "'LLM'" not in l:
+                if 'Episode: ' in l and '/12' in l:
+                    episode = int(re.search(r'Episode: (\d+)/\d+', l).group(1))
+                if 'Episode ' in l:
+                    episode = int(re.search(r'Episode (\d+)', l).group(1))
+                continue
+            # the logged info is a dict repr, with numpy arrays
+            yield episode, normalize_llm_call(eval(l[l.find('{'):])['LLM'], type)